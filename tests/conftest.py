@@ -0,0 +1,21 @@
+import os, sys, shutil
+
+import pytest
+
+# The vaginal_pcr_* modules are flat scripts at the repository root
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PACKAGE_DIR)
+
+PATH_EXP = f"{PACKAGE_DIR}/input/EGvaginal_experiment_result.xlsx"
+PATH_DB = f"{PACKAGE_DIR}/input/EGvaginal_db_abundance.csv"
+OUTPUT_DIR = f"{PACKAGE_DIR}/output"
+
+
+@pytest.fixture
+def path_db_store(tmp_path):
+    """
+    Store directory of a copy of the legacy reference CSV - the store itself does not exist yet.
+    """
+    shutil.copyfile(PATH_DB, f"{tmp_path}/EGvaginal_db_abundance.csv")
+
+    return f"{tmp_path}/EGvaginal_db"
@@ -0,0 +1,86 @@
+import os
+
+import pytest
+
+from conftest import OUTPUT_DIR, PATH_EXP
+from vaginal_pcr_analysis import DICT_STAGE_DEPENDENCY, LI_OUTPUT, VaginalPCRAnalysis
+
+
+def make_analysis(outdir, path_db_store, path_exp=PATH_EXP):
+    os.makedirs(outdir)
+    vaginalpcranalysis = VaginalPCRAnalysis(path_exp, outdir=str(outdir), path_db_store=path_db_store)
+
+    # Record the stages in the order they run
+    li_stage_run = []
+    for stage in DICT_STAGE_DEPENDENCY:
+        def run_stage(method=getattr(vaginalpcranalysis, stage), stage=stage):
+            li_stage_run.append(stage)
+            return method()
+        setattr(vaginalpcranalysis, stage, run_stage)
+
+    return vaginalpcranalysis, li_stage_run
+
+
+def output_files(outdir):
+    return sorted(os.listdir(outdir))
+
+
+def test_abundance_skips_reference(tmp_path, path_db_store):
+    vaginalpcranalysis, li_stage_run = make_analysis(tmp_path/'out', path_db_store)
+
+    assert vaginalpcranalysis.Run(['abundance']) == (True, 'Success')
+
+    assert li_stage_run == ['ReadExperiment', 'CalculateProportion']
+    assert vaginalpcranalysis.dict_ref_stats is None
+    assert output_files(tmp_path/'out') == ['EGvaginal_abundance.csv']
+
+
+def test_mean_abundance_skips_plate(tmp_path, path_db_store):
+    vaginalpcranalysis, li_stage_run = make_analysis(tmp_path/'out', path_db_store)
+
+    assert vaginalpcranalysis.Run(['mean_abundance'])[0]
+
+    assert li_stage_run == ['ReadDB', 'PlotDistribution']
+    assert vaginalpcranalysis.df_exp is None
+    assert output_files(tmp_path/'out') == ['EGvaginal_mean_abundance.csv']
+
+
+def test_eval_runs_every_stage_once(tmp_path, path_db_store):
+    vaginalpcranalysis, li_stage_run = make_analysis(tmp_path/'out', path_db_store)
+
+    assert vaginalpcranalysis.Run(['eval', 'abundance'])[0]
+
+    assert li_stage_run == ['ReadExperiment', 'CalculateProportion', 'ReadDB', 'EvaluateProportion', 'ClassifyType', 'CalculateTotalAbundance',
+                            'EvaluateBeneficialHarmful', 'EvaluatePercentile']
+    # No histogram - PlotDistribution did not run
+    assert output_files(tmp_path/'out') == ['EGvaginal_abundance.csv', 'EGvaginal_eval.csv']
+
+
+def test_all_outputs_match_committed(tmp_path, path_db_store):
+    vaginalpcranalysis, li_stage_run = make_analysis(tmp_path/'out', path_db_store)
+
+    assert vaginalpcranalysis.Run(LI_OUTPUT)[0]
+
+    assert sorted(li_stage_run) == sorted(DICT_STAGE_DEPENDENCY)
+    assert 'EGvaginal_abundance_hist.png' in output_files(tmp_path/'out')
+    for name in ['abundance', 'eval', 'mean_abundance']:
+        with open(f"{tmp_path}/out/EGvaginal_{name}.csv", 'rb') as f, open(f"{OUTPUT_DIR}/EGvaginal_{name}.csv", 'rb') as f_expected:
+            assert f.read() == f_expected.read()
+
+
+def test_failed_stage_stops_run(tmp_path, path_db_store):
+    vaginalpcranalysis, li_stage_run = make_analysis(tmp_path/'out', path_db_store, path_exp=str(tmp_path/'missing.xlsx'))
+
+    rv, rvmsg = vaginalpcranalysis.Run(['eval', 'mean_abundance'])
+
+    assert not rv
+    assert rvmsg.startswith('ReadExperiment: ')
+    assert li_stage_run == ['ReadExperiment']
+    assert output_files(tmp_path/'out') == []
+
+
+def test_unknown_output(tmp_path, path_db_store):
+    vaginalpcranalysis, _ = make_analysis(tmp_path/'out', path_db_store)
+
+    with pytest.raises(ValueError, match='Unknown outputs'):
+        vaginalpcranalysis.Run(['abundance', 'pdf'])
@@ -0,0 +1,29 @@
+import os
+
+import pandas as pd
+
+from vaginal_pcr_batch import collect_plates, run_batch
+from vaginal_pcr_benchmark import generate_plate
+
+
+def test_collect_plates_takes_every_export_format(tmp_path):
+    for name in ['a.xlsx', 'b.xls', 'c.csv', 'd.txt', 'e.TSV', 'notes.md', '~$a.xlsx']:
+        (tmp_path/name).write_text('')
+    (tmp_path/'sub.csv').mkdir()
+
+    li_path = collect_plates([str(tmp_path), f"{tmp_path}/c.csv"])
+
+    assert [os.path.basename(path) for path in li_path] == ['a.xlsx', 'b.xls', 'c.csv', 'd.txt', 'e.TSV']
+
+
+def test_run_batch_of_text_exports(tmp_path, path_db_store):
+    (tmp_path/'plates').mkdir()
+    generate_plate(f"{tmp_path}/plates/p1.txt", 4, seed=1)
+    generate_plate(f"{tmp_path}/plates/p2.csv", 3, seed=2)
+
+    path_summary, df_timing = run_batch(collect_plates([f"{tmp_path}/plates"]), f"{tmp_path}/batch", max_workers=1, path_db_store=path_db_store)
+
+    assert df_timing['plate'].to_list() == ['p1', 'p2']
+    assert (df_timing['rv'] == True).all()
+    assert df_timing['n_sample'].to_list() == [4, 3]
+    assert pd.read_csv(path_summary, encoding='utf-8-sig')['plate'].value_counts().to_dict() == {'p1': 4, 'p2': 3}
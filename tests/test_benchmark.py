@@ -0,0 +1,65 @@
+import numpy as np
+import pytest
+
+from vaginal_pcr_benchmark import compare_results, generate_plate, generate_reference, run_benchmark, run_case, summarize_runs
+from vaginal_pcr_engine import LI_MICROBIOME, UNIVERSAL
+from vaginal_pcr_reader import read_experiment
+from vaginal_pcr_store import ReferenceStore, open_reference_matrix
+
+
+@pytest.mark.parametrize('fmt', ['txt', 'xlsx'])
+def test_generate_plate(tmp_path, fmt):
+    path_exp = generate_plate(f"{tmp_path}/plate.{fmt}", 5, undetermined_rate=0.5, seed=3)
+
+    df_exp = read_experiment(path_exp)
+
+    assert len(df_exp) == 5*(len(LI_MICROBIOME) + 1)
+    assert df_exp['sample_name'].nunique() == 5
+    assert set(df_exp['microbiome']) == set(LI_MICROBIOME + [UNIVERSAL])
+    # Universal is always determined
+    assert (df_exp.loc[df_exp['microbiome'] == UNIVERSAL, 'Ct'] < 40.1).all()
+
+
+def test_generate_plate_is_seeded(tmp_path):
+    df_first = read_experiment(generate_plate(f"{tmp_path}/a.txt", 4, seed=1))
+
+    assert df_first.equals(read_experiment(generate_plate(f"{tmp_path}/b.txt", 4, seed=1)))
+    assert not df_first.equals(read_experiment(generate_plate(f"{tmp_path}/c.txt", 4, seed=2)))
+
+
+def test_generate_reference(tmp_path):
+    manifest = generate_reference(f"{tmp_path}/store", 50, n_segment=3)
+
+    assert len(manifest['segments']) == 3
+    assert len(ReferenceStore(f"{tmp_path}/store").load(manifest)) == 50
+    assert open_reference_matrix(f"{tmp_path}/store", manifest['content_hash']) is not None
+    assert (tmp_path/'store'/'stats.json').exists()
+
+
+@pytest.mark.parametrize('case', ['analysis_warm', 'update'])
+def test_run_case(tmp_path, case):
+    path_exp = generate_plate(f"{tmp_path}/plate.txt", 6)
+    generate_reference(f"{tmp_path}/store", 40)
+
+    dict_run = run_case(case, path_exp, f"{tmp_path}/store", str(tmp_path))
+
+    assert dict_run['n_sample'] == 6
+    assert dict_run['seconds'] > 0
+    assert 'ReadDB' in [record['stage'] for record in dict_run['stages']]
+
+
+def test_run_benchmark_and_compare(tmp_path):
+    dict_result = run_benchmark([30], [4], repeat=1, li_case=['analysis_warm'], workdir=str(tmp_path))
+
+    df_summary = summarize_runs(dict_result)
+    assert df_summary.index.to_list() == [('analysis_warm', 30, 4)]
+
+    # A run twice as slow in every metric is a regression
+    dict_slow = {'runs': [dict(dict_run, seconds=dict_run['seconds']*2, rss_peak_mb=dict_run['rss_peak_mb']*2,
+                               stages=[dict(record, wall_seconds=record['wall_seconds']*2 + 1) for record in dict_run['stages']])
+                          for dict_run in dict_result['runs']]}
+    _, li_regression = compare_results(dict_result, dict_slow)
+    assert ('analysis_warm', 30, 4, 'seconds') in li_regression
+    _, li_regression = compare_results(dict_result, dict_result)
+    assert li_regression == []
+    assert np.isclose(compare_results(dict_result, dict_slow)[0]['seconds_ratio'].iloc[0], 2.0)
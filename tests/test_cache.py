@@ -0,0 +1,85 @@
+import os
+
+import pandas as pd
+import pytest
+
+import vaginal_pcr_cache
+from conftest import PATH_EXP
+from vaginal_pcr_analysis import VaginalPCRAnalysis
+from vaginal_pcr_benchmark import generate_plate
+from vaginal_pcr_cache import ResultCache
+from vaginal_pcr_store import open_store
+
+
+def make_frames(n_row):
+    return {'abundance': pd.DataFrame({'L_iners': [0.5]*n_row}, index=[f"S{idx}" for idx in range(n_row)])}
+
+
+def test_key(tmp_path):
+    resultcache = ResultCache(str(tmp_path))
+    path_a = generate_plate(f"{tmp_path}/a.txt", 3, seed=1)
+    path_b = generate_plate(f"{tmp_path}/b.txt", 3, seed=2)
+    key = resultcache.key(path_a, 'hash', 'panel')
+
+    assert resultcache.key(path_a, 'hash', 'panel') == key
+    assert len({key, resultcache.key(path_b, 'hash', 'panel'), resultcache.key(path_a, 'other', 'panel'),
+                resultcache.key(path_a, 'hash', 'other')}) == 4
+    assert resultcache.key(path_a, None, 'panel') is None
+
+
+def test_get_put_and_counters(tmp_path):
+    resultcache = ResultCache(f"{tmp_path}/cache")
+
+    assert resultcache.get('k1') is None
+    resultcache.put('k1', make_frames(2))
+    pd.testing.assert_frame_equal(resultcache.get('k1')['abundance'], make_frames(2)['abundance'])
+
+    assert (resultcache.n_hit, resultcache.n_miss) == (1, 1)
+    assert ResultCache(f"{tmp_path}/cache").read_counters() == {'hits': 1, 'misses': 1, 'evictions': 0}
+
+
+def test_least_recently_used_evicted(tmp_path):
+    resultcache = ResultCache(f"{tmp_path}/cache")
+    for idx, key in enumerate(['k1', 'k2', 'k3']):
+        resultcache.put(key, make_frames(50))
+        os.utime(f"{tmp_path}/cache/{key}", ns=(idx*10**9, idx*10**9))
+    nbytes = resultcache.entries()[0][1]
+
+    # k1 is used again - k2 becomes the least recently used
+    assert resultcache.get('k1') is not None
+    resultcache.max_bytes = 3*nbytes
+    resultcache.put('k4', make_frames(50))
+
+    assert sorted(key for _, _, key in resultcache.entries()) == ['k1', 'k3', 'k4']
+    assert resultcache.read_counters()['evictions'] == 1
+
+
+def test_analysis_hashes_plate_once_per_run(tmp_path, path_db_store, monkeypatch):
+    li_hashed = []
+    hash_experiment = vaginal_pcr_cache.hash_experiment
+    monkeypatch.setattr(vaginal_pcr_cache, 'hash_experiment', lambda path_exp: li_hashed.append(path_exp) or hash_experiment(path_exp))
+
+    def run(outdir):
+        os.makedirs(outdir)
+        vaginalpcranalysis = VaginalPCRAnalysis(PATH_EXP, outdir=str(outdir), path_db_store=path_db_store, cache=ResultCache(f"{tmp_path}/cache"))
+        rv, rvmsg = vaginalpcranalysis.Run(['eval'])
+        assert rv, rvmsg
+        return vaginalpcranalysis
+
+    # Before the store exists the key is of the legacy csv
+    run(tmp_path/'first')
+    assert len(li_hashed) == 1
+
+    # Restored from the cache, without running a stage
+    vaginalpcranalysis = run(tmp_path/'second')
+    assert len(li_hashed) == 2
+    assert vaginalpcranalysis.cache.n_hit == 1
+    assert vaginalpcranalysis.df_exp is None
+    with open(tmp_path/'first'/'EGvaginal_eval.csv', 'rb') as f, open(tmp_path/'second'/'EGvaginal_eval.csv', 'rb') as f_cached:
+        assert f.read() == f_cached.read()
+
+    # Another reference version - the store the next update migrates to
+    open_store(path_db_store, f"{path_db_store}_abundance.csv")
+    vaginalpcranalysis = run(tmp_path/'migrated')
+    assert vaginalpcranalysis.cache.n_hit == 0
+    assert len(li_hashed) == 3
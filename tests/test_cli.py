@@ -0,0 +1,35 @@
+import os, glob, importlib
+
+import pytest
+
+from conftest import PACKAGE_DIR
+from vaginal_pcr_cli import DICT_COMMAND, main
+
+
+def test_usage_and_unknown_command(capsys):
+    assert main([]) == 1
+    assert main(['--help']) == 0
+    assert 'rebuild-ref' in capsys.readouterr().out
+    assert main(['analyse']) == 1
+    assert 'Unknown command analyse' in capsys.readouterr().out
+
+
+def test_command_help_exits_0(capsys):
+    for command in DICT_COMMAND:
+        with pytest.raises(SystemExit) as exc_info:
+            main([command, '--help'])
+        assert exc_info.value.code == 0
+        assert f"usage: {command}" in capsys.readouterr().out
+
+
+def test_packaging_lists_every_module():
+    tomllib = pytest.importorskip('tomllib')
+    with open(f"{PACKAGE_DIR}/pyproject.toml", 'rb') as f:
+        dict_project = tomllib.load(f)
+
+    li_module = sorted(os.path.basename(path)[:-3] for path in glob.glob(f"{PACKAGE_DIR}/vaginal_pcr_*.py"))
+    assert sorted(dict_project['tool']['setuptools']['py-modules']) == li_module
+
+    # The console script resolves to a callable taking no arguments
+    module_name, _, attr = dict_project['project']['scripts']['vaginal-pcr'].partition(':')
+    assert getattr(importlib.import_module(module_name), attr) is main
@@ -0,0 +1,198 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from vaginal_pcr_benchmark import generate_plate
+from vaginal_pcr_drift import DriftSeries, StreamingStats, flag_plates, main, make_record, record_at, version_drift
+from vaginal_pcr_engine import LI_BENEFICIAL, LI_HARMFUL, LI_MICROBIOME, calculate_group_total
+from vaginal_pcr_rebuild import run_rebuild
+from vaginal_pcr_stats import HIST_BINS
+from vaginal_pcr_store import ReferenceStore
+from vaginal_pcr_update_reference import main as main_update
+
+
+def make_abundance(n_sample, seed, scale=1.0):
+    rng = np.random.default_rng(seed)
+    arr_abundance = rng.dirichlet(np.ones(len(LI_MICROBIOME)), size=n_sample)*scale
+    arr_abundance[rng.random(arr_abundance.shape) < 0.2] = 0.0
+
+    return pd.DataFrame(arr_abundance, index=pd.Index([f"S{seed}-{i}" for i in range(n_sample)], name='serial_number'), columns=LI_MICROBIOME)
+
+
+def stats_of(df_abundance):
+    return StreamingStats.from_frame(df_abundance, LI_MICROBIOME, LI_BENEFICIAL, LI_HARMFUL)
+
+
+def assert_stats_equal(stats, stats_expected):
+    assert stats.li_column == stats_expected.li_column
+    assert stats.n_sample == stats_expected.n_sample
+    assert np.allclose(stats.arr_mean, stats_expected.arr_mean, rtol=1e-9, atol=1e-12)
+    assert np.allclose(stats.arr_m2, stats_expected.arr_m2, rtol=1e-9, atol=1e-12)
+    assert (stats.arr_hist_count == stats_expected.arr_hist_count).all()
+
+
+def test_from_frame_matches_numpy():
+    df_abundance = make_abundance(50, seed=1)
+
+    stats = stats_of(df_abundance)
+
+    df_value = pd.concat([df_abundance] + list(calculate_group_total(df_abundance, LI_BENEFICIAL, LI_HARMFUL)), axis=1)
+    for j, col in enumerate(df_value.columns):
+        arr_value = df_value[col].to_numpy()
+        assert np.isclose(stats.arr_mean[j], arr_value.mean())
+        assert np.isclose(stats.variance()[j], arr_value.var(ddof=1))
+        arr_percent = arr_value*100 if j < len(LI_MICROBIOME) else arr_value
+        assert (stats.arr_hist_count[j] == np.histogram(arr_percent, bins=HIST_BINS)[0]).all()
+
+
+def test_merge_and_remove():
+    df_first, df_second = make_abundance(30, seed=1), make_abundance(20, seed=2)
+
+    stats = stats_of(df_first).merge(stats_of(df_second))
+    assert_stats_equal(stats, stats_of(pd.concat([df_first, df_second])))
+
+    stats.remove(stats_of(df_first))
+    assert_stats_equal(stats, stats_of(df_second))
+
+    stats.remove(stats_of(df_second))
+    assert stats.n_sample == 0
+    with pytest.raises(ValueError, match='More samples removed'):
+        stats.remove(stats_of(df_first))
+
+
+def test_stats_round_trip():
+    stats = stats_of(make_abundance(10, seed=3))
+
+    assert_stats_equal(StreamingStats.from_dict(stats.to_dict()), stats)
+    assert np.isnan(stats_of(make_abundance(1, seed=3)).variance()).all()
+
+
+def test_series_skips_incomplete_line(tmp_path):
+    series = DriftSeries(str(tmp_path))
+    assert series.read() == []
+    assert series.last() is None
+
+    series.append({'version': 1})
+    with open(series.path_series, 'a', encoding='utf-8') as f:
+        f.write('{"version": 2, "cumul')
+    assert series.last() == {'version': 1}
+
+    # The incomplete line is closed - the next record is read back
+    series.append({'version': 3})
+    assert series.read() == [{'version': 1}, {'version': 3}]
+    assert series.last() == {'version': 3}
+
+
+@pytest.fixture
+def series_shift(tmp_path):
+    # Baseline of version 1, then one plate like the reference and one shifted by twice its means
+    df_db = make_abundance(200, seed=1)
+    li_plate_stats = [('plate_ok', stats_of(make_abundance(20, seed=2))), ('plate_shift', stats_of(make_abundance(20, seed=3, scale=2.0)))]
+
+    cumulative = stats_of(df_db)
+    li_record = [make_record('baseline', {'version': 1, 'content_hash': 'h1'}, cumulative)]
+    for _, stats in li_plate_stats:
+        cumulative = StreamingStats.from_dict(cumulative.to_dict()).merge(stats)
+    li_record.append(make_record('update', {'version': 2, 'content_hash': 'h2'}, cumulative, 'h1', li_plate_stats))
+
+    series = DriftSeries(str(tmp_path))
+    for dict_record in li_record:
+        series.append(dict_record)
+
+    return series
+
+
+def test_flag_plates(series_shift):
+    df_plate = flag_plates(series_shift.read(), threshold=1.0)
+
+    assert df_plate['plate'].to_list() == ['plate_ok', 'plate_shift']
+    assert df_plate['version'].to_list() == [2, 2]
+    assert df_plate['flagged'].to_list() == [False, True]
+    assert not flag_plates(series_shift.read(), threshold=100.0)['flagged'].any()
+
+
+def test_flag_plates_skips_update_out_of_step(series_shift):
+    li_record = series_shift.read()
+    li_record[-1]['prev_content_hash'] = 'other'
+
+    assert len(flag_plates(li_record)) == 0
+
+
+def test_version_drift(series_shift):
+    li_record = series_shift.read()
+
+    version_from, version_to, df_drift = version_drift(li_record)
+
+    assert (version_from, version_to) == (1, 2)
+    assert df_drift.index.to_list() == li_record[0]['cumulative']['columns']
+    assert (df_drift['n_from'] == 200).all() and (df_drift['n_to'] == 240).all()
+    assert record_at(li_record, 5)['version'] == 2
+    assert record_at(li_record, 0) is None
+    with pytest.raises(ValueError, match='No drift record at or before version 0'):
+        version_drift(li_record, 0)
+    with pytest.raises(ValueError, match='No drift records'):
+        version_drift([])
+
+
+def assert_cumulative_matches_store(dict_record, path_store):
+    refstore = ReferenceStore(path_store)
+    manifest = refstore.read_manifest()
+
+    assert dict_record['content_hash'] == manifest['content_hash']
+    assert_stats_equal(StreamingStats.from_dict(dict_record['cumulative']), stats_of(refstore.load(manifest)[LI_MICROBIOME]))
+
+
+def test_updates_append_records(tmp_path):
+    os.makedirs(tmp_path/'plates')
+    path_store = f"{tmp_path}/store"
+    run_rebuild([generate_plate(f"{tmp_path}/plates/a.txt", 20, seed=1)], path_store, max_workers=1)
+
+    main_update([generate_plate(f"{tmp_path}/plates/b.txt", 10, seed=2), '--store', path_store])
+    # Re-run of plate b with other values - the previous values are taken out of the cumulative statistics
+    main_update([generate_plate(f"{tmp_path}/plates/b_rerun.txt", 10, undetermined_rate=0.5, seed=2), '--store', path_store, '--policy', 'replace'])
+
+    li_record = DriftSeries(path_store).read()
+    assert [dict_record['kind'] for dict_record in li_record] == ['baseline', 'update', 'update']
+    assert [dict_record['prev_content_hash'] for dict_record in li_record[1:]] == [li_record[0]['content_hash'], li_record[1]['content_hash']]
+    assert [dict_record['plates'][0]['plate'] for dict_record in li_record[1:]] == ['b', 'b_rerun']
+    assert (li_record[1]['removed']['n_sample'], li_record[2]['removed']['n_sample']) == (0, 10)
+    assert_cumulative_matches_store(li_record[-1], path_store)
+    assert flag_plates(li_record)['plate'].to_list() == ['b', 'b_rerun']
+
+
+def test_series_out_of_step_starts_from_baseline(tmp_path):
+    os.makedirs(tmp_path/'plates')
+    path_store = f"{tmp_path}/store"
+    run_rebuild([generate_plate(f"{tmp_path}/plates/a.txt", 20, seed=1)], path_store, max_workers=1)
+    os.remove(f"{path_store}/drift.jsonl")
+    manifest = ReferenceStore(path_store).read_manifest()
+
+    main_update([generate_plate(f"{tmp_path}/plates/b.txt", 10, seed=2), '--store', path_store])
+
+    li_record = DriftSeries(path_store).read()
+    assert [dict_record['kind'] for dict_record in li_record] == ['baseline', 'update']
+    assert li_record[0]['content_hash'] == manifest['content_hash']
+    assert li_record[0]['cumulative']['n_sample'] == 20
+    assert_cumulative_matches_store(li_record[-1], path_store)
+
+
+def test_drift_main(series_shift, capsys):
+    main(['--store', series_shift.path_store, '--threshold', '1.0'])
+
+    out = capsys.readouterr().out
+    assert 'Reference drift from version 1 to 2' in out
+    assert '1 plates diverge by more than 1 SD' in out
+    assert 'plate_shift' in out and 'plate_ok' not in out
+
+    main(['--store', series_shift.path_store, '--all'])
+    assert '2 plates' in capsys.readouterr().out
+
+
+def test_drift_main_exits_1(tmp_path, capsys):
+    with pytest.raises(SystemExit) as exc_info:
+        main(['--store', str(tmp_path)])
+
+    assert exc_info.value.code == 1
+    assert 'No drift records' in capsys.readouterr().out
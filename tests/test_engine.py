@@ -0,0 +1,50 @@
+import pytest
+
+from conftest import OUTPUT_DIR, PATH_EXP
+from vaginal_pcr_engine import calculate_abundance, pivot_experiment
+from vaginal_pcr_output import write_table
+from vaginal_pcr_panel import DEFAULT_PLAN
+from vaginal_pcr_reader import read_experiment
+
+
+def test_abundance_csv_is_byte_identical(tmp_path):
+    df_abundance = calculate_abundance(read_experiment(PATH_EXP), DEFAULT_PLAN)
+
+    write_table(f"{tmp_path}/EGvaginal_abundance.csv", df_abundance, index_label='serial_number')
+
+    with open(f"{tmp_path}/EGvaginal_abundance.csv", 'rb') as f, open(f"{OUTPUT_DIR}/EGvaginal_abundance.csv", 'rb') as f_expected:
+        assert f.read() == f_expected.read()
+
+
+def test_abundance_is_scalar_power_of_every_cell():
+    df_exp = read_experiment(PATH_EXP)
+    df_abundance = calculate_abundance(df_exp, DEFAULT_PLAN)
+    li_sample_name, arr_ct, arr_tm1 = pivot_experiment(df_exp, DEFAULT_PLAN['li_target'])
+
+    for i, sample_name in enumerate(li_sample_name):
+        for j, taxon in enumerate(DEFAULT_PLAN['li_microbiome']):
+            if (arr_ct[i, j] == DEFAULT_PLAN['ct_undetermined']) or (arr_tm1[i, j] <= DEFAULT_PLAN['arr_tm1_min'][j]):
+                expected = 0.0
+            else:
+                expected = 2**-(float(arr_ct[i, j]) - float(arr_ct[i, -1]))
+            assert df_abundance.loc[sample_name, taxon] == expected
+
+
+def test_undetected_cells_are_zero():
+    df_exp = read_experiment(PATH_EXP)
+    well_ct, well_tm1 = df_exp.index[(df_exp['microbiome'] == 'L_iners')][:2]
+    df_exp.loc[well_ct, 'Ct'] = DEFAULT_PLAN['ct_undetermined']
+    df_exp.loc[well_tm1, 'Tm1'] = 70.0
+
+    df_abundance = calculate_abundance(df_exp, DEFAULT_PLAN)
+
+    assert df_abundance.loc[df_exp.loc[well_ct, 'sample_name'], 'L_iners'] == 0.0
+    assert df_abundance.loc[df_exp.loc[well_tm1, 'sample_name'], 'L_iners'] == 0.0
+
+
+def test_missing_well():
+    df_exp = read_experiment(PATH_EXP)
+    df_exp = df_exp[~((df_exp['sample_name'] == df_exp['sample_name'].iloc[0]) & (df_exp['microbiome'] == 'L_iners'))]
+
+    with pytest.raises(ValueError, match='Missing well'):
+        calculate_abundance(df_exp, DEFAULT_PLAN)
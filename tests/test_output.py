@@ -0,0 +1,92 @@
+import gzip, json
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from vaginal_pcr_output import make_run_dir, open_sink, output_path, write_table
+
+
+def make_frames():
+    df_first = pd.DataFrame({'plate': ['p1', 'p1'], 'L_iners': [0.1 + 0.2, 1e-300], 'Type': ['항균든든', None]}, index=['S1', 'S2'])
+    df_second = pd.DataFrame({'plate': ['p2'], 'L_iners': [np.nan], 'Type': ['면역저하']}, index=['S3'])
+
+    return df_first, df_second
+
+
+def write_plates(path, fmt, codec='none'):
+    with open_sink(path, fmt, codec) as sink:
+        for df in make_frames():
+            sink.write(df, index_label='serial_number')
+
+    return sink
+
+
+def test_output_path():
+    assert output_path('out/EGvaginal_eval') == 'out/EGvaginal_eval.csv'
+    assert output_path('out/EGvaginal_eval', 'jsonl', 'gzip') == 'out/EGvaginal_eval.jsonl.gz'
+    assert output_path('out/EGvaginal_eval', 'csv', 'zstd') == 'out/EGvaginal_eval.csv.zst'
+    # parquet compresses its columns - no file suffix
+    assert output_path('out/EGvaginal_eval', 'parquet', 'gzip') == 'out/EGvaginal_eval.parquet'
+
+    with pytest.raises(ValueError, match='Unknown output format'):
+        output_path('out/EGvaginal_eval', 'xlsx')
+    with pytest.raises(ValueError, match='Unknown output codec'):
+        output_path('out/EGvaginal_eval', 'csv', 'bz2')
+
+
+def test_csv_sink_streams_one_table(tmp_path):
+    sink = write_plates(f"{tmp_path}/eval.csv", 'csv')
+
+    assert sink.n_row == 3
+    with open(f"{tmp_path}/eval.csv", 'rb') as f:
+        data = f.read()
+    # One BOM and one header, as the whole table written at once
+    assert data == pd.concat(make_frames()).to_csv(index_label='serial_number').encode('utf-8-sig')
+
+
+def test_csv_gzip(tmp_path):
+    write_plates(f"{tmp_path}/eval.csv", 'csv')
+    write_plates(f"{tmp_path}/eval.csv.gz", 'csv', 'gzip')
+
+    with open(f"{tmp_path}/eval.csv", 'rb') as f, gzip.open(f"{tmp_path}/eval.csv.gz", 'rb') as f_gzip:
+        assert f_gzip.read() == f.read()
+
+
+def test_jsonl_keeps_floats_exact(tmp_path):
+    write_plates(f"{tmp_path}/eval.jsonl", 'jsonl')
+
+    with open(f"{tmp_path}/eval.jsonl", encoding='utf-8') as f:
+        li_record = [json.loads(line) for line in f]
+
+    assert [record['serial_number'] for record in li_record] == ['S1', 'S2', 'S3']
+    assert [record['L_iners'] for record in li_record] == [0.1 + 0.2, 1e-300, None]
+    assert li_record[1]['Type'] is None
+    assert li_record[0]['Type'] == '항균든든'
+
+
+def test_parquet_row_group_per_write(tmp_path):
+    pq = pytest.importorskip('pyarrow.parquet')
+
+    write_plates(f"{tmp_path}/eval.parquet", 'parquet', 'zstd')
+
+    assert pq.ParquetFile(f"{tmp_path}/eval.parquet").num_row_groups == 2
+    df = pd.read_parquet(f"{tmp_path}/eval.parquet").set_index('serial_number')
+    pd.testing.assert_frame_equal(df, pd.concat(make_frames()), check_names=False)
+
+
+def test_csv_zstd(tmp_path):
+    zstandard = pytest.importorskip('zstandard')
+
+    write_table(f"{tmp_path}/eval.csv.zst", make_frames()[0], index_label='serial_number', codec='zstd')
+
+    with open(f"{tmp_path}/eval.csv.zst", 'rb') as f:
+        data = zstandard.ZstdDecompressor().stream_reader(f).read()
+    assert data == make_frames()[0].to_csv(index_label='serial_number').encode('utf-8-sig')
+
+
+def test_make_run_dir_never_reuses_a_directory(tmp_path):
+    li_path_run = [make_run_dir(str(tmp_path), prefix='batch') for _ in range(3)]
+
+    assert len(set(li_path_run)) == 3
+    assert all(path_run.startswith(f"{tmp_path}/batch_") for path_run in li_path_run)
@@ -0,0 +1,70 @@
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from conftest import PATH_EXP
+from vaginal_pcr_engine import LI_BENEFICIAL, LI_HARMFUL, LI_MICROBIOME, TM1_CUTOFF, calculate_abundance
+from vaginal_pcr_panel import DEFAULT_PANEL, DEFAULT_PLAN, compile_panel, load_plan
+from vaginal_pcr_reader import read_experiment
+
+
+def test_default_plan():
+    assert DEFAULT_PLAN['li_microbiome'] == LI_MICROBIOME
+    assert (DEFAULT_PLAN['li_beneficial'], DEFAULT_PLAN['li_harmful']) == (LI_BENEFICIAL, LI_HARMFUL)
+    assert (DEFAULT_PLAN['arr_tm1_min'] == TM1_CUTOFF).all()
+    assert np.isinf(DEFAULT_PLAN['arr_tm1_max']).all()
+    assert load_plan() is DEFAULT_PLAN
+
+
+def test_panel_file_of_the_default_panel(tmp_path):
+    # Only the targets given - every other key is that of the default panel
+    with open(tmp_path/'panel.json', 'w', encoding='utf-8') as f:
+        json.dump({'targets': DEFAULT_PANEL['targets']}, f, ensure_ascii=False)
+
+    assert load_plan(str(tmp_path/'panel.json'))['panel_hash'] == DEFAULT_PLAN['panel_hash']
+    assert compile_panel(dict(DEFAULT_PANEL, high_abundance=0.4))['panel_hash'] != DEFAULT_PLAN['panel_hash']
+
+
+def test_subset_panel_computes_its_own_targets():
+    df_exp = read_experiment(PATH_EXP)
+    li_taxa = ['L_iners', 'G_vaginalis', 'L_crispatus']
+    plan = compile_panel({'targets': [{'name': taxon, 'group': 'harmful' if taxon in LI_HARMFUL else 'beneficial', 'type': 'x'}
+                                      for taxon in li_taxa]})
+
+    df_abundance = calculate_abundance(df_exp, plan)
+
+    assert df_abundance.columns.to_list() == li_taxa
+    pd.testing.assert_frame_equal(df_abundance, calculate_abundance(df_exp, DEFAULT_PLAN)[li_taxa])
+
+
+def test_target_tm1_window():
+    df_exp = read_experiment(PATH_EXP)
+    df_default = calculate_abundance(df_exp, DEFAULT_PLAN)
+    sr_tm1 = df_exp.loc[df_exp['microbiome'] == 'G_vaginalis'].set_index('sample_name')['Tm1']
+    tm1_max = float(sr_tm1[df_default['G_vaginalis'] > 0].median())
+
+    li_target = [dict(dict_target, tm1_max=tm1_max) if dict_target['name'] == 'G_vaginalis' else dict_target for dict_target in DEFAULT_PANEL['targets']]
+    df_abundance = calculate_abundance(df_exp, compile_panel({'targets': li_target}))
+
+    arr_outside = (sr_tm1 > tm1_max).reindex(df_abundance.index).to_numpy()
+    assert arr_outside.any()
+    assert (df_abundance.loc[arr_outside, 'G_vaginalis'] == 0.0).all()
+    pd.testing.assert_series_equal(df_abundance.loc[~arr_outside, 'G_vaginalis'], df_default.loc[~arr_outside, 'G_vaginalis'])
+    pd.testing.assert_frame_equal(df_abundance.drop(columns='G_vaginalis'), df_default.drop(columns='G_vaginalis'))
+
+
+@pytest.mark.parametrize('dict_panel, message', [
+    ({'assay': 'x'}, 'Unknown panel keys assay'),
+    ({'format': 2}, 'Unsupported panel format'),
+    ({'targets': []}, 'no targets'),
+    ({'targets': [{'name': 'A', 'type': 'x', 'tm1': 80}]}, 'Unknown keys tm1 of target A'),
+    ({'targets': [{'name': 'A'}]}, 'needs a name and a type'),
+    ({'targets': [{'name': 'A', 'type': 'x', 'group': 'neutral'}]}, 'Unknown group neutral'),
+    ({'targets': [{'name': 'A', 'type': 'x'}, {'name': 'A', 'type': 'y'}]}, 'more than once: A'),
+    ({'targets': [{'name': 'Universal', 'type': 'x'}]}, 'cannot be a panel target'),
+])
+def test_invalid_panel(dict_panel, message):
+    with pytest.raises(ValueError, match=message):
+        compile_panel(dict_panel)
@@ -0,0 +1,79 @@
+import math
+
+import pytest
+
+from conftest import PATH_EXP
+from vaginal_pcr_reader import parse_float, read_experiment, rows_to_frame
+
+HEADER = ('Well', 'Well Position', 'Sample Name', 'Target Name', 'Cт', 'Tm1')
+
+
+def test_parse_float():
+    assert parse_float(35.12) == 35.12
+    assert parse_float(' 35.12 ') == 35.12
+    assert parse_float('Undetermined', undetermined=40.1) == 40.1
+    assert math.isnan(parse_float(None))
+    assert math.isnan(parse_float(''))
+
+
+def test_parse_float_decimal_comma():
+    assert parse_float('35,12') == 35.12
+    assert parse_float('80,5') == 80.5
+
+
+@pytest.mark.parametrize('value', ['1,234.5', '1.234,5', '1,234,5'])
+def test_parse_float_rejects_ambiguous_comma(value):
+    with pytest.raises(ValueError, match='ambiguous number'):
+        parse_float(value)
+
+
+def test_rows_to_frame_skips_metadata_and_stops_at_end_of_table():
+    li_row = [
+        ('* Experiment Name', 'EG plate'),
+        (),
+        HEADER,
+        (1, 'A1', 'S1', 'L_iners', '31,5', 85.0),
+        (2, 'A2', 'S1', 'Universal', 'Undetermined', 88.0),
+        (None, None, None, None, None, None),
+        (3, 'A3', 'summary row after the table', 'L_iners', 'not a number', None),
+    ]
+
+    df_exp = rows_to_frame(iter(li_row), undetermined=40.1)
+
+    assert df_exp.index.to_list() == [1, 2]
+    assert df_exp['sample_name'].to_list() == ['S1', 'S1']
+    assert df_exp['Ct'].to_list() == [31.5, 40.1]
+    assert df_exp['Tm1'].to_list() == [85.0, 88.0]
+
+
+@pytest.mark.parametrize('row_end', [(), ('',), ('[Amplification Data]',)])
+def test_rows_to_frame_end_markers(row_end):
+    li_row = [HEADER, (1, 'A1', 'S1', 'L_iners', 31.5, 85.0), row_end, (2, 'A2', 'S2', 'L_iners', 30.0, 85.0)]
+
+    assert rows_to_frame(iter(li_row)).index.to_list() == [1]
+
+
+def test_rows_to_frame_without_header():
+    with pytest.raises(ValueError, match="no 'Well' header row"):
+        rows_to_frame(iter([('Sample Name', 'Cт'), ('S1', 31.5)]))
+
+
+def test_rows_to_frame_missing_column():
+    with pytest.raises(ValueError, match='missing Tm1'):
+        rows_to_frame(iter([('Well', 'Sample Name', 'Target Name', 'CT')]))
+
+
+@pytest.mark.parametrize('ext, delimiter', [('txt', '\t'), ('csv', ',')])
+def test_text_export_matches_xlsx(tmp_path, ext, delimiter):
+    df_exp = read_experiment(PATH_EXP)
+
+    path_txt = tmp_path/f'plate.{ext}'
+    with open(path_txt, 'w', encoding='utf-8') as f:
+        f.write('* Block Type = 96-Well Block\n\n')
+        f.write(delimiter.join(HEADER) + '\n')
+        for well, row in df_exp.iterrows():
+            ct = 'Undetermined' if row['Ct'] == 40.1 else repr(row['Ct'])
+            f.write(delimiter.join([str(well), '', row['sample_name'], row['microbiome'], ct, repr(row['Tm1'])]) + '\n')
+        f.write('\n[Results summary]\n')
+
+    assert read_experiment(str(path_txt)).equals(df_exp)
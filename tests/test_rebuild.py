@@ -0,0 +1,117 @@
+import json, os
+
+import pandas as pd
+import pytest
+
+from vaginal_pcr_benchmark import generate_plate
+from vaginal_pcr_rebuild import main, run_rebuild
+from vaginal_pcr_stats import compare_reference_stats, compute_reference_stats
+from vaginal_pcr_store import ReferenceStore, SampleRegistry, open_reference_matrix
+from vaginal_pcr_update_reference import main as main_update
+
+
+@pytest.fixture
+def li_path(tmp_path):
+    # Plate c re-runs the samples of plate a with other values
+    os.makedirs(tmp_path/'plates')
+
+    return [generate_plate(f"{tmp_path}/plates/a.txt", 4, seed=1), generate_plate(f"{tmp_path}/plates/b.txt", 3, seed=2),
+            generate_plate(f"{tmp_path}/plates/c.txt", 4, undetermined_rate=0.5, seed=1)]
+
+
+def write_bad_plate(path_exp):
+    with open(path_exp, 'w', encoding='utf-8') as f:
+        f.write('not a plate export\n')
+
+    return path_exp
+
+
+@pytest.mark.parametrize('policy', ['keep-first', 'replace', 'keep-both'])
+def test_rebuild_matches_sequential_ingests(tmp_path, li_path, policy):
+    manifest, df_summary = run_rebuild(li_path, f"{tmp_path}/rebuilt", max_workers=2, policy=policy)
+
+    for path_exp in li_path:
+        main_update([path_exp, '--store', f"{tmp_path}/sequential", '--policy', policy])
+
+    df_rebuilt = ReferenceStore(f"{tmp_path}/rebuilt").load(manifest)
+    pd.testing.assert_frame_equal(df_rebuilt, ReferenceStore(f"{tmp_path}/sequential").load(), check_like=True)
+    assert len(df_rebuilt) == (11 if policy == 'keep-both' else 7)
+    assert df_summary['rv'].all()
+    assert df_summary['n_sample'].to_list() == [4, 3, 4]
+
+
+def test_rebuild_publishes_the_store(tmp_path, li_path):
+    path_store = f"{tmp_path}/store"
+
+    manifest, _ = run_rebuild(li_path, path_store, max_workers=1)
+
+    df_db = ReferenceStore(path_store).load(manifest)
+    with open(f"{path_store}/stats.json", encoding='utf-8') as f:
+        dict_stats = json.load(f)
+    assert dict_stats['content_hash'] == manifest['content_hash']
+    assert compare_reference_stats(dict_stats, compute_reference_stats(df_db, manifest)) == []
+
+    refmatrix = open_reference_matrix(path_store, manifest['content_hash'])
+    assert refmatrix is not None
+    pd.testing.assert_frame_equal(refmatrix.to_frame(), df_db, check_like=True)
+
+    registry = SampleRegistry(ReferenceStore(path_store))
+    assert registry.read(manifest['content_hash'])
+    assert registry.contains(df_db.index).all()
+    assert not os.path.exists(f"{path_store}.rebuild")
+
+
+def test_rebuild_replaces_the_previous_reference(tmp_path, li_path):
+    path_store = f"{tmp_path}/store"
+    manifest_first, _ = run_rebuild(li_path[:1], path_store, max_workers=1)
+
+    manifest, _ = run_rebuild(li_path[1:2], path_store, max_workers=1)
+
+    assert manifest['version'] > manifest_first['version']
+    assert len(manifest['segments']) == 1
+    assert ReferenceStore(path_store).load(manifest).index.str.startswith('BM002-').all()
+
+
+def test_failed_plate_is_not_published_and_resumed(tmp_path, li_path):
+    path_store = f"{tmp_path}/store"
+    li_path = li_path[:2] + [write_bad_plate(f"{tmp_path}/plates/bad.txt")]
+
+    manifest, df_summary = run_rebuild(li_path, path_store, max_workers=2)
+
+    assert manifest is None
+    assert df_summary['rv'].to_list() == [True, True, False]
+    assert not ReferenceStore(path_store).exists()
+    # The plates that were computed are kept for the next run
+    assert len(os.listdir(f"{path_store}.rebuild")) == 2
+
+    manifest, df_summary = run_rebuild(li_path, path_store, max_workers=2, skip_failed=True)
+
+    # Only the failed plate is computed again
+    assert df_summary['path_exp'].to_list() == [li_path[2]]
+    assert len(ReferenceStore(path_store).load(manifest)) == 7
+    assert not os.path.exists(f"{path_store}.rebuild")
+
+
+def test_rebuild_unknown_policy(tmp_path, li_path):
+    with pytest.raises(ValueError, match='Unknown duplicate policy'):
+        run_rebuild(li_path, f"{tmp_path}/store", policy='keep-last')
+
+
+def test_rebuild_main(tmp_path, li_path, capsys):
+    main([f"{tmp_path}/plates", '--store', f"{tmp_path}/store", '--workers', '1'])
+
+    assert 'Rebuild Complete' in capsys.readouterr().out
+    assert len(ReferenceStore(f"{tmp_path}/store").load()) == 7
+
+
+def test_rebuild_main_exits_1(tmp_path, li_path, capsys):
+    with pytest.raises(SystemExit) as exc_info:
+        main([f"{tmp_path}/empty/*.txt", '--store', f"{tmp_path}/store"])
+    assert exc_info.value.code == 1
+    assert 'No experiment result files found' in capsys.readouterr().out
+
+    write_bad_plate(f"{tmp_path}/plates/d.txt")
+    with pytest.raises(SystemExit) as exc_info:
+        main([f"{tmp_path}/plates", '--store', f"{tmp_path}/store", '--workers', '1'])
+    assert exc_info.value.code == 1
+    assert not ReferenceStore(f"{tmp_path}/store").exists()
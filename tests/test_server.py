@@ -0,0 +1,120 @@
+import os, json, time, asyncio
+
+import pytest
+
+import vaginal_pcr_server
+from vaginal_pcr_benchmark import generate_plate, generate_reference
+from vaginal_pcr_server import VaginalPCRServer
+from vaginal_pcr_update_reference import VaginalPCRUpdateRef
+
+
+async def request(port, method, target, body=b''):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(f"{method} {target} HTTP/1.1\r\nContent-Length: {len(body)}\r\n\r\n".encode('latin-1') + body)
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+
+    head, _, body = response.partition(b'\r\n\r\n')
+    return int(head.split(b' ')[1]), json.loads(body)
+
+
+def run_with_server(vaginalpcrserver, client):
+    async def main():
+        # As serve() does - the worker starts before any request
+        await asyncio.get_running_loop().run_in_executor(vaginalpcrserver.executor, os.getpid)
+        server = await asyncio.start_server(vaginalpcrserver.handle, host='127.0.0.1', port=0)
+        async with server:
+            return await client(server.sockets[0].getsockname()[1])
+
+    return asyncio.run(main())
+
+
+@pytest.fixture
+def path_store(tmp_path):
+    generate_reference(f"{tmp_path}/store", 40)
+
+    return f"{tmp_path}/store"
+
+
+@pytest.fixture
+def vaginalpcrserver(tmp_path, path_store):
+    os.makedirs(f"{tmp_path}/work")
+    vaginalpcrserver = VaginalPCRServer(workdir=f"{tmp_path}/work", max_workers=1, path_db_store=path_store)
+    yield vaginalpcrserver
+    vaginalpcrserver.close()
+
+
+def test_analyze_and_health(tmp_path, path_store, vaginalpcrserver):
+    with open(generate_plate(f"{tmp_path}/plate.txt", 5), 'rb') as f:
+        data = f.read()
+
+    async def client(port):
+        return (await request(port, 'POST', '/analyze?name=plate.txt', data), await request(port, 'GET', '/health'),
+                await request(port, 'GET', '/unknown'))
+
+    (status, dict_body), (status_health, dict_health), (status_unknown, _) = run_with_server(vaginalpcrserver, client)
+
+    assert status == 200
+    assert (dict_body['plate'], dict_body['n_sample'], dict_body['rv']) == ('plate', 5, True)
+    assert dict_body['eval'].splitlines()[0].startswith('serial_number')
+    assert status_health == 200
+    assert dict_health['requests'] == 1
+    with open(f"{path_store}/manifest.json", encoding='utf-8') as f:
+        assert dict_health['content_hash'] == json.load(f)['content_hash']
+    assert status_unknown == 404
+
+
+def test_concurrent_requests_reload_once(monkeypatch, vaginalpcrserver):
+    li_call = []
+
+    def slow_load_reference_stats(*args):
+        li_call.append(args)
+        time.sleep(0.2)
+        return load_reference_stats(*args)
+
+    load_reference_stats = vaginal_pcr_server.load_reference_stats
+    monkeypatch.setattr(vaginal_pcr_server, 'load_reference_stats', slow_load_reference_stats)
+
+    async def client(port):
+        li_tick = []
+
+        async def tick():
+            # Keeps running while the reload blocks a thread, not the event loop
+            for _ in range(5):
+                li_tick.append(time.perf_counter())
+                await asyncio.sleep(0.01)
+
+        li_response = await asyncio.gather(*[request(port, 'GET', '/health') for _ in range(4)], tick())
+        return li_response[:-1], li_tick
+
+    li_response, li_tick = run_with_server(vaginalpcrserver, client)
+
+    assert [status for status, _ in li_response] == [200]*4
+    assert len(li_call) == 1
+    assert li_tick[-1] - li_tick[0] < 0.2
+
+
+def test_reload_after_update_moves_the_pin(tmp_path, path_store, vaginalpcrserver):
+    assert vaginalpcrserver.ReloadReference()
+    path_pin = vaginalpcrserver.path_matrix
+    assert os.path.exists(path_pin)
+    assert not vaginalpcrserver.ReloadReference()
+
+    vaginalupdate = VaginalPCRUpdateRef(generate_plate(f"{tmp_path}/new.txt", 3, seed=7), path_db_store=path_store)
+    for stage in [vaginalupdate.ReadDB, vaginalupdate.CalculateProportion, vaginalupdate.InsertDataDB, vaginalupdate.UpdateStatistics,
+                  vaginalupdate.PublishReference]:
+        rv, rvmsg = stage()
+        assert rv, rvmsg
+
+    # A request in flight still uses the previous pin - it is removed when the request finishes
+    vaginalpcrserver.dict_pin_request[path_pin] = 1
+    assert vaginalpcrserver.ReloadReference()
+    assert vaginalpcrserver.dict_ref_stats['n_sample'] == 43
+    assert vaginalpcrserver.path_matrix != path_pin
+    assert os.path.exists(path_pin)
+
+    del vaginalpcrserver.dict_pin_request[path_pin]
+    vaginalpcrserver.remove_stale_pins()
+    assert not os.path.exists(path_pin)
+    assert os.path.exists(vaginalpcrserver.path_matrix)
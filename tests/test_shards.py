@@ -0,0 +1,76 @@
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from conftest import PATH_DB
+from vaginal_pcr_engine import LI_GROUP_TOTAL, LI_MICROBIOME, calculate_group_total
+from vaginal_pcr_shards import load_shard_config, open_pooled_reference, read_pooled_content_hash
+from vaginal_pcr_stats import compare_reference_stats, compute_reference_stats, percentile_rank
+from vaginal_pcr_store import open_store
+
+
+@pytest.fixture
+def path_config(tmp_path):
+    # The legacy reference split into three sites - the first one with a csv at a configured path
+    df_csv = pd.read_csv(PATH_DB, index_col=0)
+    li_shard = []
+    for idx, li_col in enumerate(np.array_split(df_csv.columns.to_numpy(), 3)):
+        name = f"site_{idx}"
+        path_csv = f"{tmp_path}/legacy_{idx}.csv" if idx == 0 else f"{tmp_path}/{name}/EGvaginal_db_abundance.csv"
+        (tmp_path/name).mkdir()
+        df_csv[li_col].to_csv(path_csv)
+        li_shard.append({'name': name, 'store': f"{name}/EGvaginal_db", 'csv': f"legacy_{idx}.csv" if idx == 0 else None})
+
+    with open(f"{tmp_path}/shards.json", 'w', encoding='utf-8') as f:
+        json.dump({'shards': li_shard}, f)
+
+    return f"{tmp_path}/shards.json"
+
+
+def test_load_shard_config(tmp_path, path_config):
+    li_shard = load_shard_config(path_config)
+
+    assert [dict_shard['name'] for dict_shard in li_shard] == ['site_0', 'site_1', 'site_2']
+    assert li_shard[0]['csv'] == f"{tmp_path}/legacy_0.csv"
+    assert li_shard[1] == {'name': 'site_1', 'store': f"{tmp_path}/site_1/EGvaginal_db", 'csv': f"{tmp_path}/site_1/EGvaginal_db_abundance.csv"}
+
+    with open(path_config, 'w', encoding='utf-8') as f:
+        json.dump({'shards': [{'name': 'a', 'store': 'x'}, {'name': 'a', 'store': 'y'}]}, f)
+    with pytest.raises(ValueError, match='unique'):
+        load_shard_config(path_config)
+
+
+@pytest.mark.parametrize('max_workers', [1, 3])
+def test_pooled_reference_equals_one_store(path_config, max_workers):
+    df_db = pd.read_csv(PATH_DB, index_col=0).transpose()
+
+    dict_stats, percentile_index = open_pooled_reference(path_config, max_workers=max_workers)
+
+    assert compare_reference_stats(dict_stats, compute_reference_stats(df_db, {'content_hash': 'pooled', 'version': 0})) == []
+    assert [dict_shard['n_sample'] for dict_shard in dict_stats['shards']] == [len(arr) for arr in np.array_split(np.arange(len(df_db)), 3)]
+
+    # Percentiles from the rank counts of the shards are those within the pooled cohort
+    arr_value = df_db['L_iners'].to_numpy()[::5]
+    assert percentile_index.percentile('L_iners', arr_value).tolist() == percentile_rank(np.sort(df_db['L_iners'].to_numpy()), arr_value).tolist()
+    sr_beneficial, _ = calculate_group_total(df_db[LI_MICROBIOME])
+    assert (percentile_index.percentile(LI_GROUP_TOTAL[0], [0.0, 50.0]).tolist()
+            == percentile_rank(np.sort(sr_beneficial.to_numpy()), [0.0, 50.0]).tolist())
+
+
+def test_pooled_content_hash_follows_shards(path_config):
+    # Before the migration - from the legacy csv files
+    dict_stats, _ = open_pooled_reference(path_config, max_workers=1)
+    assert read_pooled_content_hash(path_config) == dict_stats['content_hash']
+
+    for dict_shard in load_shard_config(path_config):
+        open_store(dict_shard['store'], dict_shard['csv'])
+    dict_stats, _ = open_pooled_reference(path_config, max_workers=1)
+    assert read_pooled_content_hash(path_config) == dict_stats['content_hash']
+
+    # A new sample in one shard changes the pooled version
+    refstore = open_store(load_shard_config(path_config)[1]['store'], None)
+    df_new = refstore.load().iloc[:1].rename(index=lambda sample_name: f"{sample_name}_new")
+    refstore.append(df_new)
+    assert read_pooled_content_hash(path_config) != dict_stats['content_hash']
@@ -0,0 +1,150 @@
+import os
+from fractions import Fraction
+
+import numpy as np
+import pandas as pd
+import pytest
+from scipy.stats import percentileofscore
+
+from conftest import OUTPUT_DIR, PATH_EXP
+from vaginal_pcr_analysis import VaginalPCRAnalysis
+from vaginal_pcr_engine import LI_BENEFICIAL, LI_GROUP_TOTAL, LI_HARMFUL, LI_MICROBIOME, calculate_group_total
+from vaginal_pcr_stats import (EXACT_SCALE, ReferenceAccumulator, ReferenceVersionError, compare_reference_stats, compute_reference_stats,
+                               exact_mean, exact_sum, load_percentile_index, load_stats_snapshot, open_legacy_reference, open_reference_snapshot,
+                               percentile_rank, rank_counts, write_stats_snapshot)
+from vaginal_pcr_store import open_store
+
+
+def make_frame(n_sample, seed):
+    rng = np.random.default_rng(seed)
+    # Abundances over many orders of magnitude, and undetected cells
+    arr_abundance = rng.random((n_sample, len(LI_MICROBIOME)))*10.0**rng.integers(-12, 1, (n_sample, len(LI_MICROBIOME)))
+    arr_abundance[rng.random(arr_abundance.shape) < 0.3] = 0.0
+
+    return pd.DataFrame(arr_abundance, index=[f"S{seed}_{idx}" for idx in range(n_sample)], columns=LI_MICROBIOME)
+
+
+def test_exact_sum_matches_fractions():
+    arr = np.concatenate([make_frame(200, seed=1).to_numpy().ravel(), [1e300, -1e300, 5e-324, -0.0, 1.0, 1e-30, -1.0]])
+
+    assert Fraction(exact_sum(arr), 2**EXACT_SCALE) == sum(Fraction(x) for x in arr.tolist())
+
+
+def test_exact_sum_is_order_independent():
+    arr = make_frame(200, seed=2).to_numpy().ravel()
+
+    assert exact_sum(arr) == exact_sum(arr[::-1]) == exact_sum(np.sort(arr))
+    assert exact_sum([]) == 0
+
+
+def test_exact_mean_is_correctly_rounded():
+    arr = make_frame(50, seed=3)['L_iners'].to_numpy()
+
+    assert exact_mean(exact_sum(arr), len(arr)) == float(sum(Fraction(x) for x in arr.tolist())/len(arr))
+
+
+def test_snapshot_keyed_by_content_hash(tmp_path):
+    dict_stats = compute_reference_stats(make_frame(20, seed=4), {'content_hash': 'abc', 'version': 3, 'taxa': LI_MICROBIOME})
+    write_stats_snapshot(f"{tmp_path}/stats.json", dict_stats)
+
+    assert load_stats_snapshot(f"{tmp_path}/stats.json", 'abc') == dict_stats
+    assert load_stats_snapshot(f"{tmp_path}/stats.json", 'def') is None
+    assert load_stats_snapshot(f"{tmp_path}/missing.json", 'abc') is None
+
+
+def test_legacy_statistics_cached_per_process(path_db_store):
+    path_csv = f"{path_db_store}_abundance.csv"
+
+    df_db, manifest, dict_stats = open_legacy_reference(path_db_store, path_csv)
+
+    assert manifest['content_hash'].startswith('csv:')
+    assert dict_stats == compute_reference_stats(df_db, manifest)
+    assert open_reference_snapshot(path_db_store, path_csv)[0] is dict_stats
+
+    # A changed csv is read again
+    df_db.iloc[:3].transpose().to_csv(path_csv)
+    os.utime(path_csv, ns=(0, 0))
+    _, manifest_changed, dict_stats_changed = open_legacy_reference(path_db_store, path_csv)
+    assert manifest_changed['content_hash'] != manifest['content_hash']
+    assert dict_stats_changed['n_sample'] == 3
+
+
+def test_accumulator_add_matches_recompute():
+    df_first = make_frame(40, seed=5)
+    df_second = make_frame(25, seed=6)
+
+    acc = ReferenceAccumulator(LI_MICROBIOME, LI_BENEFICIAL, LI_HARMFUL).add(df_first).add(df_second)
+
+    dict_stats = compute_reference_stats(pd.concat([df_first, df_second]))
+    assert compare_reference_stats(acc.to_stats(), dict_stats) == []
+
+
+def test_accumulator_remove_matches_recompute():
+    # A re-run replaces the values of samples already in the reference
+    df_db = make_frame(40, seed=7)
+    df_rerun = make_frame(10, seed=8).set_axis(df_db.index[:10], axis=0)
+
+    acc = ReferenceAccumulator(LI_MICROBIOME, LI_BENEFICIAL, LI_HARMFUL).add(df_db)
+    acc.remove(df_db.iloc[:10]).add(df_rerun)
+
+    dict_stats = compute_reference_stats(pd.concat([df_db.iloc[10:], df_rerun]))
+    assert compare_reference_stats(acc.to_stats(), dict_stats) == []
+
+
+def test_accumulator_round_trip_and_merge():
+    df_first = make_frame(30, seed=9)
+    df_second = make_frame(20, seed=10)
+
+    acc = ReferenceAccumulator.from_dict(ReferenceAccumulator(LI_MICROBIOME, LI_BENEFICIAL, LI_HARMFUL).add(df_first).to_dict())
+    acc.merge(ReferenceAccumulator(LI_MICROBIOME, LI_BENEFICIAL, LI_HARMFUL).add(df_second))
+
+    assert compare_reference_stats(acc.to_stats(), compute_reference_stats(pd.concat([df_first, df_second]))) == []
+
+
+def test_percentile_rank_equals_scipy():
+    # Ties, zeros, values outside the reference and a NaN
+    arr_reference = np.array([0.0, 0.0, 0.0, 1e-9, 0.25, 0.25, 0.5, 0.75, 0.75, 0.75, 1.0])
+    arr_value = np.array([-1.0, 0.0, 1e-12, 1e-9, 0.25, 0.3, 0.75, 1.0, 2.0, np.nan])
+
+    arr_percentile = percentile_rank(np.sort(arr_reference), arr_value)
+
+    for value, percentile in zip(arr_value[:-1], arr_percentile[:-1]):
+        assert percentile == percentileofscore(arr_reference, value, kind='rank')
+    assert np.isnan(arr_percentile[-1])
+    assert np.isnan(percentile_rank(np.empty(0), [0.5])).all()
+
+
+def test_rank_counts_of_shards_add_up():
+    arr_reference = make_frame(300, seed=5)['L_iners'].to_numpy()
+    arr_value = arr_reference[::7]
+
+    arr_left, arr_right = rank_counts(np.sort(arr_reference), arr_value)
+    li_count = [rank_counts(np.sort(arr_shard), arr_value) for arr_shard in np.array_split(arr_reference, 3)]
+
+    np.testing.assert_array_equal(arr_left, sum(left for left, _ in li_count))
+    np.testing.assert_array_equal(arr_right, sum(right for _, right in li_count))
+
+
+def test_eval_percentiles_are_exact(tmp_path, path_db_store):
+    vaginalpcranalysis = VaginalPCRAnalysis(PATH_EXP, outdir=str(tmp_path), path_db_store=path_db_store)
+    rv, rvmsg = vaginalpcranalysis.Run(['eval'])
+    assert rv, rvmsg
+
+    df_db = pd.read_csv(f"{path_db_store}_abundance.csv", index_col=0).transpose()
+    sr_beneficial, sr_harmful = calculate_group_total(df_db)
+    dict_reference = dict({col: df_db[col] for col in LI_MICROBIOME}, **dict(zip(LI_GROUP_TOTAL, [sr_beneficial, sr_harmful])))
+    df_eval = vaginalpcranalysis.df_eval
+    for col, sr_reference in dict_reference.items():
+        sr_value = vaginalpcranalysis.df_abundance[col] if col in LI_MICROBIOME else df_eval[col]
+        col_percentile = f"{col}_percentile" if col in LI_MICROBIOME else f"{col[:-3]}_percentile"
+        assert df_eval[col_percentile].to_list() == [percentileofscore(sr_reference, value, kind='rank') for value in sr_value]
+
+    with open(f"{tmp_path}/EGvaginal_eval.csv", 'rb') as f, open(f"{OUTPUT_DIR}/EGvaginal_eval.csv", 'rb') as f_expected:
+        assert f.read() == f_expected.read()
+
+
+def test_percentile_index_of_another_version(path_db_store):
+    open_store(path_db_store, f"{path_db_store}_abundance.csv")
+
+    with pytest.raises(ReferenceVersionError):
+        load_percentile_index(path_db_store, f"{path_db_store}_abundance.csv", 'sha256:other')
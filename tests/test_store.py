@@ -0,0 +1,288 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from conftest import PATH_EXP
+from vaginal_pcr_analysis import VaginalPCRAnalysis
+from vaginal_pcr_engine import LI_GROUP_TOTAL
+from vaginal_pcr_stats import compare_reference_stats, compute_reference_stats, load_reference_stats
+from vaginal_pcr_store import (COMPACT_SEGMENTS, ReferenceMatrix, ReferenceStore, SampleRegistry, hash_sample_ids, open_reference_matrix,
+                               open_store, publish_reference_matrix, write_reference_matrix)
+
+LI_TAXA = ['L_crispatus', 'L_gasseri', 'L_iners', 'L_jensenii', 'G_vaginalis', 'F_vaginae', 'BVAB-1']
+
+
+def make_frame(li_sample_name, seed):
+    arr_abundance = np.random.default_rng(seed).random((len(li_sample_name), len(LI_TAXA)))
+
+    return pd.DataFrame(arr_abundance, index=pd.Index(li_sample_name, name='serial_number'), columns=LI_TAXA)
+
+
+def segment_files(refstore):
+    return sorted(name for name in os.listdir(refstore.path_store) if name.startswith('seg_'))
+
+
+@pytest.fixture
+def refstore(tmp_path):
+    refstore = ReferenceStore(f"{tmp_path}/store")
+    refstore.create(LI_TAXA)
+
+    return refstore
+
+
+def test_append_and_load(refstore):
+    df_first = make_frame(['S1', 'S2', 'S3'], seed=1)
+    df_second = make_frame(['S4', 'S2'], seed=2)
+
+    refstore.append(df_first)
+    manifest = refstore.append(df_second)
+
+    assert manifest['version'] == 2
+    assert [segment['n_sample'] for segment in manifest['segments']] == [3, 2]
+
+    # The latest row of a sample wins
+    df_db = refstore.load(manifest)
+    assert df_db.index.to_list() == ['S1', 'S3', 'S4', 'S2']
+    np.testing.assert_array_equal(df_db.loc['S2'].to_numpy(), df_second.loc['S2'].to_numpy())
+    np.testing.assert_array_equal(df_db.loc['S1'].to_numpy(), df_first.loc['S1'].to_numpy())
+    assert refstore.sample_ids(manifest) == {'S1', 'S2', 'S3', 'S4'}
+
+
+def test_append_empty_frame_keeps_version(refstore):
+    manifest = refstore.append(make_frame(['S1'], seed=1))
+
+    assert refstore.append(make_frame([], seed=2)) == manifest
+
+
+def test_manifest_content_hash(refstore, tmp_path):
+    manifest_empty = refstore.read_manifest()
+    manifest = refstore.append(make_frame(['S1', 'S2'], seed=1))
+
+    assert manifest['content_hash'] != manifest_empty['content_hash']
+    assert manifest['content_hash'] == refstore.content_hash(manifest)
+    assert manifest['segments'][0]['sha256'] == refstore.segment_hash(manifest['segments'][0]['name'])
+
+    # Same content, same hash - independent of the store directory
+    other = ReferenceStore(f"{tmp_path}/other")
+    other.create(LI_TAXA)
+    assert other.append(make_frame(['S1', 'S2'], seed=1))['content_hash'] == manifest['content_hash']
+
+    # Any change of the values changes it
+    other = ReferenceStore(f"{tmp_path}/changed")
+    other.create(LI_TAXA)
+    assert other.append(make_frame(['S1', 'S2'], seed=3))['content_hash'] != manifest['content_hash']
+
+
+def test_compact(refstore):
+    for seed in range(4):
+        refstore.append(make_frame([f"S{seed}", 'S_rerun'], seed=seed))
+    manifest = refstore.read_manifest()
+    df_db = refstore.load(manifest)
+
+    manifest_compact = refstore.compact()
+
+    assert len(manifest_compact['segments']) == 1
+    assert manifest_compact['version'] == manifest['version'] + 1
+    assert manifest_compact['content_hash'] != manifest['content_hash']
+    assert manifest_compact['retired'] == [segment['name'] for segment in manifest['segments']]
+    pd.testing.assert_frame_equal(refstore.load(manifest_compact), df_db)
+
+    # A reader of the previous manifest still finds its segments
+    pd.testing.assert_frame_equal(refstore.load(manifest), df_db)
+    pd.testing.assert_frame_equal(refstore.lookup(['S_rerun', 'S1'], manifest), df_db.loc[['S_rerun', 'S1']])
+
+
+def test_retired_segments_deleted_by_next_compaction(refstore):
+    refstore.append(make_frame(['S1'], seed=1))
+    refstore.append(make_frame(['S2'], seed=2))
+    manifest_first = refstore.compact()
+    refstore.append(make_frame(['S3'], seed=3))
+
+    manifest = refstore.compact()
+
+    # Kept: the current segment and those it replaced; the segments retired by the first compaction are gone
+    li_expected = sorted(f"{name}.{ext}" for name in [segment['name'] for segment in manifest['segments']] + manifest['retired']
+                         for ext in ['ids', 'npy'])
+    assert segment_files(refstore) == li_expected
+    assert not set(manifest_first['retired']) & set(manifest['retired'])
+    assert refstore.load(manifest).index.to_list() == ['S1', 'S2', 'S3']
+
+
+def test_append_compacts_past_segment_limit(refstore):
+    for seed in range(COMPACT_SEGMENTS + 1):
+        manifest = refstore.append(make_frame([f"S{seed}"], seed=seed))
+
+    assert len(manifest['segments']) == 1
+    assert len(manifest['retired']) == COMPACT_SEGMENTS + 1
+    assert len(refstore.load(manifest)) == COMPACT_SEGMENTS + 1
+
+
+def test_rewrite(refstore):
+    refstore.append(make_frame(['S1', 'S2'], seed=1))
+    manifest = refstore.append(make_frame(['S3'], seed=2))
+
+    df_rebuilt = make_frame(['R1', 'R2', 'R3'], seed=3)[LI_TAXA[:3]]
+    dict_group = {'beneficial': LI_TAXA[:2], 'harmful': LI_TAXA[2:3]}
+    manifest_rewrite = refstore.rewrite(df_rebuilt, dict_group)
+
+    assert manifest_rewrite['version'] == manifest['version'] + 1
+    assert manifest_rewrite['taxa'] == LI_TAXA[:3]
+    assert manifest_rewrite['groups'] == dict_group
+    assert len(manifest_rewrite['segments']) == 1
+    pd.testing.assert_frame_equal(refstore.load(manifest_rewrite), df_rebuilt)
+    assert refstore.read_manifest() == manifest_rewrite
+    # The replaced reference stays readable until the next compaction
+    assert refstore.load(manifest).index.to_list() == ['S1', 'S2', 'S3']
+
+
+def test_open_store_migrates_legacy_csv(path_db_store):
+    path_csv = f"{path_db_store}_abundance.csv"
+
+    refstore = open_store(path_db_store, path_csv)
+
+    manifest = refstore.read_manifest()
+    df_csv = pd.read_csv(path_csv, index_col=0).transpose()
+    pd.testing.assert_frame_equal(refstore.load(manifest), df_csv, check_names=False)
+    for name in ['stats.json', 'registry.idx', 'reference.mat']:
+        assert os.path.exists(f"{path_db_store}/{name}")
+
+
+def run_analysis(outdir, path_db_store):
+    os.makedirs(outdir, exist_ok=True)
+    vaginalpcranalysis = VaginalPCRAnalysis(PATH_EXP, outdir=str(outdir), path_db_store=path_db_store)
+    rv, rvmsg = vaginalpcranalysis.Run(['abundance', 'eval', 'mean_abundance'])
+    assert rv, rvmsg
+
+    return vaginalpcranalysis
+
+
+def test_analysis_reads_legacy_csv_without_migrating(tmp_path, path_db_store):
+    vaginalpcranalysis = run_analysis(tmp_path/'csv', path_db_store)
+
+    assert vaginalpcranalysis.dict_ref_stats['content_hash'].startswith('csv:')
+    assert not os.path.exists(path_db_store)
+
+    # The same outputs once an update has migrated the CSV into the store
+    open_store(path_db_store, f"{path_db_store}_abundance.csv")
+    vaginalpcranalysis = run_analysis(tmp_path/'store', path_db_store)
+
+    assert vaginalpcranalysis.dict_ref_stats['store_version'] == 1
+    for name in ['abundance', 'eval', 'mean_abundance']:
+        with open(tmp_path/'csv'/f"EGvaginal_{name}.csv", 'rb') as f, open(tmp_path/'store'/f"EGvaginal_{name}.csv", 'rb') as f_store:
+            assert f.read() == f_store.read()
+
+
+def test_lookup_matrix_and_segments_agree(refstore):
+    prev_content_hash = refstore.read_manifest()['content_hash']
+    refstore.append(make_frame(['S1', 'S2', 'S3'], seed=1))
+    manifest = refstore.append(make_frame(['S2', 'S4'], seed=2))
+    li_lookup = ['S4', 'S2', 'missing', 'S1']
+
+    # Without a published matrix the segments are searched
+    df_segment = refstore.lookup(li_lookup, manifest)
+
+    publish_reference_matrix(refstore, manifest, prev_content_hash=prev_content_hash)
+    assert open_reference_matrix(refstore.path_store, manifest['content_hash']) is not None
+    df_matrix = refstore.lookup(li_lookup, manifest)
+
+    df_expected = refstore.load(manifest).loc[['S4', 'S2', 'S1']]
+    pd.testing.assert_frame_equal(df_segment, df_expected)
+    pd.testing.assert_frame_equal(df_matrix, df_expected)
+
+
+def test_reference_matrix_round_trip(refstore, tmp_path):
+    manifest = refstore.append(make_frame(['S1', 'S2', 'S3', 'S4'], seed=1))
+    df_db = refstore.load(manifest)
+
+    write_reference_matrix(f"{tmp_path}/reference.mat", df_db, manifest)
+    refmatrix = ReferenceMatrix(f"{tmp_path}/reference.mat")
+
+    assert (refmatrix.version, refmatrix.content_hash, refmatrix.n_sample) == (manifest['version'], manifest['content_hash'], 4)
+    assert isinstance(refmatrix.arr_abundance, np.memmap)
+    assert refmatrix.arr_abundance.ctypes.data % 64 == 0
+    pd.testing.assert_frame_equal(refmatrix.to_frame(), df_db)
+    assert refmatrix.sample_names() == ['S1', 'S2', 'S3', 'S4']
+    np.testing.assert_array_equal(refmatrix.row_keys(), hash_sample_ids(df_db.index))
+    assert refmatrix.li_sorted_column == LI_TAXA + LI_GROUP_TOTAL
+    np.testing.assert_array_equal(refmatrix.sorted_column('L_iners'), np.sort(df_db['L_iners'].to_numpy()))
+    np.testing.assert_array_equal(refmatrix.find_rows(['S3', 'missing', 'S1']), [2, -1, 0])
+
+
+def test_reference_matrix_of_empty_reference(refstore, tmp_path):
+    manifest = refstore.read_manifest()
+
+    write_reference_matrix(f"{tmp_path}/reference.mat", refstore.load(manifest), manifest)
+    refmatrix = ReferenceMatrix(f"{tmp_path}/reference.mat")
+
+    assert refmatrix.n_sample == 0
+    assert refmatrix.to_frame().empty
+    np.testing.assert_array_equal(refmatrix.find_rows(['S1']), [-1])
+
+
+def test_open_reference_matrix_checks_version(refstore):
+    manifest = refstore.append(make_frame(['S1', 'S2'], seed=1))
+
+    assert open_reference_matrix(refstore.path_store) is None
+    publish_reference_matrix(refstore, manifest)
+
+    assert open_reference_matrix(refstore.path_store, manifest['content_hash']).n_sample == 2
+    assert open_reference_matrix(refstore.path_store, 'stale') is None
+
+
+def test_publish_incremental_matrix_equals_full(refstore, tmp_path):
+    manifest_prev = refstore.append(make_frame(['S1', 'S2', 'S3'], seed=1))
+    publish_reference_matrix(refstore, manifest_prev)
+    df_added = make_frame(['S2', 'S5'], seed=2)
+    manifest = refstore.append(df_added)
+
+    # Derived from the previous matrix: S2 moves to the end with its new values, as refstore.load() orders it
+    assert publish_reference_matrix(refstore, manifest, prev_content_hash=manifest_prev['content_hash'], df_added=df_added) == 4
+    write_reference_matrix(f"{tmp_path}/full.mat", refstore.load(manifest), manifest)
+
+    with open(f"{refstore.path_store}/reference.mat", 'rb') as f, open(f"{tmp_path}/full.mat", 'rb') as f_full:
+        assert f.read() == f_full.read()
+
+
+def test_statistics_recomputed_from_matrix(refstore):
+    df_expected = make_frame([f"S{idx}" for idx in range(20)], seed=1)
+    manifest = refstore.append(df_expected)
+    publish_reference_matrix(refstore, manifest)
+    # No stats.json - the statistics come from the matrix, without reading the segments
+    for name in segment_files(refstore):
+        os.remove(f"{refstore.path_store}/{name}")
+
+    dict_stats, df_db = load_reference_stats(refstore.path_store, None)
+
+    pd.testing.assert_frame_equal(df_db, df_expected)
+    assert compare_reference_stats(dict_stats, compute_reference_stats(df_expected, manifest)) == []
+
+
+def test_registry_rebuilt_when_stale(refstore):
+    manifest = refstore.append(make_frame(['S1', 'S2'], seed=1))
+
+    registry = SampleRegistry(refstore)
+    assert not registry.read(manifest['content_hash'])
+    registry.load(manifest)
+    assert registry.contains(['S2', 'S3', 'S1']).tolist() == [True, False, True]
+    assert SampleRegistry(refstore).read(manifest['content_hash'])
+
+    # Appended without the registry - the next load rebuilds it from the segment ids
+    manifest = refstore.append(make_frame(['S3'], seed=2))
+    registry = SampleRegistry(refstore)
+    assert not registry.read(manifest['content_hash'])
+    assert registry.load(manifest).contains(['S3']).tolist() == [True]
+
+
+def test_registry_add(refstore):
+    manifest = refstore.append(make_frame(['S1'], seed=1))
+    registry = SampleRegistry(refstore).load(manifest)
+
+    manifest = refstore.append(make_frame(['S2', 'S1_run2'], seed=2))
+    registry.add(['S2', 'S1_run2'], manifest)
+
+    registry = SampleRegistry(refstore)
+    assert registry.read(manifest['content_hash'])
+    assert registry.contains(['S1', 'S2', 'S1_run2', 'S3']).tolist() == [True, True, True, False]
+    np.testing.assert_array_equal(registry.arr_key, np.unique(hash_sample_ids(['S1', 'S2', 'S1_run2'])))
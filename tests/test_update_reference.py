@@ -0,0 +1,163 @@
+import json, fcntl
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from conftest import PATH_EXP
+from vaginal_pcr_reader import read_experiment
+from vaginal_pcr_stats import compare_reference_stats, compute_reference_stats
+from vaginal_pcr_store import ReferenceStore, SampleRegistry
+from vaginal_pcr_update_reference import VaginalPCRUpdateRef, main, resolve_sample_ids
+
+LI_TAXA = ['L_iners', 'G_vaginalis']
+
+
+def make_frame(li_sample_name, value):
+    arr_abundance = np.full((len(li_sample_name), len(LI_TAXA)), float(value))
+
+    return pd.DataFrame(arr_abundance, index=pd.Index(li_sample_name, name='serial_number'), columns=LI_TAXA)
+
+
+@pytest.fixture
+def registry(tmp_path):
+    # Reference of S1 and S2, and S1_run2 from an earlier keep-both ingest
+    refstore = ReferenceStore(f"{tmp_path}/store")
+    refstore.create(LI_TAXA)
+    manifest = refstore.append(make_frame(['S1', 'S2', 'S1_run2'], 0.1))
+
+    return SampleRegistry(refstore).load(manifest)
+
+
+# Plate with S1 already in the reference, S3 new and loaded twice
+@pytest.fixture
+def df_abundance():
+    return pd.concat([make_frame(['S1', 'S3'], 0.2), make_frame(['S3'], 0.3)])
+
+
+def test_keep_first(registry, df_abundance):
+    df_insert, li_replaced, li_renamed = resolve_sample_ids(df_abundance, registry, 'keep-first')
+
+    assert df_insert.index.to_list() == ['S3']
+    assert df_insert.loc['S3', 'L_iners'] == 0.2
+    assert (li_replaced, li_renamed) == ([], [])
+
+
+def test_replace(registry, df_abundance):
+    df_insert, li_replaced, li_renamed = resolve_sample_ids(df_abundance, registry, 'replace')
+
+    assert df_insert.index.to_list() == ['S1', 'S3']
+    assert df_insert['L_iners'].to_list() == [0.2, 0.3]
+    assert li_replaced == ['S1']
+    assert li_renamed == []
+
+
+def test_keep_both(registry, df_abundance):
+    df_insert, li_replaced, li_renamed = resolve_sample_ids(df_abundance, registry, 'keep-both')
+
+    # S1_run2 is taken in the reference - the next free suffix is used
+    assert df_insert.index.to_list() == ['S1_run3', 'S3', 'S3_run2']
+    assert df_insert['L_iners'].to_list() == [0.2, 0.2, 0.3]
+    assert li_replaced == []
+    assert li_renamed == [('S1', 'S1_run3'), ('S3', 'S3_run2')]
+
+
+def test_unknown_policy(registry, df_abundance):
+    with pytest.raises(ValueError, match='Unknown duplicate policy'):
+        resolve_sample_ids(df_abundance, registry, 'keep-last')
+
+
+def read_stats(path_db_store):
+    with open(f"{path_db_store}/stats.json", encoding='utf-8') as f:
+        return json.load(f)
+
+
+def run_update(path_exp, path_db_store, policy='keep-first', verify=True):
+    vaginalupdate = VaginalPCRUpdateRef(path_exp, policy=policy, verify=verify, path_db_store=path_db_store)
+    for stage in [vaginalupdate.ReadDB, vaginalupdate.CalculateProportion, vaginalupdate.InsertDataDB, vaginalupdate.UpdateStatistics,
+                  vaginalupdate.PublishReference]:
+        rv, rvmsg = stage()
+        assert rv, f"{stage.__name__}: {rvmsg}"
+
+    return vaginalupdate
+
+
+@pytest.mark.parametrize('policy, n_added', [('keep-first', 0), ('replace', 0), ('keep-both', 32)])
+def test_incremental_statistics_match_recompute(path_db_store, policy, n_added):
+    # The example plate is in the reference already - replace takes the previous values out of the sums
+    run_update(PATH_EXP, path_db_store, policy=policy)
+
+    refstore = ReferenceStore(path_db_store)
+    manifest = refstore.read_manifest()
+    df_db = refstore.load(manifest)
+    assert len(df_db) == len(pd.read_csv(f"{path_db_store}_abundance.csv", index_col=0, nrows=0).columns) + n_added
+
+    dict_stats = read_stats(path_db_store)
+    assert dict_stats['content_hash'] == manifest['content_hash']
+    assert compare_reference_stats(dict_stats, compute_reference_stats(df_db, manifest)) == []
+
+
+def write_text_export(path_exp, df_exp):
+    with open(path_exp, 'w', encoding='utf-8') as f:
+        f.write('Well\tSample Name\tTarget Name\tCT\tTm1\n')
+        for well, row in df_exp.iterrows():
+            ct = 'Undetermined' if row['Ct'] == 40.1 else repr(row['Ct'])
+            f.write(f"{well}\t{row['sample_name']}\t{row['microbiome']}\t{ct}\t{row['Tm1']!r}\n")
+
+    return str(path_exp)
+
+
+def test_replace_removes_previous_values(path_db_store, tmp_path):
+    run_update(PATH_EXP, path_db_store)
+    refstore = ReferenceStore(path_db_store)
+    df_before = refstore.load()
+
+    # Re-run of the plate with Universal one cycle later - every detected abundance doubles
+    df_exp = read_experiment(PATH_EXP)
+    df_exp.loc[df_exp['microbiome'] == 'Universal', 'Ct'] += 1.0
+    vaginalupdate = run_update(write_text_export(tmp_path/'rerun.txt', df_exp), path_db_store, policy='replace')
+
+    df_after = refstore.load()
+    li_sample_name = vaginalupdate.df_db.index.to_list()
+    assert vaginalupdate.df_replaced.index.to_list() == li_sample_name
+    assert len(df_after) == len(df_before)
+    pd.testing.assert_frame_equal(df_after.loc[li_sample_name], df_before.loc[li_sample_name]*2.0, rtol=1e-12)
+    assert read_stats(path_db_store)['n_sample'] == len(df_before)
+
+
+def test_update_exits_1_on_failure(path_db_store, tmp_path, capsys):
+    with pytest.raises(SystemExit) as exc_info:
+        main([str(tmp_path/'missing.xlsx'), '--store', path_db_store])
+
+    assert exc_info.value.code == 1
+    assert 'Update failed in ReadDB' in capsys.readouterr().out
+
+
+def test_failed_stage_releases_store_lock(path_db_store, monkeypatch, capsys):
+    def UpdateStatistics(self):
+        return False, 'statistics failed'
+
+    monkeypatch.setattr(VaginalPCRUpdateRef, 'UpdateStatistics', UpdateStatistics)
+
+    with pytest.raises(SystemExit) as exc_info:
+        main([PATH_EXP, '--store', path_db_store, '--policy', 'keep-both'])
+
+    assert exc_info.value.code == 1
+    assert 'Update failed in UpdateStatistics: statistics failed' in capsys.readouterr().out
+    # InsertDataDB took the lock - it is free again
+    with open(f"{path_db_store}/.lock", 'a') as f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+
+def test_update_usage_error(path_db_store):
+    with pytest.raises(SystemExit) as exc_info:
+        main([PATH_EXP, '--store'])
+
+    assert exc_info.value.code == 2
+
+
+def test_update_complete(path_db_store, capsys):
+    main([PATH_EXP, '--store', path_db_store, '--verify'])
+
+    assert 'Update Complete' in capsys.readouterr().out
+    assert read_stats(path_db_store)['content_hash'] == ReferenceStore(path_db_store).read_manifest()['content_hash']
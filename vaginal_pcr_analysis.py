@@ -1,9 +1,53 @@
-import os, datetime
+import os, json, datetime, argparse
 import pandas as pd
 import sys
 import numpy as np
-from scipy.stats import percentileofscore, pearsonr
-import matplotlib.pyplot as plt
+
+from vaginal_pcr_reader import read_experiment
+from vaginal_pcr_profile import instrument_stage, profiler_from_env
+from vaginal_pcr_engine import LI_GROUP_TOTAL, calculate_abundance, calculate_group_total, classify_type, evaluate_level, level_frame
+from vaginal_pcr_panel import load_plan
+from vaginal_pcr_stats import HIST_BINS, PercentileIndex, format_distribution, load_percentile_index, open_reference_snapshot
+from vaginal_pcr_shards import open_pooled_reference, open_sharded_percentile_index, read_pooled_content_hash
+from vaginal_pcr_cache import ResultCache
+from vaginal_pcr_output import LI_CODEC, LI_FORMAT, make_run_dir, output_path, write_table
+from vaginal_pcr_store import legacy_content_hash
+
+#-------------------------------------------------------
+# Pipeline
+#-------------------------------------------------------
+# Every stage declares the stages it needs and every output the stage that writes it. Run() computes
+# only the stages of the requested outputs, each once, in dependency order - e.g. the abundance csv
+# alone never opens the reference, and the eval csv alone does not render the histogram.
+LI_OUTPUT = ['abundance', 'eval', 'mean_abundance', 'histogram']
+
+DICT_OUTPUT_STAGE = {
+    'abundance': 'CalculateProportion',
+    'eval': 'EvaluatePercentile',
+    'mean_abundance': 'PlotDistribution',
+    'histogram': 'PlotDistribution',
+}
+
+# Table outputs - frame attribute, path attribute and index label. Their frames are what ResultCache keeps.
+DICT_OUTPUT_TABLE = {
+    'abundance': ('df_abundance', 'path_abundance_output', 'serial_number'),
+    'eval': ('df_eval', 'path_eval_output', 'serial_number'),
+    'mean_abundance': ('df_mean_abundance', 'path_mean_abundance', 'taxa'),
+}
+LI_CACHED_STAGE = ['ReadExperiment', 'CalculateProportion', 'EvaluateProportion', 'ClassifyType', 'CalculateTotalAbundance',
+                   'EvaluateBeneficialHarmful', 'EvaluatePercentile']
+
+DICT_STAGE_DEPENDENCY = {
+    'ReadExperiment': [],
+    'ReadDB': [],
+    'CalculateProportion': ['ReadExperiment'],
+    'EvaluateProportion': ['CalculateProportion', 'ReadDB'],
+    'ClassifyType': ['EvaluateProportion'],
+    'CalculateTotalAbundance': ['EvaluateProportion'],
+    'EvaluateBeneficialHarmful': ['CalculateTotalAbundance'],
+    'EvaluatePercentile': ['ClassifyType', 'EvaluateBeneficialHarmful'],
+    'PlotDistribution': ['ReadDB'],
+}
 
 #-------------------------------------------------------
 # Common Function
@@ -29,49 +73,93 @@ def WriteLog(functionname, msg, type='INFO', fplog=None):
         fplog.flush()
         
 # Histogram Plot 
-def save_histograms_to_file(df, filename):
-    num_rows = df.shape[1]
-    fig, axs = plt.subplots(num_rows, 1, figsize=(8, 6*num_rows))
+def save_histograms_to_file(dict_histogram, filename):
+    """
+    Plot the reference histograms from their precomputed bin weights and save them as one png.
+
+    Parameters:
+    dict_histogram (dict): Percentage of samples per bin of HIST_BINS, keyed by column name.
+    filename (str): Path of the png file to save.
+    """
+    # matplotlib is only loaded by the runs that render. The figure is drawn on its own Agg canvas, without
+    # pyplot, so the backend and the figure registry of the process are left alone
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    
+    li_col = list(dict_histogram)
+    num_rows = len(li_col)
+    fig = Figure(figsize=(8, 6*num_rows))
+    FigureCanvasAgg(fig)
+    axs = fig.subplots(num_rows, 1, squeeze=False)[:, 0]
     
     for i in range(num_rows):           
-        data = df.iloc[:,i]
-        axs[i].hist(data, weights=np.ones(len(data)) / len(data)*100, bins=[0,20,40,60,80,100])
-        axs[i].set_title(df.columns.to_list()[i][:-9])
+        axs[i].hist(HIST_BINS[:-1], weights=dict_histogram[li_col[i]], bins=HIST_BINS)
+        axs[i].set_title(li_col[i][:-9])
         axs[i].set_xlabel('Sum of Relative Abundance[%]')
         axs[i].set_ylabel('Percentage of samples[%]')        
         axs[i].set_xlim([0, 100])
-        
-        if i == 0:
-            beneficial_distribution = axs[i].hist(data, weights=np.ones(len(data)) / len(data)*100, bins=[0,20,40,60,80,100])[0]
-        if i == 1:
-            harmful_distribution = axs[i].hist(data, weights=np.ones(len(data)) / len(data)*100, bins=[0,20,40,60,80,100])[0]        
     
-    str_beneficial_distribution = ','.join(str(x) for x in beneficial_distribution)
-    str_harmful_distribution = ','.join(str(x) for x in harmful_distribution)
+    fig.tight_layout()
+    fig.savefig(filename)          
+
+
+def save_reference_histogram(dict_ref_stats, filename):
+    """
+    Render the reference histogram png unless it was already rendered from the same statistics snapshot.
+    A .key file next to the png records the snapshot it was drawn from.
 
-    plt.tight_layout()
-    plt.savefig(filename)          
+    Returns:
+    True if the png was rendered, False if it was up to date.
+    """
+    path_key = f"{filename}.key"
+    str_key = f"{dict_ref_stats['content_hash']}:{dict_ref_stats['snapshot_version']}"
     
-    return str_beneficial_distribution, str_harmful_distribution
+    if os.path.exists(filename) and os.path.exists(path_key):
+        with open(path_key) as f:
+            if f.read() == str_key:
+                return False
+    
+    save_histograms_to_file(dict_ref_stats['histogram'], filename)
+    
+    with open(path_key, 'w') as f:
+        f.write(str_key)
+        
+    return True
     
     
 ###################################
 # MainClass
 ###################################
 class VaginalPCRAnalysis:
-    def __init__(self, path_exp, outdir=None, fplog=None):
+    def __init__(self, path_exp, outdir=None, fplog=None, dict_ref_stats=None, profiler=None, path_db_store=None, path_shards=None, cache=None,
+                 output_format='csv', codec='none', plan=None):
         """
         Initializes a VaginalPCRAnalysis object.
 
         Parameters:
         path_exp (str): Path of PCR experiment result file to analyze.
+        outdir (str): Directory of the output files.
+        dict_ref_stats (dict): Reference statistics already loaded by the caller (e.g. a batch run); loaded in ReadDB if None.
+        profiler (StageProfiler): Records timing and memory of every stage if given.
+        path_db_store (str): Directory of the reference store (default: input/EGvaginal_db).
+        path_shards (str): Shard configuration of a pooled multi-site reference, used instead of path_db_store if given.
+        cache (ResultCache): Result cache consulted by Run(); results are always computed if None.
+        output_format (str): Format of the table outputs - 'csv', 'parquet' or 'jsonl'.
+        codec (str): Compression of the table outputs - 'none', 'gzip' or 'zstd'.
+        plan (dict): Compiled target panel (vaginal_pcr_panel) - taxa, detection windows and thresholds (default: the default panel).
         """
         self.__fplog=fplog        
+        self.profiler = profiler
+        self.plan = plan if plan is not None else load_plan()
         
         ## Path of Reference files
         curdir = os.path.dirname(os.path.abspath(__file__))
         self.path_exp = path_exp
-        self.path_db = f"{curdir}/input/EGvaginal_db_abundance.csv"
+        self.path_db_store = path_db_store if path_db_store is not None else f"{curdir}/input/EGvaginal_db"
+        self.path_db = f"{curdir}/input/EGvaginal_db_abundance.csv" if path_db_store is None else f"{path_db_store}_abundance.csv"
+        self.path_db_stats = f"{self.path_db_store}/stats.json"
+        self.path_shards = path_shards
+        self.cache = cache
                        
         ###output
         if( outdir is not None ):
@@ -81,14 +169,17 @@ class VaginalPCRAnalysis:
             
             
         ## Path of output files     
-        self.path_abundance_output = f"{self.outdir}/EGvaginal_abundance.csv"
-        self.path_eval_output = f"{self.outdir}/EGvaginal_eval.csv"
-        self.path_mean_abundance = f"{self.outdir}/EGvaginal_mean_abundance.csv"
+        self.output_format = output_format
+        self.codec = codec
+        self.path_abundance_output = output_path(f"{self.outdir}/EGvaginal_abundance", output_format, codec)
+        self.path_eval_output = output_path(f"{self.outdir}/EGvaginal_eval", output_format, codec)
+        self.path_mean_abundance = output_path(f"{self.outdir}/EGvaginal_mean_abundance", output_format, codec)
         self.path_hist = f"{self.outdir}/EGvaginal_abundance_hist.png"
         
         ## Dataframe of Reference files
         self.df_exp = None
         self.df_db = None
+        self.refmatrix = None
         
         ## Dataframe of output files to calculate
         self.df_abundance = None
@@ -99,11 +190,134 @@ class VaginalPCRAnalysis:
         self.li_new_sample_name = None
         self.li_microbiome = None
         
+        ## Sorted reference columns of the percentile ranks
+        self.percentile_index = None
+        
         ## Dictionaries used for calculation        
         self.dict_mean_abundance = None
+        self.dict_ref_stats = dict_ref_stats
         
+        ## Outputs written by the stages, and the results of the stages run by Run()
+        self.set_output = set(LI_OUTPUT)
+        self.dict_stage_result = {}
+        self.lazy = False
         
-    def ReadDB(self):
+        
+    def Run(self, li_output=LI_OUTPUT):
+        """
+        Compute the given outputs lazily - only the stages they depend on run, each at most once.
+        With a result cache, the table outputs of a plate already analyzed against the same reference and rules
+        are restored from it; on a miss the frames of every table output are computed and cached.
+
+        Parameters:
+        li_output (list): Outputs to write, of LI_OUTPUT.
+
+        Returns:
+        A tuple (success, message) of the first failed stage, or of the last one.
+        """
+        li_unknown = [output for output in li_output if output not in DICT_OUTPUT_STAGE]
+        if li_unknown:
+            raise ValueError(f"Unknown outputs {', '.join(li_unknown)} (expected {', '.join(LI_OUTPUT)})")
+        
+        self.set_output = set(li_output)
+        self.lazy = True
+        
+        # The key hashes the whole experiment file - computed once, for the lookup and the entry added on a miss
+        key, content_hash = None, None
+        cache_miss = False
+        if self.cache is not None:
+            content_hash = self.reference_version()
+            key = self.cache.key(self.path_exp, content_hash, self.plan['panel_hash'])
+            if self.RestoreCache(key, li_output):
+                li_output = [output for output in li_output if output not in DICT_OUTPUT_TABLE]
+                self.set_output = set(li_output)
+            else:
+                cache_miss = True
+                # Complete entry - the stages of every table output run, their files are written only if selected
+                li_output = list(li_output) + [output for output in DICT_OUTPUT_TABLE if output not in li_output]
+        
+        rv, rvmsg = True, "Success"
+        for output in li_output:
+            rv, rvmsg = self.RunStage(DICT_OUTPUT_STAGE[output])
+            if not rv:
+                break
+        
+        # Keyed by the reference version the results were computed against - rekeyed only if the reference
+        # was created or updated after the lookup
+        if cache_miss and rv:
+            if self.dict_ref_stats['content_hash'] != content_hash:
+                key = self.cache.key(self.path_exp, self.dict_ref_stats['content_hash'], self.plan['panel_hash'])
+            self.cache.put(key, {output: getattr(self, DICT_OUTPUT_TABLE[output][0]) for output in DICT_OUTPUT_TABLE})
+            
+        return rv, rvmsg
+    
+    def reference_version(self):
+        """
+        Content hash of the reference the plate is analyzed against, without loading it - of the legacy csv before the store
+        exists; None if there is neither.
+        """
+        if self.dict_ref_stats is not None:
+            return self.dict_ref_stats['content_hash']
+        if self.path_shards is not None:
+            return read_pooled_content_hash(self.path_shards)
+        
+        path_manifest = f"{self.path_db_store}/manifest.json"
+        if not os.path.exists(path_manifest):
+            return legacy_content_hash(self.path_db) if os.path.exists(self.path_db) else None
+        with open(path_manifest, encoding='utf-8') as f:
+            return json.load(f)['content_hash']
+    
+    def RestoreCache(self, key, li_output):
+        """
+        Restore the frames of a cached plate and write its selected table outputs.
+
+        Returns:
+        True on a cache hit.
+        """
+        myNAME = self.__class__.__name__+"::"+sys._getframe().f_code.co_name
+        
+        dict_frame = self.cache.get(key)
+        if dict_frame is None:
+            return False
+        
+        for output, (attr, _, _) in DICT_OUTPUT_TABLE.items():
+            setattr(self, attr, dict_frame[output])
+        self.li_microbiome = list(self.df_abundance.columns)
+        self.li_new_sample_name = self.df_abundance.index.to_list()
+        
+        for output in li_output:
+            if output in DICT_OUTPUT_TABLE:
+                self.write_output(output)
+        for stage in LI_CACHED_STAGE:
+            self.dict_stage_result[stage] = (True, "Cached")
+            
+        WriteLog(myNAME, f"Cache hit {key[:12]} - {len(self.df_abundance)} samples restored", type='INFO', fplog=self.__fplog)
+        
+        return True
+    
+    def write_output(self, output):
+        attr, path_attr, index_label = DICT_OUTPUT_TABLE[output]
+        write_table(getattr(self, path_attr), getattr(self, attr), index_label=index_label, fmt=self.output_format, codec=self.codec)
+    
+    def RunStage(self, stage):
+        """
+        Run a stage after the stages it depends on, memoized in dict_stage_result.
+        """
+        if stage in self.dict_stage_result:
+            return self.dict_stage_result[stage]
+        
+        for dependency in DICT_STAGE_DEPENDENCY[stage]:
+            rv, rvmsg = self.RunStage(dependency)
+            if not rv:
+                return rv, rvmsg
+            
+        rv, rvmsg = getattr(self, stage)()
+        self.dict_stage_result[stage] = (rv, rvmsg if rv else f"{stage}: {rvmsg}")
+        
+        return self.dict_stage_result[stage]
+        
+    @instrument_stage('df_exp')
+    def ReadExperiment(self):
         myNAME = self.__class__.__name__+"::"+sys._getframe().f_code.co_name
         WriteLog(myNAME, "In", type='INFO', fplog=self.__fplog)
         
@@ -111,30 +325,41 @@ class VaginalPCRAnalysis:
         rvmsg = "Success"
         
         try:           
-            self.df_db = pd.read_csv(self.path_db, index_col=0)
-            
-            self.df_exp = pd.read_excel(self.path_exp)
-            idx_well_id = list(self.df_exp[self.df_exp.columns[0]]).index('Well')
-            self.df_exp = self.df_exp[idx_well_id:].rename(columns = self.df_exp[idx_well_id:].reset_index().iloc[0]).drop(idx_well_id).set_index('Well')
-            
-            li_column = self.df_exp.columns.values.tolist()
+            # Experiment result - streamed result table with float Ct (Undetermined -> ct_undetermined of the panel) and Tm1
+            self.df_exp = read_experiment(self.path_exp, self.plan['ct_undetermined'])
+        except Exception as e:
+            print(str(e))
+            rv = False
+            rvmsg = str(e)
+            print(f"Error has occurred in the {myNAME} process")    
             
-            if "Cт" in li_column:
-                self.df_exp = self.df_exp[["Sample Name", "Target Name", "Cт", 'Tm1']]
-                self.df_exp.rename(columns = {"Sample Name": "sample_name", "Target Name": "microbiome", "Cт": "Ct", "Tm1": "Tm1"}, inplace=True)
+        return rv, rvmsg   
+        
+    @instrument_stage('df_exp')
+    def ReadDB(self):
+        myNAME = self.__class__.__name__+"::"+sys._getframe().f_code.co_name
+        WriteLog(myNAME, "In", type='INFO', fplog=self.__fplog)
+        
+        rv = True
+        rvmsg = "Success"
+        
+        try:           
+            # Reference statistics - the snapshot of the update script, or a full recompute if it is stale.
+            # The statistics and the memory-mapped matrix are pinned to the same reference version.
+            if (self.dict_ref_stats is None) and (self.path_shards is not None):
+                # Pooled multi-site reference - reduced from the shard partials, never materialized
+                self.dict_ref_stats, self.percentile_index = open_pooled_reference(self.path_shards)
+            elif self.dict_ref_stats is None:
+                self.dict_ref_stats, self.df_db, self.refmatrix = open_reference_snapshot(self.path_db_store, self.path_db)
                 
-            elif "CT" in li_column:
-                self.df_exp = self.df_exp[["Sample Name", "Target Name", "CT", 'Tm1']]
-                self.df_exp.rename(columns = {"Sample Name": "sample_name", "Target Name": "microbiome", "CT": "Ct", "Tm1": "Tm1"}, inplace=True)
+                if self.dict_ref_stats['content_hash'].startswith('csv:'):
+                    WriteLog(myNAME, f"No reference store yet - statistics computed from {self.path_db} (migrated by the next update)", type='INFO', fplog=self.__fplog)
+                elif self.df_db is not None:
+                    WriteLog(myNAME, "Reference statistics snapshot is missing or stale - recomputed", type='INFO', fplog=self.__fplog)
             
-            else:
-                print("Check the columns of Experiment result file")
-                sys.exit()
-            
-            idx_nan_id = self.df_exp.index.to_list().index(np.nan)
-            self.df_exp = self.df_exp.iloc[:idx_nan_id, :]
-            self.df_exp.loc[self.df_exp['Ct'] == 'Undetermined', 'Ct'] = 40.1
-                  
+            # Experiment result for stage-by-stage callers - Run() reads it in ReadExperiment, only if an output needs it
+            if (self.df_exp is None) and (not self.lazy):
+                self.df_exp = read_experiment(self.path_exp, self.plan['ct_undetermined'])
         except Exception as e:
             print(str(e))
             rv = False
@@ -143,6 +368,7 @@ class VaginalPCRAnalysis:
             
         return rv, rvmsg   
 
+    @instrument_stage('df_abundance')
     def CalculateProportion(self):
         """
         Calculate the Relative Abundance and Save the Relative Abundance data as an Csv file.
@@ -158,42 +384,24 @@ class VaginalPCRAnalysis:
         rvmsg = "Success"
         
         try:      
-            self.li_new_sample_name = list(dict.fromkeys(self.df_exp.sample_name)) 
-            self.li_microbiome = ['L_crispatus', 'L_gasseri', 'L_iners', 'L_jensenii', 'G_vaginalis', 'F_vaginae', 'BVAB-1']
-            
-            self.df_abundance = pd.DataFrame(index = self.li_microbiome, columns = self.li_new_sample_name)
-            self.df_abundance = self.df_abundance.fillna(0)
+            self.li_microbiome = list(self.plan['li_microbiome'])
             
-            for i in range(len(self.li_new_sample_name)):
-                for j in range(len(self.li_microbiome)):            
-            
-                    sample_name = self.li_new_sample_name[i]
-
-                    condition_universal = (self.df_exp.sample_name == sample_name) & (self.df_exp.microbiome == 'Universal')
-                    condition_microbiome = (self.df_exp.sample_name == sample_name) & (self.df_exp.microbiome == self.li_microbiome[j])
-
-                    ct = self.df_exp[condition_microbiome]['Ct'].values[0]
-                    ct_universal = self.df_exp[condition_universal]['Ct'].values[0]   
-                    Tm1 = self.df_exp[condition_microbiome]['Tm1'].values[0]
-
-                    if (ct == 40.1) | (Tm1 <= 80):                    
-                        self.df_abundance.loc[self.li_microbiome[j], self.li_new_sample_name[i]] = 0
-                        
-                    else:                    
-                        self.df_abundance.loc[self.li_microbiome[j], self.li_new_sample_name[i]] = 2**(-(ct- ct_universal))
-            self.df_abundance = self.df_abundance.rename_axis('serial_number', axis=1)                        
-            
-            self.df_abundance = self.df_abundance.transpose()
+            self.df_abundance = calculate_abundance(self.df_exp, self.plan)
+            self.li_new_sample_name = self.df_abundance.index.to_list()
             
             # Save the output file - Abundance of the samples
-            self.df_abundance.to_csv(self.path_abundance_output, encoding="utf-8-sig", index_label='serial_number')      
+            if 'abundance' in self.set_output:
+                self.write_output('abundance')      
             
         except Exception as e:
             print(str(e))
             rv = False
             rvmsg = str(e)
             print(f"Error has occurred in the {myNAME} process")   
+            
+        return rv, rvmsg
     
+    @instrument_stage('df_eval')
     def EvaluateProportion(self):
         """
         Evaluate based on proportion value
@@ -209,26 +417,23 @@ class VaginalPCRAnalysis:
         rvmsg = "Success"
         
         try:                 
-            self.df_eval = pd.DataFrame(index=self.df_abundance.index)
-
-            self.df_mean_abundance = self.df_db.mean(axis=1, numeric_only=True).to_frame()     
+            self.df_mean_abundance = pd.Series(self.dict_ref_stats['mean_abundance']).to_frame()     
             self.df_mean_abundance.columns =['value']
             
-            self.dict_mean_abundance = self.df_db.mean(axis=1, numeric_only=True).to_dict()
-            
+            self.dict_mean_abundance = dict(self.dict_ref_stats['mean_abundance'])
             
+            li_missing = [col for col in self.li_microbiome if col not in self.dict_mean_abundance]
+            if li_missing:
+                raise ValueError(f"The reference has no {', '.join(li_missing)} - analyze against a reference store of the panel {self.plan['name']}")
+            dict_acc = self.dict_ref_stats.get('accumulator')
+            if (dict_acc is not None) and ((dict_acc['beneficial'], dict_acc['harmful']) != (self.plan['li_beneficial'], self.plan['li_harmful'])):
+                raise ValueError(f"The beneficial/harmful totals of the reference are not those of the panel {self.plan['name']}")
             
-            for col in self.df_abundance:
-                # Define the conditions and corresponding values
-                conditions = [
-                    self.df_abundance[col] >= 0.5,
-                    (self.df_abundance[col] >= self.dict_mean_abundance[col]) & (self.df_abundance[col] < 0.5),
-                    self.df_abundance[col] < self.dict_mean_abundance[col]
-                ]
-
-                values = ['높음', '보통', '낮음']     
-
-                self.df_eval[col] = np.select(conditions, values)  
+            # 높음 / 보통 / 낮음 of the whole plate against the per-taxon means and bounds of the panel,
+            # as categorical codes - decoded to the labels when the csv is written
+            arr_code = evaluate_level(self.df_abundance[self.li_microbiome].to_numpy(dtype=float),
+                                      [self.dict_mean_abundance[col] for col in self.li_microbiome], self.plan['arr_high'])
+            self.df_eval = level_frame(arr_code, self.li_microbiome, self.df_abundance.index)
                                  
 
         except Exception as e:
@@ -240,6 +445,7 @@ class VaginalPCRAnalysis:
     
         return rv, rvmsg         
 
+    @instrument_stage('df_eval')
     def ClassifyType(self):
         """
         Classify a Type based on percentile rank value and Save the Evaluation data as an Csv file
@@ -255,32 +461,11 @@ class VaginalPCRAnalysis:
         rvmsg = "Success"
         
         try:  
-            dict_abundance = self.df_abundance.to_dict('records')
-            dict_type = {'L_crispatus': '항균든든', 'L_gasseri': '항균유지', 'L_iners': '면역주의', 'L_jensenii': '항균특별',  
-                         'G_vaginalis': '면역저하', 'F_vaginae': '면역저하', 'BVAB-1': '면역저하'}
+            # Whole-plate classification with the compiled rule table - Type/SprayType as categorical columns
+            cat_type, cat_spray_type = classify_type(self.df_abundance[self.li_microbiome].to_numpy(dtype=float), self.plan['type_rule'])
             
-            self.df_eval['SprayType'] = 'C'
-            
-            for idx in range(len(self.li_new_sample_name)):                  
-                total_abundance = sum(dict_abundance[idx].values())
-                
-                sum_beneficial = sum(list(dict_abundance[idx].values())[0:4])
-                sum_harmful = sum(list(dict_abundance[idx].values())[4:])
-                
-                if total_abundance < 0.05:
-                    self.df_eval.loc[self.li_new_sample_name[idx], 'Type'] = '기타유형'
-                    self.df_eval.loc[self.li_new_sample_name[idx], 'SprayType'] = 'G'
-                    
-                elif sum_harmful > sum_beneficial:
-                    self.df_eval.loc[self.li_new_sample_name[idx], 'Type'] = '면역저하'
-                    self.df_eval.loc[self.li_new_sample_name[idx], 'SprayType'] = 'G'                    
-                    
-                else:   
-                    max_taxa = max(dict_abundance[idx],key=dict_abundance[idx].get)
-                    self.df_eval.loc[self.li_new_sample_name[idx], 'Type'] = dict_type[max_taxa]
-                    
-                    if dict_type[max_taxa] == '면역저하':
-                        self.df_eval.loc[self.li_new_sample_name[idx], 'SprayType'] = 'G'                    
+            self.df_eval['SprayType'] = cat_spray_type
+            self.df_eval['Type'] = cat_type
                     
         except Exception as e:
             print(str(e))
@@ -291,6 +476,7 @@ class VaginalPCRAnalysis:
     
         return rv, rvmsg         
     
+    @instrument_stage('df_eval')
     def CalculateTotalAbundance(self):
         """
         Classify a Type based on percentile rank value and Save the Evaluation data as an Csv file
@@ -306,14 +492,8 @@ class VaginalPCRAnalysis:
         rvmsg = "Success"
         
         try:  
-            self.df_eval['beneficial_total[%]'] = (self.df_abundance['L_crispatus'] + self.df_abundance['L_gasseri'] + self.df_abundance['L_iners'] + self.df_abundance['L_jensenii'])*100
-              
-            self.df_eval['harmful_total[%]'] = (self.df_abundance['G_vaginalis'] + self.df_abundance['F_vaginae'] + self.df_abundance['BVAB-1'])*100 
+            self.df_eval['beneficial_total[%]'], self.df_eval['harmful_total[%]'] = calculate_group_total(self.df_abundance, self.plan['li_beneficial'], self.plan['li_harmful'])
             
-            self.df_db = self.df_db.transpose() 
-            self.df_db['beneficial_total[%]'] = (self.df_db['L_crispatus'] + self.df_db['L_gasseri'] + self.df_db['L_iners'] + self.df_db['L_jensenii'])*100
-              
-            self.df_db['harmful_total[%]'] = (self.df_db['G_vaginalis'] + self.df_db['F_vaginae'] + self.df_db['BVAB-1'])*100                         
         except Exception as e:
             print(str(e))
             rv = False
@@ -323,6 +503,7 @@ class VaginalPCRAnalysis:
     
         return rv, rvmsg     
 
+    @instrument_stage('df_eval')
     def EvaluateBeneficialHarmful(self):
         """
         Evaluate Beneficial & Harmful microbiome
@@ -338,21 +519,59 @@ class VaginalPCRAnalysis:
         rvmsg = "Success"
         
         try:                                                    
-            self.dict_mean_abundance = self.df_db.mean(axis=0, numeric_only=True).to_dict()          
+            self.dict_mean_abundance = dict(self.dict_ref_stats['mean_group_total'])          
             
-            for col in ['beneficial_total[%]', 'harmful_total[%]']:
-                # Define the conditions and corresponding values
-                conditions = [
-                    self.df_eval[col] >= 50,
-                    (self.df_eval[col] >= self.dict_mean_abundance[col]) & (self.df_eval[col] < 50),
-                    self.df_eval[col] < self.dict_mean_abundance[col]
-                ]
-
-                values = ['높음', '보통', '낮음']     
+            arr_code = evaluate_level(self.df_eval[LI_GROUP_TOTAL].to_numpy(dtype=float),
+                                      [self.dict_mean_abundance[col] for col in LI_GROUP_TOTAL], self.plan['arr_high_group'])
+            df_level = level_frame(arr_code, [f"{col[:-3]}_eval" for col in LI_GROUP_TOTAL], self.df_eval.index)
+            for col in df_level:
+                self.df_eval[col] = df_level[col]
+            
+        except Exception as e:
+            print(str(e))
+            rv = False
+            rvmsg = str(e)
+            print(f"Error has occurred in the {myNAME} process")    
+            sys.exit()
+    
+        return rv, rvmsg          
+    
+    @instrument_stage('df_eval')
+    def EvaluatePercentile(self):
+        """
+        Percentile rank of every taxon and of the beneficial/harmful totals within the reference cohort,
+        looked up in the sorted reference columns for the whole plate at once, and Save the Evaluation data as an Csv file.
 
-                self.df_eval[f"{col[:-3]}_eval"] = np.select(conditions, values)  
+        Returns:
+        A tuple (success, message), where success is a boolean indicating whether the operation was successful,
+        and message is a string containing a success or error message.
+        """          
+        myNAME = self.__class__.__name__+"::"+sys._getframe().f_code.co_name
+        WriteLog(myNAME, "In", type='INFO', fplog=self.__fplog)
+         
+        rv = True
+        rvmsg = "Success"
+        
+        try:                                                    
+            # Sorted columns memory-mapped from reference.mat (of every shard) - sorted here only if it is missing or stale
+            if self.percentile_index is not None:
+                percentile_index = self.percentile_index
+            elif self.path_shards is not None:
+                percentile_index = open_sharded_percentile_index(self.path_shards, self.dict_ref_stats)
+            elif self.refmatrix is not None:
+                percentile_index = PercentileIndex.from_matrix(self.refmatrix)
+            else:
+                percentile_index = load_percentile_index(self.path_db_store, self.path_db, self.dict_ref_stats['content_hash'], self.df_db)
+            self.percentile_index = percentile_index
+            
+            for col in self.li_microbiome:
+                self.df_eval[f"{col}_percentile"] = self.percentile_index.percentile(col, self.df_abundance[col])
+            for col in LI_GROUP_TOTAL:
+                self.df_eval[f"{col[:-3]}_percentile"] = self.percentile_index.percentile(col, self.df_eval[col])
+                
             # Save the output file - df_eval
-            self.df_eval.to_csv(self.path_eval_output, encoding="utf-8-sig", index_label='serial_number')                          
+            if 'eval' in self.set_output:
+                self.write_output('eval')                          
             
         except Exception as e:
             print(str(e))
@@ -363,6 +582,7 @@ class VaginalPCRAnalysis:
     
         return rv, rvmsg          
     
+    @instrument_stage('df_mean_abundance')
     def PlotDistribution(self): 
         """
         Plot the Distribution - Relative Abundance of Harmful & Beneficial microbiome  
@@ -377,14 +597,23 @@ class VaginalPCRAnalysis:
         rvmsg = "Success"
         
         try:          
-            # Histogram Plot - mrs 
-            save_histograms_to_file(self.df_db[['beneficial_total[%]', 'harmful_total[%]']], self.path_hist)
+            dict_histogram = self.dict_ref_stats['histogram']
+            
+            # Histogram Plot - mrs, rendered only when the reference statistics changed since the last png
+            if 'histogram' in self.set_output:
+                save_reference_histogram(self.dict_ref_stats, self.path_hist)
+            
+            # Reference means - also without the per-sample stages of EvaluateProportion
+            if self.df_mean_abundance is None:
+                self.df_mean_abundance = pd.Series(self.dict_ref_stats['mean_abundance']).to_frame()     
+                self.df_mean_abundance.columns =['value']
                 
-            self.df_mean_abundance.loc['beneficial_distribution'] = save_histograms_to_file(self.df_db[['beneficial_total[%]', 'harmful_total[%]']], self.path_hist)[0]
-            self.df_mean_abundance.loc['harmful_distribution'] = save_histograms_to_file(self.df_db[['beneficial_total[%]', 'harmful_total[%]']], self.path_hist)[1]
+            self.df_mean_abundance.loc['beneficial_distribution'] = format_distribution(dict_histogram['beneficial_total[%]'])
+            self.df_mean_abundance.loc['harmful_distribution'] = format_distribution(dict_histogram['harmful_total[%]'])
                   
             # Save the output file - Abundance of the samples
-            self.df_mean_abundance.to_csv(self.path_mean_abundance, encoding="utf-8-sig", index_label='taxa')       
+            if 'mean_abundance' in self.set_output:
+                self.write_output('mean_abundance')       
             
         except Exception as e:
             print(str(e))
@@ -398,18 +627,50 @@ class VaginalPCRAnalysis:
 ####################################
 # main
 ####################################
-if __name__ == '__main__':
+def main(li_arg=None):
+    """
+    Command line of the analysis - also the 'analyze' command of vaginal_pcr_cli.py.
+
+    Parameters:
+    li_arg (list): Arguments (default: sys.argv[1:]).
+    """
+    parser = argparse.ArgumentParser(prog='analyze', description="Analyze a PCR experiment result file against the reference")
+    parser.add_argument('path_exp', nargs='?', default="input/EGvaginal_experiment_result.xlsx", help="Experiment result file")
+    parser.add_argument('--outputs', default=','.join(LI_OUTPUT), help=f"Comma-separated outputs to write, of {','.join(LI_OUTPUT)} (default: all)")
+    parser.add_argument('--cache', default=None, help="Result cache directory - re-runs of a plate against the same reference are restored from it")
+    parser.add_argument('--cache-size', type=int, default=256, help="Size bound of the result cache in MB (default: 256)")
+    parser.add_argument('--format', default='csv', choices=LI_FORMAT, help="Format of the table outputs (default: csv)")
+    parser.add_argument('--codec', default='none', choices=LI_CODEC, help="Compression of the table outputs (default: none)")
+    parser.add_argument('--run-dir', action='store_true', help="Write into a new directory output/run_<time> instead of output/")
+    parser.add_argument('--outdir', default=None, help="Output directory (default: output/)")
+    parser.add_argument('--store', default=None, help="Reference store directory (default: input/EGvaginal_db)")
+    parser.add_argument('--shards', default=None, help="Shard configuration of a pooled multi-site reference (json)")
+    parser.add_argument('--panel', default=None, help="Target panel definition (json, see vaginal_pcr_panel.py; default: the EGvaginal panel)")
+    args = parser.parse_args(li_arg)
+    
+    cache = ResultCache(args.cache, max_bytes=args.cache_size << 20) if args.cache is not None else None
+    curdir = os.path.dirname(os.path.abspath(__file__))
+    outdir = args.outdir
+    if args.run_dir:
+        outdir = make_run_dir(outdir if outdir is not None else f"{curdir}/output")
+    elif outdir is not None:
+        os.makedirs(outdir, exist_ok=True)
+    path_db_store = os.path.abspath(args.store) if args.store is not None else None
     
-    path_exp = "input/EGvaginal_experiment_result.xlsx"
+    vaginalpcranalysis = VaginalPCRAnalysis(args.path_exp, outdir=outdir, profiler=profiler_from_env(), path_db_store=path_db_store,
+                                            path_shards=args.shards, cache=cache, output_format=args.format, codec=args.codec,
+                                            plan=load_plan(args.panel))
+    rv, rvmsg = vaginalpcranalysis.Run([output.strip() for output in args.outputs.split(',') if output.strip()])
     
-    vaginalpcranalysis = VaginalPCRAnalysis(path_exp)
-    vaginalpcranalysis.ReadDB()      
-    vaginalpcranalysis.CalculateProportion()   
-    vaginalpcranalysis.EvaluateProportion()     
-    vaginalpcranalysis.ClassifyType() 
-    vaginalpcranalysis.CalculateTotalAbundance()     
-    vaginalpcranalysis.EvaluateBeneficialHarmful() 
-    vaginalpcranalysis.PlotDistribution()    
+    if vaginalpcranalysis.profiler is not None:
+        vaginalpcranalysis.profiler.write_prometheus()
 
+    if not rv:
+        print(rvmsg)
+        sys.exit(1)
     
     print('Analysis Complete')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,283 @@
+##<Usage: python vaginal_pcr_batch.py {dir|glob} [{dir|glob} ...] [--outdir DIR] [--workers N] [--profile] [--shards FILE] [--cache DIR] [--format csv|parquet|jsonl] [--codec none|gzip|zstd] [--panel FILE] [--store DIR]>
+### ex) python vaginal_pcr_batch.py "/home/kbkim/vaginal_pcr/input/plates/" --workers 8
+
+import os, sys, glob, time, argparse
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from vaginal_pcr_analysis import VaginalPCRAnalysis, WriteLog, save_reference_histogram
+from vaginal_pcr_stats import load_percentile_index, load_reference_stats, open_pinned_matrix, pin_reference_matrix
+from vaginal_pcr_shards import open_pooled_reference, open_sharded_percentile_index
+from vaginal_pcr_profile import StageProfiler
+from vaginal_pcr_cache import ResultCache
+from vaginal_pcr_output import LI_CODEC, LI_FORMAT, make_run_dir, open_sink, output_path
+from vaginal_pcr_panel import load_plan
+from vaginal_pcr_reader import LI_EXPORT_EXT
+
+#-------------------------------------------------------
+# Batch analysis of many plate exports
+#-------------------------------------------------------
+# The reference statistics are loaded once in the parent and handed to every worker process,
+# so a worker only parses its plate and runs the per-plate stages. The parent pins the published
+# matrix of the same version (a hard link, see pin_reference_matrix) and every worker opens its
+# percentile index once per version, so percentiles and statistics always come from one version. Each plate writes into its own
+# sub-directory of the batch output directory; the reference histogram is rendered once for the batch.
+# The merged eval table is streamed plate by plate, in plate order, into one output sink, so the parent
+# holds only the plates that finished ahead of an earlier, still running one.
+
+# Reference statistics of the worker processes - set by init_worker
+dict_worker_ref_stats = None
+
+# Percentile index of the worker process, kept open across plates - {content_hash: index} of the last version used
+dict_worker_percentile_index = {}
+
+
+def init_worker(dict_ref_stats):
+    global dict_worker_ref_stats
+    dict_worker_ref_stats = dict_ref_stats
+
+
+def worker_percentile_index(dict_ref_stats, path_db_store=None, path_db=None, path_shards=None, path_matrix=None):
+    """
+    Percentile index of the version of dict_ref_stats, opened once per worker process: from the pinned matrix if
+    given, otherwise from the store or the shards, which must still hold that version (ReferenceVersionError if not).
+    """
+    content_hash = dict_ref_stats['content_hash']
+    if content_hash not in dict_worker_percentile_index:
+        if path_shards is not None:
+            percentile_index = open_sharded_percentile_index(path_shards, dict_ref_stats)
+        elif path_matrix is not None:
+            percentile_index = open_pinned_matrix(path_matrix, content_hash)
+        else:
+            percentile_index = load_percentile_index(path_db_store, path_db, content_hash)
+
+        # Only the current version is kept
+        dict_worker_percentile_index.clear()
+        dict_worker_percentile_index[content_hash] = percentile_index
+
+    return dict_worker_percentile_index[content_hash]
+
+
+def collect_plates(li_pattern):
+    """
+    Expand directories and glob patterns into the list of experiment exports, in sorted order. A directory
+    contributes every file read_experiment reads (.xlsx, .xls, .csv, .txt, .tsv).
+    """
+    li_path = []
+    for pattern in li_pattern:
+        if os.path.isdir(pattern):
+            li_path.extend(path for path in glob.glob(os.path.join(pattern, '*'))
+                           if os.path.isfile(path) and (os.path.splitext(path)[1].lower() in LI_EXPORT_EXT))
+        else:
+            li_path.extend(glob.glob(pattern))
+
+    # Skip Excel lock files and duplicates from overlapping patterns
+    li_path = [path for path in li_path if not os.path.basename(path).startswith('~$')]
+
+    return sorted(dict.fromkeys(os.path.abspath(path) for path in li_path))
+
+
+def assign_plate_names(li_path):
+    """
+    One output directory name per plate - the file stem, suffixed when two plates share a stem.
+    """
+    dict_count = {}
+    li_plate = []
+    for path in li_path:
+        stem = os.path.splitext(os.path.basename(path))[0]
+        dict_count[stem] = dict_count.get(stem, 0) + 1
+        li_plate.append(stem if dict_count[stem] == 1 else f"{stem}_{dict_count[stem]}")
+
+    return li_plate
+
+
+def analyze_plate(path_exp, plate, outdir, path_hist, dict_ref_stats=None, path_profile=None, path_shards=None, path_cache=None,
+                  output_format='csv', codec='none', plan=None, path_db_store=None, path_matrix=None):
+    """
+    Run the VaginalPCRAnalysis pipeline for one plate in a worker process.
+
+    Parameters:
+    dict_ref_stats (dict): Reference statistics; those of init_worker if None.
+    path_profile (str): JSON lines file of the stage records; stages are not measured if None.
+    path_shards (str): Shard configuration, if dict_ref_stats are the pooled statistics of a sharded reference.
+    path_cache (str): Result cache directory; plates already analyzed against the same reference are restored from it.
+    output_format (str), codec (str): Format and compression of the table outputs of the plate.
+    plan (dict): Compiled target panel (default: the default panel).
+    path_db_store (str): Reference store the statistics belong to (default: input/EGvaginal_db).
+    path_matrix (str): Matrix of the same version pinned by the parent (pin_reference_matrix), for the percentile ranks.
+
+    Returns:
+    Dictionary with the plate summary (timing, sample count, status) and its eval frame.
+    """
+    start = time.perf_counter()
+    outdir_plate = f"{outdir}/{plate}"
+    os.makedirs(outdir_plate, exist_ok=True)
+
+    dict_result = {'plate': plate, 'path_exp': path_exp, 'n_sample': 0, 'rv': True, 'rvmsg': "Success", 'df_eval': None, 'li_stage_record': []}
+    profiler = StageProfiler(path_profile) if path_profile is not None else None
+    cache = ResultCache(path_cache) if path_cache is not None else None
+
+    try:
+        with open(f"{outdir_plate}/log.txt", 'w') as fplog:
+            if dict_ref_stats is None:
+                dict_ref_stats = dict_worker_ref_stats
+            vaginalpcranalysis = VaginalPCRAnalysis(path_exp, outdir=outdir_plate, fplog=fplog, dict_ref_stats=dict_ref_stats, profiler=profiler, path_shards=path_shards, cache=cache,
+                                                    output_format=output_format, codec=codec, plan=plan, path_db_store=path_db_store)
+
+            # Shared reference histogram - already rendered by the parent, so PlotDistribution skips it
+            vaginalpcranalysis.path_hist = path_hist
+            # Percentile index of the version of the statistics, kept open by the worker
+            vaginalpcranalysis.percentile_index = worker_percentile_index(dict_ref_stats, vaginalpcranalysis.path_db_store, vaginalpcranalysis.path_db,
+                                                                          path_shards, path_matrix)
+
+            rv, rvmsg = vaginalpcranalysis.Run()
+            if not rv:
+                raise RuntimeError(rvmsg)
+
+        dict_result['n_sample'] = len(vaginalpcranalysis.df_eval)
+        dict_result['df_eval'] = vaginalpcranalysis.df_eval
+
+    # Stages call sys.exit() on errors - keep the worker alive and report the plate as failed
+    except (Exception, SystemExit) as e:
+        dict_result['rv'] = False
+        dict_result['rvmsg'] = str(e)
+
+    dict_result['seconds'] = time.perf_counter() - start
+    if profiler is not None:
+        dict_result['li_stage_record'] = profiler.li_record
+
+    return dict_result
+
+
+def run_batch(li_path, outdir, max_workers=None, profile=False, fplog=None, path_shards=None, path_cache=None,
+              output_format='csv', codec='none', plan=None, path_db_store=None):
+    """
+    Analyze many plate exports with a process pool.
+
+    Parameters:
+    li_path (list): Paths of the experiment workbooks.
+    outdir (str): Batch output directory; every plate gets a sub-directory.
+    max_workers (int): Number of worker processes (default: CPU count).
+    profile (bool): Record every stage of every plate into EGvaginal_batch_stages.jsonl / .prom.
+    path_shards (str): Shard configuration - analyze against the pooled multi-site reference.
+    path_cache (str): Result cache directory shared by the workers.
+    output_format (str), codec (str): Format and compression of the eval tables - 'csv', 'parquet' or 'jsonl'; 'none', 'gzip' or 'zstd'.
+    plan (dict): Compiled target panel of the plates, compiled once for the batch (default: the default panel).
+    path_db_store (str): Reference store to analyze against (default: input/EGvaginal_db); its legacy csv is <store>_abundance.csv.
+
+    Returns:
+    A tuple (path_summary, df_timing) of the merged eval table file and the per-plate timing report.
+    """
+    myNAME = "run_batch"
+    start = time.perf_counter()
+    os.makedirs(outdir, exist_ok=True)
+
+    path_matrix = None
+    if path_shards is not None:
+        dict_ref_stats, _ = open_pooled_reference(path_shards, max_workers=max_workers)
+    else:
+        curdir = os.path.dirname(os.path.abspath(__file__))
+        path_db = f"{curdir}/input/EGvaginal_db_abundance.csv" if path_db_store is None else f"{path_db_store}_abundance.csv"
+        path_db_store = path_db_store if path_db_store is not None else f"{curdir}/input/EGvaginal_db"
+        dict_ref_stats, _ = load_reference_stats(path_db_store, path_db)
+        # The matrix of the same version for the workers - an update during the batch does not change it
+        path_matrix = pin_reference_matrix(path_db_store, dict_ref_stats['content_hash'], f"{outdir}/.EGvaginal_reference.mat")
+
+    # Reference histogram - rendered once for the whole batch
+    path_hist = f"{outdir}/EGvaginal_abundance_hist.png"
+    save_reference_histogram(dict_ref_stats, path_hist)
+
+    li_plate = assign_plate_names(li_path)
+    dict_plate_idx = {plate: idx for idx, plate in enumerate(li_plate)}
+    li_result = []
+    path_profile = f"{outdir}/EGvaginal_batch_stages.jsonl" if profile else None
+
+    # Merged summary of all plates - plates that finish early wait in dict_pending for the ones before them
+    path_summary = output_path(f"{outdir}/EGvaginal_batch_eval", output_format, codec)
+    dict_pending = {}
+    idx_next = 0
+
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=init_worker, initargs=(dict_ref_stats,)) as executor, \
+            open_sink(path_summary, output_format, codec) as sink:
+        li_future = [executor.submit(analyze_plate, path_exp, plate, outdir, path_hist, None, path_profile, path_shards, path_cache, output_format, codec, plan,
+                                     path_db_store, path_matrix)
+                     for path_exp, plate in zip(li_path, li_plate)]
+
+        for future in as_completed(li_future):
+            dict_result = future.result()
+            WriteLog(myNAME, f"[{len(li_result) + len(dict_pending) + 1}/{len(li_path)}] {dict_result['plate']} - {dict_result['rvmsg']} ({dict_result['seconds']:.2f}s)", type='INFO', fplog=fplog)
+
+            dict_pending[dict_plate_idx[dict_result['plate']]] = dict_result
+            while idx_next in dict_pending:
+                dict_result = dict_pending.pop(idx_next)
+                df_eval = dict_result.pop('df_eval')
+                if df_eval is not None:
+                    df_eval = df_eval.assign(plate=dict_result['plate'])
+                    sink.write(df_eval[['plate'] + [col for col in df_eval.columns if col != 'plate']], index_label='serial_number')
+                li_result.append(dict_result)
+                idx_next += 1
+
+        if sink.n_row == 0:
+            sink.write(pd.DataFrame(columns=['plate']), index_label='serial_number')
+
+    if path_matrix is not None:
+        os.remove(path_matrix)
+
+    elapsed = time.perf_counter() - start
+
+    # Per-plate timing / throughput report
+    df_timing = pd.DataFrame([{key: dict_result[key] for key in ['plate', 'path_exp', 'n_sample', 'seconds', 'rv', 'rvmsg']} for dict_result in li_result])
+    df_timing['samples_per_second'] = df_timing['n_sample'] / df_timing['seconds']
+    df_timing.to_csv(f"{outdir}/EGvaginal_batch_timing.csv", encoding="utf-8-sig", index=False)
+
+    if profile:
+        StageProfiler().write_prometheus(f"{outdir}/EGvaginal_batch_stages.prom", [record for dict_result in li_result for record in dict_result['li_stage_record']])
+
+    n_sample = int(df_timing['n_sample'].sum())
+    WriteLog(myNAME, f"{len(li_path)} plates, {n_sample} samples in {elapsed:.2f}s - {len(li_path)/elapsed:.2f} plates/s, {n_sample/elapsed:.1f} samples/s", type='INFO', fplog=fplog)
+
+    return path_summary, df_timing
+
+
+####################################
+# main
+####################################
+def main(li_arg=None):
+    """
+    Command line of the batch analysis - also the 'batch' command of vaginal_pcr_cli.py.
+
+    Parameters:
+    li_arg (list): Arguments (default: sys.argv[1:]).
+    """
+    parser = argparse.ArgumentParser(prog='batch', description="Analyze a batch of PCR experiment result files")
+    parser.add_argument('patterns', nargs='+', help="Directories or glob patterns of experiment result files (.xlsx, .xls, .csv, .txt, .tsv)")
+    parser.add_argument('--outdir', default=None, help="Batch output directory (default: output/batch_<timestamp>)")
+    parser.add_argument('--workers', type=int, default=None, help="Number of worker processes (default: CPU count)")
+    parser.add_argument('--profile', action='store_true', help="Record timing and memory of every stage of every plate")
+    parser.add_argument('--store', default=None, help="Reference store to analyze against (default: input/EGvaginal_db; --shards is used instead if given)")
+    parser.add_argument('--shards', default=None, help="Shard configuration of a pooled multi-site reference (json)")
+    parser.add_argument('--cache', default=None, help="Result cache directory - plates already analyzed against the same reference are restored")
+    parser.add_argument('--format', default='csv', choices=LI_FORMAT, help="Format of the eval tables (default: csv)")
+    parser.add_argument('--codec', default='none', choices=LI_CODEC, help="Compression of the eval tables (default: none)")
+    parser.add_argument('--panel', default=None, help="Target panel definition (json, see vaginal_pcr_panel.py; default: the EGvaginal panel)")
+    args = parser.parse_args(li_arg)
+
+    li_path = collect_plates(args.patterns)
+    if not li_path:
+        print("No experiment result files found")
+        sys.exit(1)
+
+    outdir = args.outdir
+    if outdir is None:
+        curdir = os.path.dirname(os.path.abspath(__file__))
+        outdir = make_run_dir(f"{curdir}/output", prefix='batch')
+
+    run_batch(li_path, outdir, max_workers=args.workers, profile=args.profile, path_shards=args.shards, path_cache=args.cache,
+              output_format=args.format, codec=args.codec, plan=load_plan(args.panel),
+              path_db_store=os.path.abspath(args.store) if args.store is not None else None)
+
+    print('Batch Analysis Complete')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,438 @@
+##<Usage: python vaginal_pcr_benchmark.py [--reference-sizes 100,10000,1000000] [--plate-sizes 12,96,1000] [--repeat N] [--format txt|xlsx]>
+###        python vaginal_pcr_benchmark.py --compare output/benchmark/old.json output/benchmark/new.json
+### ex) python vaginal_pcr_benchmark.py --reference-sizes 100,1000000 --plate-sizes 96 --repeat 5
+
+import os, sys, json, time, shutil, resource, platform, argparse, tempfile, datetime, subprocess, contextlib
+import multiprocessing
+import numpy as np
+import pandas as pd
+
+from vaginal_pcr_engine import LI_MICROBIOME, UNIVERSAL
+from vaginal_pcr_profile import StageProfiler, peak_rss_mb
+from vaginal_pcr_store import ReferenceStore, write_reference_matrix
+from vaginal_pcr_stats import compute_reference_stats, write_stats_snapshot
+
+#-------------------------------------------------------
+# Benchmark suite
+#-------------------------------------------------------
+# Synthetic QuantStudio exports and reference stores of any size are generated into a scratch
+# directory, then VaginalPCRAnalysis and VaginalPCRUpdateRef are run on them end to end with a
+# StageProfiler. Every case runs in a fresh process, so its peak RSS is its own. Results are written
+# as one JSON file per run (tagged with the git commit) and two of them can be compared.
+#
+# Cases per (reference size, plate size):
+#   analysis_cold   stats.json missing - the reference statistics are recomputed from reference.mat
+#   analysis_warm   stats.json up to date - the usual analysis
+#   update          ingest of the plate into a copy of the reference, incremental statistics update
+#   startup_import  a fresh interpreter importing vaginal_pcr_analysis - the fixed start-up cost of every run
+#   startup_analyze a fresh interpreter running `vaginal_pcr_cli.py analyze --outputs eval,abundance` end to end
+
+BENCHMARK_VERSION = 1
+LI_CASE = ['analysis_cold', 'analysis_warm', 'update', 'startup_import', 'startup_analyze']
+LI_STARTUP_CASE = ['startup_import', 'startup_analyze']
+
+# Result table header of a QuantStudio export
+LI_EXPORT_COLUMN = ['Well', 'Sample Name', 'Target Name', 'Task', 'Reporter', 'Quencher', 'RQ', 'RQ Min', 'RQ Max', 'CT',
+                    'Ct Mean', 'Ct SD', 'Delta Ct', 'Delta Ct Mean', 'Delta Ct SD', 'Delta Ct SE', 'Delta Delta Ct',
+                    'Automatic Ct Threshold', 'Ct Threshold', 'Automatic Baseline', 'Baseline Start', 'Baseline End',
+                    'MTP', 'CQCONF', 'EXPFAIL', 'OFFSCALE', 'Tm1', 'Tm2', 'Tm3']
+
+
+#-------------------------------------------------------
+# Synthetic data
+#-------------------------------------------------------
+def generate_delta_ct(rng, n_sample, n_taxa):
+    """
+    Ct of every taxon relative to Universal: one dominant taxon per sample close to Universal, the others far below it.
+    """
+    arr_delta = rng.uniform(4, 16, size=(n_sample, n_taxa))
+    arr_dominant = rng.integers(0, n_taxa, size=n_sample)
+    arr_delta[np.arange(n_sample), arr_dominant] = rng.uniform(0, 3, size=n_sample)
+
+    return arr_delta
+
+
+def generate_plate(path_exp, n_sample, undetermined_rate=0.2, tm1_mean=82.0, tm1_sd=1.5, seed=0):
+    """
+    Write a synthetic QuantStudio export with 8 wells (7 taxa + Universal) per sample.
+
+    Parameters:
+    path_exp (str): Path of the export; .xlsx is written with openpyxl, anything else as a tab-delimited text export.
+    n_sample (int): Number of samples on the plate.
+    undetermined_rate (float): Fraction of taxon wells reported as Undetermined.
+    tm1_mean (float), tm1_sd (float): Normal distribution of Tm1; wells at or below TM1_CUTOFF count as not detected.
+    seed (int): Seed of the random generator.
+    """
+    rng = np.random.default_rng(seed)
+    li_target = LI_MICROBIOME + [UNIVERSAL]
+
+    arr_ct_universal = rng.normal(18, 1.5, size=n_sample)
+    arr_ct = np.column_stack([arr_ct_universal[:, None] + generate_delta_ct(rng, n_sample, len(LI_MICROBIOME)), arr_ct_universal])
+    arr_undetermined = rng.random(size=arr_ct.shape) < undetermined_rate
+    arr_undetermined[:, -1] = False
+    arr_tm1 = rng.normal(tm1_mean, tm1_sd, size=arr_ct.shape)
+
+    li_row = []
+    for idx_sample in range(n_sample):
+        sample_name = f"BM{seed:03d}-{idx_sample:07d}"
+        for idx_target, target in enumerate(li_target):
+            well = idx_sample*len(li_target) + idx_target + 1
+            ct = 'Undetermined' if arr_undetermined[idx_sample, idx_target] else round(float(arr_ct[idx_sample, idx_target]), 3)
+            tm1 = round(float(arr_tm1[idx_sample, idx_target]), 3)
+            li_row.append([well, sample_name, target, 'UNKNOWN', 'SYBR', 'None', None, None, None, ct]
+                          + [None]*16 + [tm1, None, None])
+
+    li_meta = [['* Experiment Name', 'synthetic benchmark plate'], ['* Instrument Type', 'QuantStudio 5 System'],
+               ['* Number of samples', n_sample], ['* Seed', seed]]
+
+    if os.path.splitext(path_exp)[1].lower() == '.xlsx':
+        import openpyxl
+
+        wb = openpyxl.Workbook(write_only=True)
+        ws = wb.create_sheet('Results')
+        for row in li_meta + [[], [], LI_EXPORT_COLUMN] + li_row:
+            ws.append(row)
+        wb.save(path_exp)
+    else:
+        with open(path_exp, 'w', encoding='utf-8') as f:
+            for key, value in li_meta:
+                f.write(f"{key} = {value}\n")
+            f.write('\n[Results]\n')
+            f.write('\t'.join(LI_EXPORT_COLUMN) + '\n')
+            for row in li_row:
+                f.write('\t'.join('' if value is None else str(value) for value in row) + '\n')
+
+    return path_exp
+
+
+def generate_reference(path_store, n_sample, seed=0, n_segment=1, with_stats=True):
+    """
+    Create a synthetic reference store of n_sample samples with its published matrix and, optionally, its statistics snapshot.
+
+    Parameters:
+    path_store (str): Directory of the store to create (must not exist).
+    n_segment (int): Number of ingests the samples are spread over.
+    with_stats (bool): Also write stats.json, as the update script would.
+
+    Returns:
+    The manifest of the created store.
+    """
+    rng = np.random.default_rng(seed)
+    refstore = ReferenceStore(path_store)
+    manifest = refstore.create(LI_MICROBIOME)
+
+    arr_abundance = np.power(2.0, -generate_delta_ct(rng, n_sample, len(LI_MICROBIOME)))
+    arr_abundance[rng.random(size=arr_abundance.shape) < 0.2] = 0.0
+    li_sample_name = [f"REF{seed:03d}-{idx:07d}" for idx in range(n_sample)]
+
+    for arr_idx in np.array_split(np.arange(n_sample), n_segment):
+        df_segment = pd.DataFrame(arr_abundance[arr_idx], index=[li_sample_name[idx] for idx in arr_idx], columns=LI_MICROBIOME)
+        manifest = refstore.append(df_segment)
+
+    # Published matrix and statistics snapshot, as the update script leaves them
+    df_db = refstore.load(manifest)
+    write_reference_matrix(f"{path_store}/reference.mat", df_db, manifest)
+    if with_stats:
+        write_stats_snapshot(f"{path_store}/stats.json", compute_reference_stats(df_db, manifest))
+
+    return manifest
+
+
+#-------------------------------------------------------
+# Benchmark cases
+#-------------------------------------------------------
+def run_case(case, path_exp, path_store, workdir, use_tracemalloc=False):
+    """
+    Run one benchmark case end to end (in a fresh worker process).
+
+    Returns:
+    Dictionary with the end-to-end wall time, the peak RSS of the process and the stage records.
+    """
+    # Imported here - the generators do not need the pipelines
+    from vaginal_pcr_analysis import VaginalPCRAnalysis
+    from vaginal_pcr_update_reference import VaginalPCRUpdateRef
+
+    profiler = StageProfiler(use_tracemalloc=use_tracemalloc)
+    outdir = tempfile.mkdtemp(dir=workdir)
+    rss_start = peak_rss_mb()
+
+    try:
+        if case == 'update':
+            # The update writes into the store - work on a copy
+            path_case_store = f"{outdir}/store"
+            shutil.copytree(path_store, path_case_store)
+
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            start = time.perf_counter()
+
+            if case == 'update':
+                pipeline = VaginalPCRUpdateRef(path_exp, profiler=profiler, path_db_store=path_case_store)
+                li_stage = [pipeline.ReadDB, pipeline.CalculateProportion, pipeline.InsertDataDB, pipeline.UpdateStatistics, pipeline.PublishReference]
+            else:
+                pipeline = VaginalPCRAnalysis(path_exp, outdir=outdir, profiler=profiler, path_db_store=path_store)
+                li_stage = [pipeline.ReadDB, pipeline.CalculateProportion, pipeline.EvaluateProportion, pipeline.ClassifyType,
+                            pipeline.CalculateTotalAbundance, pipeline.EvaluateBeneficialHarmful, pipeline.EvaluatePercentile, pipeline.PlotDistribution]
+
+            for stage in li_stage:
+                rv, rvmsg = stage()
+                if not rv:
+                    raise RuntimeError(f"{stage.__name__}: {rvmsg}")
+
+            seconds = time.perf_counter() - start
+    finally:
+        shutil.rmtree(outdir, ignore_errors=True)
+
+    n_sample = len(pipeline.df_abundance)
+    li_stage_record = [{key: record[key] for key in record if key not in ['time', 'pid', 'plate']} for record in profiler.li_record]
+
+    return {'seconds': seconds, 'n_sample': n_sample, 'samples_per_second': n_sample / seconds,
+            'rss_start_mb': rss_start, 'rss_peak_mb': peak_rss_mb(), 'stages': li_stage_record}
+
+
+def run_startup_case(case, path_exp, path_store, workdir):
+    """
+    Run one start-up case as a new interpreter, from process start to exit.
+
+    Returns:
+    Dictionary with the wall time and peak RSS of the child process, like run_case.
+    """
+    curdir = os.path.dirname(os.path.abspath(__file__))
+    outdir = tempfile.mkdtemp(dir=workdir)
+
+    if case == 'startup_import':
+        li_command = [sys.executable, '-c', 'import vaginal_pcr_analysis']
+    else:
+        li_command = [sys.executable, f"{curdir}/vaginal_pcr_cli.py", 'analyze', path_exp, '--outputs', 'eval,abundance',
+                      '--store', path_store, '--outdir', outdir]
+
+    try:
+        start = time.perf_counter()
+        subprocess.run(li_command, cwd=curdir, stdout=subprocess.DEVNULL, check=True)
+        seconds = time.perf_counter() - start
+
+        n_sample = 0
+        if case == 'startup_analyze':
+            with open(f"{outdir}/EGvaginal_abundance.csv", encoding='utf-8-sig') as f:
+                n_sample = sum(1 for _ in f) - 1
+    finally:
+        shutil.rmtree(outdir, ignore_errors=True)
+
+    # Largest peak RSS of the finished children - the start-up runs are the only children of this process
+    rss_peak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+
+    return {'seconds': seconds, 'n_sample': n_sample, 'samples_per_second': n_sample / seconds,
+            'rss_start_mb': None, 'rss_peak_mb': rss_peak, 'stages': []}
+
+
+def git_commit():
+    curdir = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=curdir, capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=curdir, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+    return f"{commit}-dirty" if dirty else commit
+
+
+def run_benchmark(li_reference_size, li_plate_size, repeat=3, fmt='txt', li_case=LI_CASE, undetermined_rate=0.2,
+                  tm1_mean=82.0, tm1_sd=1.5, seed=0, use_tracemalloc=False, workdir=None, fplog=None):
+    """
+    Generate the synthetic data and run every case for every (reference size, plate size).
+
+    Parameters:
+    li_reference_size (list): Numbers of reference samples.
+    li_plate_size (list): Numbers of samples per plate.
+    repeat (int): Runs per case; each run is a fresh process.
+    fmt (str): Export format of the plates, 'txt' or 'xlsx'.
+
+    Returns:
+    The benchmark result dictionary.
+    """
+    myNAME = "run_benchmark"
+    # Imported here, like in run_case
+    from vaginal_pcr_analysis import WriteLog
+
+    dict_result = {
+        'benchmark_version': BENCHMARK_VERSION,
+        'time': datetime.datetime.now().isoformat(timespec='seconds'),
+        'commit': git_commit(),
+        'environment': {'python': platform.python_version(), 'numpy': np.__version__, 'pandas': pd.__version__,
+                        'platform': platform.platform(), 'cpu_count': os.cpu_count()},
+        'params': {'reference_sizes': li_reference_size, 'plate_sizes': li_plate_size, 'repeat': repeat, 'format': fmt,
+                   'cases': li_case, 'undetermined_rate': undetermined_rate, 'tm1_mean': tm1_mean, 'tm1_sd': tm1_sd,
+                   'seed': seed, 'tracemalloc': use_tracemalloc},
+        'generate': [],
+        'runs': [],
+    }
+
+    workdir = tempfile.mkdtemp(prefix='vaginal_pcr_benchmark_', dir=workdir)
+    # One process per run (maxtasksperchild=1) - peak RSS must not carry over from the previous case
+    pool = multiprocessing.get_context('spawn').Pool(1, maxtasksperchild=1)
+
+    try:
+        dict_path_exp = {}
+        for n_plate in li_plate_size:
+            start = time.perf_counter()
+            dict_path_exp[n_plate] = generate_plate(f"{workdir}/plate_{n_plate}.{fmt}", n_plate, undetermined_rate, tm1_mean, tm1_sd, seed)
+            dict_result['generate'].append({'kind': 'plate', 'n_sample': n_plate, 'seconds': time.perf_counter() - start,
+                                            'bytes': os.path.getsize(dict_path_exp[n_plate])})
+
+        for n_reference in li_reference_size:
+            path_store = f"{workdir}/reference_{n_reference}"
+            start = time.perf_counter()
+            generate_reference(path_store, n_reference, seed)
+            dict_result['generate'].append({'kind': 'reference', 'n_sample': n_reference, 'seconds': time.perf_counter() - start})
+            WriteLog(myNAME, f"Reference of {n_reference} samples generated", type='INFO', fplog=fplog)
+
+            for n_plate in li_plate_size:
+                for case in li_case:
+                    path_case_store = path_store
+                    if case == 'analysis_cold':
+                        # Same reference without its snapshot
+                        path_case_store = f"{workdir}/reference_{n_reference}_cold"
+                        if not os.path.exists(path_case_store):
+                            shutil.copytree(path_store, path_case_store)
+                            os.remove(f"{path_case_store}/stats.json")
+
+                    for idx_repeat in range(repeat):
+                        if case in LI_STARTUP_CASE:
+                            dict_run = run_startup_case(case, dict_path_exp[n_plate], path_case_store, workdir)
+                        else:
+                            dict_run = pool.apply(run_case, (case, dict_path_exp[n_plate], path_case_store, workdir, use_tracemalloc))
+                        dict_run.update({'case': case, 'n_reference': n_reference, 'n_plate': n_plate, 'repeat': idx_repeat})
+                        dict_result['runs'].append(dict_run)
+
+                    li_seconds = [dict_run['seconds'] for dict_run in dict_result['runs'][-repeat:]]
+                    WriteLog(myNAME, f"{case} reference={n_reference} plate={n_plate} - median {np.median(li_seconds):.3f}s", type='INFO', fplog=fplog)
+
+                shutil.rmtree(f"{workdir}/reference_{n_reference}_cold", ignore_errors=True)
+            shutil.rmtree(path_store, ignore_errors=True)
+    finally:
+        pool.close()
+        pool.join()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return dict_result
+
+
+#-------------------------------------------------------
+# Results
+#-------------------------------------------------------
+def summarize_runs(dict_result):
+    """
+    Median end-to-end time, throughput, peak RSS and per-stage wall time of every case.
+
+    Returns:
+    DataFrame indexed by (case, n_reference, n_plate).
+    """
+    li_row = []
+    for dict_run in dict_result['runs']:
+        row = {'case': dict_run['case'], 'n_reference': dict_run['n_reference'], 'n_plate': dict_run['n_plate'],
+               'seconds': dict_run['seconds'], 'samples_per_second': dict_run['samples_per_second'], 'rss_peak_mb': dict_run['rss_peak_mb']}
+        for record in dict_run['stages']:
+            row[f"stage:{record['stage']}"] = record['wall_seconds']
+        li_row.append(row)
+
+    if not li_row:
+        return pd.DataFrame()
+
+    return pd.DataFrame(li_row).groupby(['case', 'n_reference', 'n_plate'], sort=False).median()
+
+
+def compare_results(dict_old, dict_new, threshold=0.1):
+    """
+    Compare the medians of two benchmark results.
+
+    Parameters:
+    threshold (float): Relative slowdown (or peak RSS growth) reported as a regression.
+
+    Returns:
+    A tuple (df_compare, li_regression) of the side by side medians and the regressed (case, n_reference, n_plate, metric).
+    """
+    df_old = summarize_runs(dict_old)
+    df_new = summarize_runs(dict_new)
+    li_metric = ['seconds', 'rss_peak_mb'] + [col for col in df_new.columns if col.startswith('stage:') and col in df_old.columns]
+
+    df_compare = df_old[li_metric].join(df_new[li_metric], lsuffix='_old', rsuffix='_new', how='inner')
+    li_regression = []
+    for metric in li_metric:
+        df_compare[f"{metric}_ratio"] = df_compare[f"{metric}_new"] / df_compare[f"{metric}_old"]
+        # Stage timings below a millisecond are noise
+        arr_significant = df_compare[f"{metric}_old"] >= (0.001 if metric.startswith('stage:') else 0)
+        for key in df_compare.index[(df_compare[f"{metric}_ratio"] > 1 + threshold) & arr_significant]:
+            li_regression.append((*key, metric))
+
+    return df_compare, li_regression
+
+
+def write_result(dict_result, outdir):
+    os.makedirs(outdir, exist_ok=True)
+    stamp = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
+    path_result = f"{outdir}/benchmark_{stamp}_{dict_result['commit'] or 'nocommit'}.json"
+
+    with open(path_result, 'w', encoding='utf-8') as f:
+        json.dump(dict_result, f, ensure_ascii=False, indent=1)
+
+    return path_result
+
+
+def parse_sizes(text):
+    return [int(float(x)) for x in text.split(',') if x.strip()]
+
+
+####################################
+# main
+####################################
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Benchmark the PCR analysis and reference update on synthetic data")
+    parser.add_argument('--reference-sizes', default='100,10000,1000000', help="Comma separated reference sizes, e.g. 1e2,1e4,1e6")
+    parser.add_argument('--plate-sizes', default='12,96,1000', help="Comma separated numbers of samples per plate")
+    parser.add_argument('--repeat', type=int, default=3, help="Runs per case (default: 3)")
+    parser.add_argument('--format', default='txt', choices=['txt', 'xlsx'], help="Export format of the synthetic plates")
+    parser.add_argument('--cases', default=','.join(LI_CASE), help=f"Comma separated cases out of {','.join(LI_CASE)}")
+    parser.add_argument('--undetermined-rate', type=float, default=0.2)
+    parser.add_argument('--tm1-mean', type=float, default=82.0)
+    parser.add_argument('--tm1-sd', type=float, default=1.5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--tracemalloc', action='store_true', help="Also trace Python allocations per stage")
+    parser.add_argument('--outdir', default=None, help="Directory of the result JSON (default: output/benchmark)")
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), default=None, help="Compare two result files instead of running")
+    parser.add_argument('--threshold', type=float, default=0.1, help="Relative slowdown reported as a regression (default: 0.1)")
+    args = parser.parse_args()
+
+    if args.compare is not None:
+        li_dict_result = []
+        for path in args.compare:
+            with open(path, encoding='utf-8') as f:
+                li_dict_result.append(json.load(f))
+
+        df_compare, li_regression = compare_results(li_dict_result[0], li_dict_result[1], threshold=args.threshold)
+        with pd.option_context('display.width', 200, 'display.max_columns', None):
+            print(df_compare[[col for col in df_compare.columns if col.startswith(('seconds', 'rss_peak_mb'))]])
+        for case, n_reference, n_plate, metric in li_regression:
+            print(f"REGRESSION {case} reference={n_reference} plate={n_plate} {metric}: x{df_compare.loc[(case, n_reference, n_plate), f'{metric}_ratio']:.2f}")
+
+        sys.exit(1 if li_regression else 0)
+
+    li_case = [case for case in args.cases.split(',') if case]
+    li_unknown = [case for case in li_case if case not in LI_CASE]
+    if li_unknown:
+        print(f"Unknown benchmark cases: {', '.join(li_unknown)}")
+        sys.exit(1)
+
+    dict_result = run_benchmark(parse_sizes(args.reference_sizes), parse_sizes(args.plate_sizes), repeat=args.repeat, fmt=args.format,
+                                li_case=li_case, undetermined_rate=args.undetermined_rate, tm1_mean=args.tm1_mean, tm1_sd=args.tm1_sd,
+                                seed=args.seed, use_tracemalloc=args.tracemalloc)
+
+    outdir = args.outdir
+    if outdir is None:
+        curdir = os.path.dirname(os.path.abspath(__file__))
+        outdir = f"{curdir}/output/benchmark"
+
+    path_result = write_result(dict_result, outdir)
+    with pd.option_context('display.width', 200, 'display.max_columns', None):
+        print(summarize_runs(dict_result)[['seconds', 'samples_per_second', 'rss_peak_mb']])
+
+    print(f"Benchmark Complete - {path_result}")
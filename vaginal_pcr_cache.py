@@ -0,0 +1,205 @@
+##<Usage: python vaginal_pcr_cache.py {cache_dir} [--clear]>
+### ex) python vaginal_pcr_cache.py "/home/kbkim/vaginal_pcr/output/cache"
+
+import os, json, shutil, pickle, hashlib, argparse
+
+from vaginal_pcr_engine import LI_LEVEL, LI_SPRAY_G_TYPE, LI_SPRAY_TYPE, TYPE_HARMFUL, TYPE_LOW_TOTAL
+from vaginal_pcr_stats import HIST_BINS
+from vaginal_pcr_store import StoreLock, write_json_atomic
+
+#-------------------------------------------------------
+# Result cache
+#-------------------------------------------------------
+# Results of a plate are cached under the key (sha256 of the experiment file, content hash of the
+# reference, panel hash, rule version): a re-run of the same plate against the same reference and rules restores
+# the abundance, eval and mean-abundance frames instead of parsing and computing them again.
+#
+#   <cache_dir>/<key>/frames.pkl   the frames of one plate
+#   <cache_dir>/counters.json      hits, misses and evictions of all processes
+#   <cache_dir>/.lock              held while an entry is added or the counters change
+#
+# The entry directory mtime is its last use; entries are evicted least recently used first once the
+# cache exceeds its size bound. Entries are only ever read by this package - do not share a cache
+# directory with untrusted writers, as the frames are pickled.
+
+CACHE_FORMAT = 2
+DEFAULT_MAX_BYTES = 256 << 20
+
+
+def rule_version():
+    """
+    Hash of the rules besides the panel (see the panel hash of vaginal_pcr_panel) that the cached results
+    depend on: the level labels, the fixed types, the SprayType rule and the histogram bins.
+    """
+    dict_rule = {
+        'format': CACHE_FORMAT, 'li_level': LI_LEVEL, 'type_low_total': TYPE_LOW_TOTAL, 'type_harmful': TYPE_HARMFUL,
+        'li_spray_type': LI_SPRAY_TYPE, 'li_spray_g_type': LI_SPRAY_G_TYPE, 'hist_bins': HIST_BINS,
+    }
+
+    return hashlib.sha256(json.dumps(dict_rule, ensure_ascii=False, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def hash_experiment(path_exp):
+    h = hashlib.sha256()
+    with open(path_exp, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+
+    return h.hexdigest()
+
+
+class ResultCache:
+    def __init__(self, path_cache, max_bytes=DEFAULT_MAX_BYTES):
+        """
+        Initializes a ResultCache object.
+
+        Parameters:
+        path_cache (str): Cache directory, shared by concurrent processes.
+        max_bytes (int): Size bound of the cached entries.
+        """
+        self.path_cache = path_cache
+        self.max_bytes = max_bytes
+        self.rule_version = rule_version()
+
+        ## Hits and misses of this process
+        self.n_hit = 0
+        self.n_miss = 0
+
+    def key(self, path_exp, content_hash, panel_hash):
+        """
+        Cache key of a plate against a reference version and a panel, or None if the reference version is unknown.
+        """
+        if content_hash is None:
+            return None
+
+        h = hashlib.sha256(f"{hash_experiment(path_exp)}:{content_hash}:{panel_hash}:{self.rule_version}".encode('ascii'))
+
+        return h.hexdigest()
+
+    def lock(self):
+        return StoreLock(f"{self.path_cache}/.lock")
+
+    def get(self, key):
+        """
+        Frames of a cached entry, marked as the most recently used.
+
+        Returns:
+        Dictionary of the cached frames, or None on a miss.
+        """
+        dict_frame = None
+        if key is not None:
+            path_entry = f"{self.path_cache}/{key}"
+            try:
+                with open(f"{path_entry}/frames.pkl", 'rb') as f:
+                    dict_frame = pickle.load(f)
+                os.utime(path_entry)
+            # Evicted by another process in the meantime
+            except FileNotFoundError:
+                dict_frame = None
+
+        if dict_frame is not None:
+            self.n_hit += 1
+        else:
+            self.n_miss += 1
+        self.count('hits' if dict_frame is not None else 'misses')
+
+        return dict_frame
+
+    def put(self, key, dict_frame):
+        """
+        Add an entry and evict the least recently used entries beyond max_bytes.
+        """
+        if key is None:
+            return
+
+        os.makedirs(self.path_cache, exist_ok=True)
+        path_tmp = f"{self.path_cache}/.{key}.{os.getpid()}.tmp"
+        os.makedirs(path_tmp, exist_ok=True)
+        with open(f"{path_tmp}/frames.pkl", 'wb') as f:
+            pickle.dump(dict_frame, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+        with self.lock():
+            if os.path.exists(f"{self.path_cache}/{key}"):
+                shutil.rmtree(path_tmp, ignore_errors=True)
+            else:
+                os.rename(path_tmp, f"{self.path_cache}/{key}")
+            self.evict()
+
+    def entries(self):
+        """
+        List of (last use, bytes, key) of the cached entries, least recently used first.
+        """
+        li_entry = []
+        for entry in os.scandir(self.path_cache):
+            if entry.is_dir() and not entry.name.startswith('.'):
+                try:
+                    li_entry.append((entry.stat().st_mtime_ns, os.path.getsize(f"{entry.path}/frames.pkl"), entry.name))
+                except FileNotFoundError:
+                    continue
+
+        return sorted(li_entry)
+
+    def evict(self):
+        # Called under the lock
+        li_entry = self.entries()
+        total_bytes = sum(nbytes for _, nbytes, _ in li_entry)
+
+        n_evicted = 0
+        for _, nbytes, key in li_entry:
+            if total_bytes <= self.max_bytes:
+                break
+            shutil.rmtree(f"{self.path_cache}/{key}", ignore_errors=True)
+            total_bytes -= nbytes
+            n_evicted += 1
+
+        if n_evicted > 0:
+            self.count('evictions', n_evicted, locked=True)
+
+    def read_counters(self):
+        path_counters = f"{self.path_cache}/counters.json"
+        if not os.path.exists(path_counters):
+            return {'hits': 0, 'misses': 0, 'evictions': 0}
+
+        with open(path_counters, encoding='utf-8') as f:
+            return json.load(f)
+
+    def count(self, counter, n=1, locked=False):
+        """
+        Add to a persistent counter of the cache directory.
+        """
+        os.makedirs(self.path_cache, exist_ok=True)
+        lock = None if locked else self.lock().acquire()
+        try:
+            dict_counter = self.read_counters()
+            dict_counter[counter] = dict_counter.get(counter, 0) + n
+            write_json_atomic(f"{self.path_cache}/counters.json", dict_counter)
+        finally:
+            if lock is not None:
+                lock.release()
+
+    def clear(self):
+        with self.lock():
+            for _, _, key in self.entries():
+                shutil.rmtree(f"{self.path_cache}/{key}", ignore_errors=True)
+
+
+####################################
+# main
+####################################
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Show or clear the analysis result cache")
+    parser.add_argument('cache', help="Cache directory")
+    parser.add_argument('--clear', action='store_true', help="Remove every cached entry")
+    args = parser.parse_args()
+
+    resultcache = ResultCache(args.cache)
+    if args.clear:
+        resultcache.clear()
+
+    li_entry = resultcache.entries() if os.path.isdir(args.cache) else []
+    dict_counter = resultcache.read_counters()
+    n_lookup = dict_counter['hits'] + dict_counter['misses']
+    print(f"{len(li_entry)} entries, {sum(nbytes for _, nbytes, _ in li_entry) / (1 << 20):.1f} MB")
+    print(f"hits {dict_counter['hits']}, misses {dict_counter['misses']}, evictions {dict_counter['evictions']}"
+          + (f", hit rate {dict_counter['hits'] / n_lookup:.1%}" if n_lookup else ""))
@@ -0,0 +1,66 @@
+##<Usage: python vaginal_pcr_cli.py {analyze|update-ref|batch|rebuild-ref|drift} [options]>
+### ex) python vaginal_pcr_cli.py analyze "/home/kbkim/vaginal_pcr/input/EGvaginal_experiment_result.xlsx" --outputs eval
+###     python vaginal_pcr_cli.py update-ref "/home/kbkim/vaginal_pcr/input/EGvaginal_experiment_result.xlsx" --policy keep-first
+###     python vaginal_pcr_cli.py batch "/home/kbkim/vaginal_pcr/input/plates/" --workers 8
+###     python vaginal_pcr_cli.py rebuild-ref "/home/kbkim/vaginal_pcr/archive/" --workers 8
+###     python vaginal_pcr_cli.py drift --threshold 0.5
+###     python vaginal_pcr_cli.py analyze --help
+
+import sys, importlib
+
+#-------------------------------------------------------
+# Command line entry point
+#-------------------------------------------------------
+# Only the module of the chosen command is imported, and only when the command runs, so
+# `--help` and the dispatch itself load nothing beyond the standard library. Each command is
+# the main() of its script, which keeps working on its own (python vaginal_pcr_analysis.py ...).
+
+DICT_COMMAND = {
+    'analyze': ('vaginal_pcr_analysis', "Analyze a plate against the reference"),
+    'update-ref': ('vaginal_pcr_update_reference', "Ingest plates into the reference store"),
+    'batch': ('vaginal_pcr_batch', "Analyze many plates in a process pool"),
+    'rebuild-ref': ('vaginal_pcr_rebuild', "Rebuild the reference store from an archive of plates"),
+    'drift': ('vaginal_pcr_drift', "Drift of the reference between versions and divergent plates"),
+}
+
+
+def print_usage():
+    print("Usage: python vaginal_pcr_cli.py <command> [options]")
+    print()
+    print("Commands:")
+    for command, (_, description) in DICT_COMMAND.items():
+        print(f"  {command:<14}{description}")
+    print()
+    print("Run 'python vaginal_pcr_cli.py <command> --help' for the options of a command.")
+
+
+def main(li_arg=None):
+    """
+    Dispatch to the main() of the command's module.
+
+    Parameters:
+    li_arg (list): Arguments (default: sys.argv[1:]).
+    """
+    li_arg = list(sys.argv[1:] if li_arg is None else li_arg)
+
+    if (not li_arg) or (li_arg[0] in ['-h', '--help']):
+        print_usage()
+        return 0 if li_arg else 1
+
+    command = li_arg[0]
+    if command not in DICT_COMMAND:
+        print(f"Unknown command {command}")
+        print_usage()
+        return 1
+
+    module = importlib.import_module(DICT_COMMAND[command][0])
+    module.main(li_arg[1:])
+
+    return 0
+
+
+####################################
+# main
+####################################
+if __name__ == '__main__':
+    sys.exit(main())
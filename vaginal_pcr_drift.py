@@ -0,0 +1,410 @@
+##<Usage: python vaginal_pcr_drift.py [--store DIR] [--from VERSION] [--to VERSION] [--threshold SMD] [--all]>
+### ex) python vaginal_pcr_drift.py                              (drift between the first and the last recorded version, plates flagged above 1.0 SD)
+###     python vaginal_pcr_drift.py --from 12 --to 15 --threshold 0.5
+
+import os, sys, json, argparse, datetime
+import numpy as np
+import pandas as pd
+
+from vaginal_pcr_engine import LI_GROUP_TOTAL, calculate_group_total
+from vaginal_pcr_store import fsync_dir, store_groups
+from vaginal_pcr_stats import HIST_BINS
+
+#-------------------------------------------------------
+# Drift of the reference over its updates
+#-------------------------------------------------------
+# Every update of a store appends one record to <store>/drift.jsonl, under the store lock:
+#
+#   {"format": 1, "kind": "update", "version": 14, "content_hash": ..., "prev_content_hash": ..., "time": ...,
+#    "plates": [{"plate": "plate_0412", "stats": {...}}, ...],    every run computed from each plate
+#    "added": {...}, "removed": {...},                            rows inserted into / taken out of the reference
+#    "cumulative": {...}}                                         the whole reference of this version
+#
+# A stats block holds, per taxon and per beneficial/harmful total, the count, mean and sum of squared deviations
+# (M2) of Welford's algorithm and the counts of the 0-20-40-60-80-100 bins (taxa in percent). Blocks are combined
+# with the parallel form of the update (Chan et al.), and taken apart again for replaced samples, so the cumulative
+# block of a version is the one of the previous record updated with the plates alone - the reference is not rescanned.
+# A series that is missing or out of step with the store (updates before drift monitoring) starts again from a
+# 'baseline' record of one scan of the reference; a rebuild appends the baseline of the rebuilt reference.
+#
+# Records are only appended. The drift between two versions compares their cumulative blocks; a plate is flagged
+# when the mean of one of its columns is further than --threshold reference standard deviations from the mean of
+# the reference it was ingested into (the cumulative block of the record before it).
+
+DRIFT_FORMAT = 1
+DRIFT_THRESHOLD = 1.0
+
+# Smoothing of empty bins in the population stability index
+PSI_EPSILON = 1e-4
+
+
+class StreamingStats:
+    def __init__(self, li_column):
+        """
+        Initializes an empty StreamingStats object.
+
+        Parameters:
+        li_column (list): Columns - the taxa of the reference, then the beneficial/harmful totals.
+        """
+        self.li_column = list(li_column)
+        self.n_sample = 0
+        self.arr_mean = np.zeros(len(self.li_column))
+        self.arr_m2 = np.zeros(len(self.li_column))
+        self.arr_hist_count = np.zeros((len(self.li_column), len(HIST_BINS) - 1), dtype=np.int64)
+
+    @classmethod
+    def from_frame(cls, df_abundance, li_taxa, li_beneficial, li_harmful):
+        """
+        Statistics of the (sample x taxa) rows of df_abundance.
+        """
+        stats = cls(list(li_taxa) + LI_GROUP_TOTAL)
+        if len(df_abundance) == 0:
+            return stats
+
+        arr_value = np.column_stack([df_abundance[list(li_taxa)].to_numpy(dtype=float)] +
+                                    [sr_total.to_numpy() for sr_total in calculate_group_total(df_abundance, li_beneficial, li_harmful)])
+        arr_percent = arr_value.copy()
+        arr_percent[:, :len(li_taxa)] *= 100
+
+        stats.n_sample = len(arr_value)
+        stats.arr_mean = arr_value.mean(axis=0)
+        stats.arr_m2 = ((arr_value - stats.arr_mean)**2).sum(axis=0)
+
+        # Bins of every column at once - as np.histogram, the last bin holds 100 and values outside 0-100 fall in no bin
+        n_bin = len(HIST_BINS) - 1
+        arr_bin = np.searchsorted(HIST_BINS, arr_percent, side='right') - 1
+        arr_bin[arr_percent == HIST_BINS[-1]] = n_bin - 1
+        arr_valid = (arr_bin >= 0) & (arr_bin < n_bin)
+        arr_col = np.broadcast_to(np.arange(len(stats.li_column)), arr_bin.shape)
+        stats.arr_hist_count = np.bincount((arr_col*n_bin + arr_bin)[arr_valid], minlength=len(stats.li_column)*n_bin).reshape(-1, n_bin)
+
+        return stats
+
+    def combine(self, other, sign):
+        if other.li_column != self.li_column:
+            raise ValueError("Streaming statistics of different columns cannot be combined")
+        if other.n_sample == 0:
+            return self
+
+        n_sample = self.n_sample + sign*other.n_sample
+        if n_sample < 0:
+            raise ValueError("More samples removed than the statistics hold")
+
+        if n_sample == 0:
+            self.arr_mean = np.zeros(len(self.li_column))
+            self.arr_m2 = np.zeros(len(self.li_column))
+        elif sign > 0:
+            arr_delta = other.arr_mean - self.arr_mean
+            self.arr_m2 = self.arr_m2 + other.arr_m2 + arr_delta**2*self.n_sample*other.n_sample/n_sample
+            self.arr_mean = self.arr_mean + arr_delta*other.n_sample/n_sample
+        else:
+            # The combine step solved for the part that remains
+            arr_mean = (self.n_sample*self.arr_mean - other.n_sample*other.arr_mean)/n_sample
+            arr_delta = other.arr_mean - arr_mean
+            self.arr_m2 = np.maximum(self.arr_m2 - other.arr_m2 - arr_delta**2*n_sample*other.n_sample/self.n_sample, 0)
+            self.arr_mean = arr_mean
+
+        self.n_sample = n_sample
+        self.arr_hist_count = self.arr_hist_count + sign*other.arr_hist_count
+
+        return self
+
+    def merge(self, other):
+        """
+        Add the samples of another StreamingStats over the same columns.
+        """
+        return self.combine(other, 1)
+
+    def remove(self, other):
+        """
+        Take out samples that were merged before, e.g. the previous values of a re-run sample.
+        """
+        return self.combine(other, -1)
+
+    def variance(self):
+        # Sample variance - NaN below two samples
+        return self.arr_m2/(self.n_sample - 1) if self.n_sample > 1 else np.full(len(self.li_column), np.nan)
+
+    def std(self):
+        return np.sqrt(self.variance())
+
+    def to_dict(self):
+        return {'columns': self.li_column, 'n_sample': self.n_sample, 'mean': self.arr_mean.tolist(),
+                'm2': self.arr_m2.tolist(), 'hist_count': self.arr_hist_count.tolist()}
+
+    @classmethod
+    def from_dict(cls, dict_stats):
+        stats = cls(dict_stats['columns'])
+        stats.n_sample = dict_stats['n_sample']
+        stats.arr_mean = np.array(dict_stats['mean'], dtype=float)
+        stats.arr_m2 = np.array(dict_stats['m2'], dtype=float)
+        stats.arr_hist_count = np.array(dict_stats['hist_count'], dtype=np.int64).reshape(len(stats.li_column), len(HIST_BINS) - 1)
+
+        return stats
+
+
+class DriftSeries:
+    def __init__(self, path_store):
+        """
+        Initializes a DriftSeries object - the append-only drift records of a reference store.
+
+        Parameters:
+        path_store (str): Directory of the reference store.
+        """
+        self.path_store = path_store
+        self.path_series = f"{path_store}/drift.jsonl"
+
+    def read(self):
+        """
+        Records of the series in append order; a line left incomplete by a crash is skipped.
+        """
+        if not os.path.exists(self.path_series):
+            return []
+
+        li_record = []
+        with open(self.path_series, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    li_record.append(json.loads(line))
+                except json.JSONDecodeError:
+                    continue
+
+        return li_record
+
+    def last(self):
+        """
+        Last record of the series (None if it is empty) - read from the end of the file.
+        """
+        if not os.path.exists(self.path_series):
+            return None
+
+        with open(self.path_series, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            pos = f.tell()
+            block = b''
+            while pos > 0:
+                step = min(1 << 16, pos)
+                pos -= step
+                f.seek(pos)
+                block = f.read(step) + block
+
+                # The first line of the block is complete only at the start of the file
+                li_line = block.split(b'\n')
+                for line in reversed(li_line if pos == 0 else li_line[1:]):
+                    if line.strip():
+                        try:
+                            return json.loads(line)
+                        except json.JSONDecodeError:
+                            continue
+
+        return None
+
+    def append(self, dict_record):
+        """
+        Append one record as one fsynced line. Callers hold the store lock.
+        """
+        with open(self.path_series, 'a+b') as f:
+            # Close a line left incomplete by a crash, so it cannot swallow this record
+            line_end = b''
+            if f.tell() > 0:
+                f.seek(-1, os.SEEK_END)
+                line_end = b'' if f.read(1) == b'\n' else b'\n'
+            f.write(line_end + (json.dumps(dict_record, ensure_ascii=False) + '\n').encode('utf-8'))
+            f.flush()
+            os.fsync(f.fileno())
+        fsync_dir(self.path_store)
+
+
+def make_record(kind, manifest, cumulative, prev_content_hash=None, li_plate_stats=None, added=None, removed=None):
+    return {'format': DRIFT_FORMAT, 'kind': kind, 'version': manifest['version'], 'content_hash': manifest['content_hash'],
+            'prev_content_hash': prev_content_hash, 'time': datetime.datetime.now().isoformat(timespec='seconds'),
+            'plates': [{'plate': plate, 'stats': stats.to_dict()} for plate, stats in (li_plate_stats or [])],
+            'added': added.to_dict() if added is not None else None,
+            'removed': removed.to_dict() if removed is not None else None,
+            'cumulative': cumulative.to_dict()}
+
+
+def record_baseline(path_store, manifest, df_db):
+    """
+    Append the baseline record of the whole reference df_db of manifest, e.g. after a rebuild.
+    """
+    li_beneficial, li_harmful = store_groups(manifest)
+    cumulative = StreamingStats.from_frame(df_db, manifest['taxa'], li_beneficial, li_harmful)
+    DriftSeries(path_store).append(make_record('baseline', manifest, cumulative))
+
+    return cumulative
+
+
+def record_update(path_store, manifest, prev_manifest, li_plate_abundance, df_added, df_removed, load_reference):
+    """
+    Append the drift record of one update of the store, in O(ingested samples).
+
+    Parameters:
+    manifest (dict), prev_manifest (dict): Manifests of the store after and before the update.
+    li_plate_abundance (list): (plate, df_abundance) of every ingested plate - all its runs, before duplicates are resolved.
+    df_added (DataFrame): Rows inserted into the reference.
+    df_removed (DataFrame): Previous values of the replaced samples.
+    load_reference (callable): Loads the updated reference - only called when the series has to start again from a baseline.
+
+    Returns:
+    The record appended.
+    """
+    series = DriftSeries(path_store)
+    li_taxa = manifest['taxa']
+    li_beneficial, li_harmful = store_groups(manifest)
+
+    added = StreamingStats.from_frame(df_added, li_taxa, li_beneficial, li_harmful)
+    removed = StreamingStats.from_frame(df_removed, li_taxa, li_beneficial, li_harmful)
+
+    dict_last = series.last()
+    if (dict_last is not None) and (dict_last['content_hash'] == prev_manifest['content_hash']) and (dict_last['cumulative']['columns'] == added.li_column):
+        cumulative = StreamingStats.from_dict(dict_last['cumulative'])
+    else:
+        # Series missing or out of step - the baseline of the reference before the update, from one scan of the updated one
+        cumulative = StreamingStats.from_frame(load_reference(), li_taxa, li_beneficial, li_harmful).remove(added).merge(removed)
+        series.append(make_record('baseline', prev_manifest, cumulative))
+
+    cumulative.remove(removed).merge(added)
+    li_plate_stats = [(plate, StreamingStats.from_frame(df_abundance, li_taxa, li_beneficial, li_harmful)) for plate, df_abundance in li_plate_abundance]
+
+    dict_record = make_record('update', manifest, cumulative, prev_manifest['content_hash'], li_plate_stats, added, removed)
+    series.append(dict_record)
+
+    return dict_record
+
+
+#-------------------------------------------------------
+# Queries
+#-------------------------------------------------------
+def population_stability_index(arr_count_from, arr_count_to):
+    """
+    PSI of the bin counts of every column (rows), with empty bins smoothed by PSI_EPSILON.
+    """
+    arr_from = arr_count_from/np.maximum(arr_count_from.sum(axis=-1, keepdims=True), 1) + PSI_EPSILON
+    arr_to = arr_count_to/np.maximum(arr_count_to.sum(axis=-1, keepdims=True), 1) + PSI_EPSILON
+
+    return ((arr_to - arr_from)*np.log(arr_to/arr_from)).sum(axis=-1)
+
+
+def compare_stats(stats_from, stats_to):
+    """
+    Per-column drift from stats_from to stats_to: means, standard deviations, the standardized mean difference
+    (in standard deviations of stats_from) and the PSI of the bins.
+
+    Returns:
+    DataFrame indexed by column.
+    """
+    arr_std_from = stats_from.std()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        arr_smd = (stats_to.arr_mean - stats_from.arr_mean)/arr_std_from
+
+    return pd.DataFrame({'n_from': stats_from.n_sample, 'mean_from': stats_from.arr_mean, 'std_from': arr_std_from,
+                         'n_to': stats_to.n_sample, 'mean_to': stats_to.arr_mean, 'std_to': stats_to.std(),
+                         'smd': arr_smd, 'psi': population_stability_index(stats_from.arr_hist_count, stats_to.arr_hist_count)},
+                        index=pd.Index(stats_from.li_column, name='column'))
+
+
+def record_at(li_record, version):
+    """
+    Record of the reference at version - the last one appended at or before it (None if there is none).
+    """
+    dict_at = None
+    for dict_record in li_record:
+        if dict_record['version'] <= version:
+            dict_at = dict_record
+
+    return dict_at
+
+
+def version_drift(li_record, version_from=None, version_to=None):
+    """
+    Drift of the reference between two versions (default: the first and the last recorded one).
+
+    Returns:
+    A tuple (version_from, version_to, df_drift) - see compare_stats.
+    """
+    if not li_record:
+        raise ValueError("No drift records")
+
+    dict_from = li_record[0] if version_from is None else record_at(li_record, version_from)
+    dict_to = li_record[-1] if version_to is None else record_at(li_record, version_to)
+    if (dict_from is None) or (dict_to is None):
+        raise ValueError(f"No drift record at or before version {version_from if dict_from is None else version_to}")
+
+    df_drift = compare_stats(StreamingStats.from_dict(dict_from['cumulative']), StreamingStats.from_dict(dict_to['cumulative']))
+
+    return dict_from['version'], dict_to['version'], df_drift
+
+
+def flag_plates(li_record, threshold=DRIFT_THRESHOLD):
+    """
+    Compare every ingested plate with the reference it was ingested into (the cumulative statistics of the record before).
+
+    Returns:
+    DataFrame with one row per plate: version, time, plate, sample count, the column of the largest |smd|, that smd,
+    the largest PSI and whether |smd| exceeds threshold.
+    """
+    li_row = []
+    dict_prev = None
+    for dict_record in li_record:
+        if (dict_record['kind'] == 'update') and (dict_prev is not None) and (dict_prev['content_hash'] == dict_record['prev_content_hash']):
+            stats_ref = StreamingStats.from_dict(dict_prev['cumulative'])
+
+            for dict_plate in dict_record['plates']:
+                df_compare = compare_stats(stats_ref, StreamingStats.from_dict(dict_plate['stats']))
+                sr_abs_smd = df_compare['smd'].abs()
+                col = sr_abs_smd.idxmax() if sr_abs_smd.notna().any() else None
+
+                li_row.append({'version': dict_record['version'], 'time': dict_record['time'], 'plate': dict_plate['plate'],
+                               'n_sample': dict_plate['stats']['n_sample'], 'column': col,
+                               'smd': df_compare.loc[col, 'smd'] if col is not None else np.nan,
+                               'max_psi': df_compare['psi'].max(),
+                               'flagged': bool(col is not None and sr_abs_smd[col] > threshold)})
+        dict_prev = dict_record
+
+    return pd.DataFrame(li_row, columns=['version', 'time', 'plate', 'n_sample', 'column', 'smd', 'max_psi', 'flagged'])
+
+
+####################################
+# main
+####################################
+def main(li_arg=None):
+    """
+    Command line of the drift report - also the 'drift' command of vaginal_pcr_cli.py.
+
+    Parameters:
+    li_arg (list): Arguments (default: sys.argv[1:]).
+    """
+    parser = argparse.ArgumentParser(prog='drift', description="Drift of the reference between versions and plates that diverge from it")
+    parser.add_argument('--store', default=None, help="Reference store (default: input/EGvaginal_db)")
+    parser.add_argument('--from', dest='version_from', type=int, default=None, help="Version to compare from (default: the first recorded one)")
+    parser.add_argument('--to', dest='version_to', type=int, default=None, help="Version to compare to (default: the last recorded one)")
+    parser.add_argument('--threshold', type=float, default=DRIFT_THRESHOLD, help=f"Flag plates whose mean is further than this many reference SDs (default: {DRIFT_THRESHOLD})")
+    parser.add_argument('--all', action='store_true', help="List every plate, not only the flagged ones")
+    args = parser.parse_args(li_arg)
+
+    curdir = os.path.dirname(os.path.abspath(__file__))
+    path_store = os.path.abspath(args.store) if args.store is not None else f"{curdir}/input/EGvaginal_db"
+
+    li_record = DriftSeries(path_store).read()
+    if not li_record:
+        print(f"No drift records in {path_store}")
+        sys.exit(1)
+
+    version_from, version_to, df_drift = version_drift(li_record, args.version_from, args.version_to)
+
+    with pd.option_context('display.width', 200, 'display.max_columns', None):
+        print(f"Reference drift from version {version_from} to {version_to}")
+        print(df_drift.to_string(float_format=lambda x: f"{x:.4g}"))
+        print()
+
+        df_plate = flag_plates(li_record, args.threshold)
+        if not args.all:
+            df_plate = df_plate[df_plate['flagged']]
+        print(f"{int(df_plate['flagged'].sum())} plates diverge by more than {args.threshold:g} SD" if not args.all else f"{len(df_plate)} plates")
+        if len(df_plate):
+            print(df_plate.to_string(index=False, float_format=lambda x: f"{x:.4g}"))
+
+
+if __name__ == '__main__':
+    main()
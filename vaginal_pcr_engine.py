@@ -0,0 +1,256 @@
+import numpy as np
+import pandas as pd
+
+#-------------------------------------------------------
+# Shared calculation engine
+#-------------------------------------------------------
+# The stages run on the plan of a target panel (vaginal_pcr_panel.compile_panel); the constants below
+# are the definition of the default panel.
+LI_MICROBIOME = ['L_crispatus', 'L_gasseri', 'L_iners', 'L_jensenii', 'G_vaginalis', 'F_vaginae', 'BVAB-1']
+LI_BENEFICIAL = LI_MICROBIOME[0:4]
+LI_HARMFUL = LI_MICROBIOME[4:]
+LI_GROUP_TOTAL = ['beneficial_total[%]', 'harmful_total[%]']
+UNIVERSAL = 'Universal'
+CT_UNDETERMINED = 40.1
+TM1_CUTOFF = 80
+
+
+def pivot_experiment(df_exp, li_target):
+    """
+    Pivot the long well table into (sample x target) arrays in a single pass.
+
+    Parameters:
+    df_exp (DataFrame): Well table with the columns sample_name, microbiome, Ct and Tm1.
+    li_target (list): Targets to extract, in column order.
+
+    Returns:
+    A tuple (li_sample_name, arr_ct, arr_tm1). Samples keep their order of first appearance and,
+    like the previous per-cell lookup, the first well of a (sample, target) pair wins.
+    """
+    df_first = df_exp.drop_duplicates(subset=['sample_name', 'microbiome'], keep='first')
+    li_sample_name = list(dict.fromkeys(df_exp['sample_name']))
+
+    sample_codes = pd.Index(li_sample_name).get_indexer(df_first['sample_name'])
+    target_codes = pd.Index(li_target).get_indexer(df_first['microbiome'])
+    is_target = target_codes >= 0
+
+    arr_ct = np.full((len(li_sample_name), len(li_target)), np.nan)
+    arr_tm1 = np.full((len(li_sample_name), len(li_target)), np.nan)
+    arr_ct[sample_codes[is_target], target_codes[is_target]] = pd.to_numeric(df_first['Ct']).to_numpy(dtype=float)[is_target]
+    arr_tm1[sample_codes[is_target], target_codes[is_target]] = pd.to_numeric(df_first['Tm1']).to_numpy(dtype=float)[is_target]
+
+    return li_sample_name, arr_ct, arr_tm1
+
+
+def split_runs(df_exp, li_target):
+    """
+    Split a plate into runs of its samples. A sample loaded twice on the same plate has two wells per target;
+    run 0 holds the first well of every (sample, target) pair, run 1 the second one, and so on.
+
+    Parameters:
+    df_exp (DataFrame): Well table with the columns sample_name, microbiome, Ct and Tm1.
+    li_target (list): Targets a repeat run must cover completely.
+
+    Returns:
+    A tuple (li_df_run, li_partial) - the well table of every run, and the sample names whose repeat wells
+    do not cover every target (those wells are left out, as the first well wins in pivot_experiment).
+    """
+    arr_run = df_exp.groupby(['sample_name', 'microbiome'], sort=False).cumcount().to_numpy()
+    if (len(arr_run) == 0) or (arr_run.max() == 0):
+        return [df_exp], []
+
+    li_df_run = [df_exp[arr_run == 0]]
+    li_partial = []
+    for run in range(1, arr_run.max() + 1):
+        df_run = df_exp[arr_run == run]
+        sr_n_target = df_run[df_run['microbiome'].isin(li_target)].groupby('sample_name', sort=False)['microbiome'].nunique()
+        set_complete = set(sr_n_target.index[sr_n_target == len(li_target)])
+        li_partial.extend(sample_name for sample_name in dict.fromkeys(df_run['sample_name']) if sample_name not in set_complete)
+        if set_complete:
+            li_df_run.append(df_run[df_run['sample_name'].isin(set_complete)])
+
+    return li_df_run, list(dict.fromkeys(li_partial))
+
+
+def calculate_abundance(df_exp, plan):
+    """
+    Calculate the relative abundance 2**-(Ct - Ct_universal) of every (sample x taxon) cell at once.
+    A cell is not detected (0) when its Ct is Undetermined or its Tm1 is outside the window of its target.
+
+    Parameters:
+    df_exp (DataFrame): Well table with the columns sample_name, microbiome, Ct and Tm1.
+    plan (dict): Panel plan (vaginal_pcr_panel.compile_panel) - taxa in column order and their Tm1 windows.
+
+    Returns:
+    DataFrame of abundances indexed by sample name, with one column per taxon.
+    """
+    li_target = plan['li_target']
+    li_sample_name, arr_ct, arr_tm1 = pivot_experiment(df_exp, li_target)
+
+    arr_missing = np.isnan(arr_ct)
+    if arr_missing.any():
+        idx_sample, idx_target = np.argwhere(arr_missing)[0]
+        raise ValueError(f"Missing well for sample {li_sample_name[idx_sample]}, target {li_target[idx_target]}")
+
+    arr_ct_universal = arr_ct[:, -1:]
+    arr_ct = arr_ct[:, :-1]
+    arr_tm1 = arr_tm1[:, :-1]
+
+    # Per-target windows broadcast over the samples
+    arr_undetected = (arr_ct == plan['ct_undetermined']) | (arr_tm1 <= plan['arr_tm1_min']) | (arr_tm1 > plan['arr_tm1_max'])
+
+    # The scalar 2**x (libm pow) of the per-cell code, over the detected cells only - NumPy's SIMD exp2/power
+    # differ from it in the last ulp, which would change EGvaginal_abundance.csv
+    arr_detected = ~arr_undetected
+    arr_abundance = np.zeros(arr_ct.shape)
+    arr_abundance[arr_detected] = [2**x for x in (-(arr_ct - arr_ct_universal))[arr_detected].tolist()]
+
+    df_abundance = pd.DataFrame(arr_abundance, index=pd.Index(li_sample_name, name='serial_number'), columns=plan['li_microbiome'])
+
+    return df_abundance
+
+
+def calculate_group_total(df_abundance, li_beneficial=LI_BENEFICIAL, li_harmful=LI_HARMFUL):
+    """
+    Sum of the beneficial and of the harmful taxa of every sample, in percent.
+
+    Returns:
+    A tuple (beneficial_total, harmful_total) of Series.
+    """
+    arr_abundance = df_abundance.to_numpy(dtype=float)
+
+    li_total = []
+    for li_taxa in [li_beneficial, li_harmful]:
+        arr_idx = df_abundance.columns.get_indexer(li_taxa)
+        if (arr_idx < 0).any():
+            raise KeyError(f"Missing taxa {', '.join(taxon for taxon, idx in zip(li_taxa, arr_idx) if idx < 0)}")
+        li_total.append(pd.Series(sum_columns(arr_abundance, arr_idx)*100, index=df_abundance.index))
+
+    return li_total[0], li_total[1]
+
+
+#-------------------------------------------------------
+# Level evaluation
+#-------------------------------------------------------
+# Evaluations are kept as int8 codes of LI_LEVEL (a Categorical); the labels are only written out by to_csv.
+LI_LEVEL = ['높음', '보통', '낮음']
+HIGH_ABUNDANCE = 0.5
+HIGH_GROUP_TOTAL = 50
+
+
+def evaluate_level(arr_value, arr_mean, arr_high):
+    """
+    Evaluate values against the reference means: '높음' from high on, '보통' from the mean on, '낮음' below the mean.
+
+    Parameters:
+    arr_value (array-like): (sample x column) values.
+    arr_mean (array-like): Reference mean of every column.
+    arr_high (array-like): Lower bound of '높음' of every column.
+
+    Returns:
+    int8 codes of LI_LEVEL shaped like arr_value; values that compare false against both bounds (NaN)
+    get -1, missing in the Categorical.
+    """
+    arr_value = np.asarray(arr_value, dtype=float)
+    arr_mean = np.asarray(arr_mean, dtype=float)
+    arr_high = np.asarray(arr_high, dtype=float)
+
+    arr_code = np.full(arr_value.shape, -1, dtype=np.int8)
+    arr_code[arr_value < arr_mean] = 2
+    arr_code[(arr_value >= arr_mean) & (arr_value < arr_high)] = 1
+    arr_code[arr_value >= arr_high] = 0
+
+    return arr_code
+
+
+def level_frame(arr_code, li_col, index):
+    """
+    DataFrame of level Categoricals, one column per column of the evaluate_level codes.
+    """
+    return pd.DataFrame({col: pd.Categorical.from_codes(arr_code[:, idx], categories=LI_LEVEL) for idx, col in enumerate(li_col)}, index=index)
+
+
+#-------------------------------------------------------
+# Type classification rules
+#-------------------------------------------------------
+# A sample is '기타유형' when its total abundance is below MIN_TOTAL_ABUNDANCE, '면역저하' when its
+# harmful sum exceeds its beneficial sum, and otherwise the type of its most abundant taxon.
+# SprayType is 'G' for '기타유형' and '면역저하', 'C' for every other type.
+DICT_TAXON_TYPE = {'L_crispatus': '항균든든', 'L_gasseri': '항균유지', 'L_iners': '면역주의', 'L_jensenii': '항균특별',
+                   'G_vaginalis': '면역저하', 'F_vaginae': '면역저하', 'BVAB-1': '면역저하'}
+TYPE_LOW_TOTAL = '기타유형'
+TYPE_HARMFUL = '면역저하'
+MIN_TOTAL_ABUNDANCE = 0.05
+LI_SPRAY_TYPE = ['C', 'G']
+LI_SPRAY_G_TYPE = [TYPE_LOW_TOTAL, TYPE_HARMFUL]
+
+
+def compile_type_rules(li_microbiome=LI_MICROBIOME, li_beneficial=LI_BENEFICIAL, li_harmful=LI_HARMFUL,
+                       dict_taxon_type=DICT_TAXON_TYPE, min_total=MIN_TOTAL_ABUNDANCE):
+    """
+    Compile the classification rules into code arrays for classify_type.
+
+    Parameters:
+    li_microbiome (list): Abundance columns, in order.
+    li_beneficial (list), li_harmful (list): Taxa of the beneficial and harmful sums.
+    dict_taxon_type (dict): Type of a sample dominated by the taxon.
+    min_total (float): Total abundance below which a sample is TYPE_LOW_TOTAL.
+
+    Returns:
+    Dictionary of the rule table: the Type and SprayType categories, the Type code of every column,
+    the SprayType code of every Type, the column positions of the sums and the threshold.
+    """
+    li_type = list(dict.fromkeys([dict_taxon_type[taxon] for taxon in li_microbiome] + [TYPE_LOW_TOTAL, TYPE_HARMFUL]))
+
+    dict_rule = {
+        'li_type': li_type,
+        'li_spray_type': list(LI_SPRAY_TYPE),
+        'arr_taxon_type': np.array([li_type.index(dict_taxon_type[taxon]) for taxon in li_microbiome], dtype=np.int8),
+        'arr_type_spray': np.array([LI_SPRAY_TYPE.index('G' if type_name in LI_SPRAY_G_TYPE else 'C') for type_name in li_type], dtype=np.int8),
+        'code_low_total': li_type.index(TYPE_LOW_TOTAL),
+        'code_harmful': li_type.index(TYPE_HARMFUL),
+        'li_total_idx': list(range(len(li_microbiome))),
+        'li_beneficial_idx': [list(li_microbiome).index(taxon) for taxon in li_beneficial],
+        'li_harmful_idx': [list(li_microbiome).index(taxon) for taxon in li_harmful],
+        'min_total': min_total,
+    }
+
+    return dict_rule
+
+
+def sum_columns(arr_abundance, li_idx):
+    # Left to right, like the scalar sum() of the sample values
+    arr_sum = np.zeros(len(arr_abundance))
+    for idx in li_idx:
+        arr_sum = arr_sum + arr_abundance[:, idx]
+
+    return arr_sum
+
+
+def classify_type(arr_abundance, dict_rule):
+    """
+    Classify every sample of a (sample x taxa) abundance matrix at once.
+
+    Parameters:
+    arr_abundance (ndarray): Abundances, columns in the order the rules were compiled for.
+    dict_rule (dict): Rule table of compile_type_rules.
+
+    Returns:
+    A tuple (cat_type, cat_spray_type) of Categoricals.
+    """
+    arr_abundance = np.asarray(arr_abundance, dtype=float).reshape(-1, len(dict_rule['arr_taxon_type']))
+
+    arr_total = sum_columns(arr_abundance, dict_rule['li_total_idx'])
+    arr_beneficial = sum_columns(arr_abundance, dict_rule['li_beneficial_idx'])
+    arr_harmful = sum_columns(arr_abundance, dict_rule['li_harmful_idx'])
+
+    # Dominant taxon - the first one on ties
+    arr_type = dict_rule['arr_taxon_type'][np.argmax(arr_abundance, axis=1)]
+    arr_type = np.where(arr_harmful > arr_beneficial, dict_rule['code_harmful'], arr_type)
+    arr_type = np.where(arr_total < dict_rule['min_total'], dict_rule['code_low_total'], arr_type).astype(np.int8)
+    arr_spray_type = dict_rule['arr_type_spray'][arr_type]
+
+    cat_type = pd.Categorical.from_codes(arr_type, categories=dict_rule['li_type'])
+    cat_spray_type = pd.Categorical.from_codes(arr_spray_type, categories=dict_rule['li_spray_type'])
+
+    return cat_type, cat_spray_type
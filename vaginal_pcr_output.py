@@ -0,0 +1,152 @@
+import os, io, gzip, json, datetime
+
+#-------------------------------------------------------
+# Output sinks
+#-------------------------------------------------------
+# Result tables are streamed into append-friendly sinks, one write per plate, so a batch never holds
+# more than one plate of results:
+#   csv      utf-8 with a single BOM and one header line (what Excel expects)
+#   parquet  one row group per write (pyarrow); the codec is the parquet column compression
+#   jsonl    one JSON object per row
+# csv and jsonl files can be compressed as a whole with gzip (.gz) or zstd (.zst, zstandard package).
+
+LI_FORMAT = ['csv', 'parquet', 'jsonl']
+LI_CODEC = ['none', 'gzip', 'zstd']
+DICT_CODEC_SUFFIX = {'none': '', 'gzip': '.gz', 'zstd': '.zst'}
+
+
+def output_path(path_base, fmt='csv', codec='none'):
+    """
+    File name of an output: path_base (without extension) with the format extension and the codec suffix.
+    """
+    if fmt not in LI_FORMAT:
+        raise ValueError(f"Unknown output format {fmt} (expected one of {', '.join(LI_FORMAT)})")
+    if codec not in LI_CODEC:
+        raise ValueError(f"Unknown output codec {codec} (expected one of {', '.join(LI_CODEC)})")
+
+    return f"{path_base}.{fmt}" + ('' if fmt == 'parquet' else DICT_CODEC_SUFFIX[codec])
+
+
+def make_run_dir(outdir, prefix='run'):
+    """
+    Create a new output directory <outdir>/<prefix>_<time> for one run, suffixed if it already exists.
+    """
+    stamp = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
+    path_run = f"{outdir}/{prefix}_{stamp}"
+
+    n = 1
+    while True:
+        try:
+            os.makedirs(path_run)
+            return path_run
+        except FileExistsError:
+            n += 1
+            path_run = f"{outdir}/{prefix}_{stamp}_{n}"
+
+
+def open_binary(path, codec):
+    if codec == 'gzip':
+        return gzip.open(path, 'wb')
+    if codec == 'zstd':
+        import zstandard
+        return zstandard.ZstdCompressor().stream_writer(open(path, 'wb'), closefd=True)
+
+    return open(path, 'wb')
+
+
+class Sink:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class CsvSink(Sink):
+    def __init__(self, path, codec='none'):
+        self.path = path
+        self.f = io.TextIOWrapper(open_binary(path, codec), encoding='utf-8-sig', newline='')
+        self.n_row = 0
+        self.header = True
+
+    def write(self, df, index_label=None):
+        # The utf-8-sig encoder writes the BOM once, at the start of the stream
+        df.to_csv(self.f, header=self.header, index_label=index_label)
+        self.header = False
+        self.n_row += len(df)
+
+    def close(self):
+        self.f.close()
+
+
+class JsonlSink(Sink):
+    def __init__(self, path, codec='none'):
+        self.path = path
+        self.f = io.TextIOWrapper(open_binary(path, codec), encoding='utf-8', newline='')
+        self.n_row = 0
+
+    def write(self, df, index_label=None):
+        df = df.reset_index(names=index_label) if index_label is not None else df
+        # Python floats through json - to_json rounds to at most 15 digits; missing values as null
+        df = df.astype(object).where(df.notna(), None)
+        self.f.write(''.join(json.dumps(record, ensure_ascii=False) + '\n' for record in df.to_dict('records')))
+        self.n_row += len(df)
+
+    def close(self):
+        self.f.close()
+
+
+class ParquetSink(Sink):
+    def __init__(self, path, codec='none'):
+        import pyarrow.parquet as pq
+
+        self.path = path
+        self.pq = pq
+        self.compression = {'none': 'NONE', 'gzip': 'GZIP', 'zstd': 'ZSTD'}[codec]
+        self.writer = None
+        self.n_row = 0
+
+    def write(self, df, index_label=None):
+        import pyarrow as pa
+
+        df = df.reset_index(names=index_label) if index_label is not None else df
+        # Columns mixing numbers and text (the distributions of the mean-abundance table) are written as text
+        for col in df.columns[df.dtypes == object]:
+            if df[col].map(type).nunique() > 1:
+                df = df.assign(**{col: df[col].map(lambda value: None if value is None else str(value))})
+        table = pa.Table.from_pandas(df, preserve_index=False)
+
+        if self.writer is None:
+            self.writer = self.pq.ParquetWriter(self.path, table.schema, compression=self.compression)
+        # One row group per plate
+        self.writer.write_table(table.cast(self.writer.schema))
+        self.n_row += len(df)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+def open_sink(path, fmt='csv', codec='none'):
+    """
+    Open a sink for a result table.
+
+    Parameters:
+    path (str): Output path, see output_path().
+    fmt (str): One of LI_FORMAT.
+    codec (str): One of LI_CODEC.
+
+    Returns:
+    CsvSink, ParquetSink or JsonlSink - write(df, index_label) per plate, close() at the end (or use it as a context manager).
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    return {'csv': CsvSink, 'parquet': ParquetSink, 'jsonl': JsonlSink}[fmt](path, codec)
+
+
+def write_table(path, df, index_label=None, fmt='csv', codec='none'):
+    """
+    Write one table into a new output file.
+    """
+    with open_sink(path, fmt, codec) as sink:
+        sink.write(df, index_label)
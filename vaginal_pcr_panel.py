@@ -0,0 +1,163 @@
+##<Usage: python vaginal_pcr_panel.py [{path_panel}]>
+### ex) python vaginal_pcr_panel.py                          (print the default panel definition - a template for new panels)
+###     python vaginal_pcr_panel.py "/home/kbkim/vaginal_pcr/input/EGvaginal_panel_v2.json"   (check a panel and print its plan)
+
+import sys, json, hashlib
+import numpy as np
+
+from vaginal_pcr_engine import (CT_UNDETERMINED, DICT_TAXON_TYPE, HIGH_ABUNDANCE, HIGH_GROUP_TOTAL, LI_BENEFICIAL, LI_HARMFUL,
+                                LI_MICROBIOME, MIN_TOTAL_ABUNDANCE, TM1_CUTOFF, UNIVERSAL, compile_type_rules)
+
+#-------------------------------------------------------
+# Target panel
+#-------------------------------------------------------
+# A panel definition (json) lists the targets of an assay with their group, their type and, optionally,
+# their own Tm1 window and '높음' bound; the keys missing from a definition are those of DEFAULT_PANEL.
+#
+#   {"name": "EGvaginal", "universal": "Universal", "ct_undetermined": 40.1,
+#    "tm1_min": 80, "tm1_max": null,                    detected when tm1_min < Tm1 <= tm1_max (null: no bound)
+#    "high_abundance": 0.5, "high_group_total": 50, "min_total_abundance": 0.05,
+#    "targets": [{"name": "L_crispatus", "group": "beneficial", "type": "항균든든"}, ...,
+#                {"name": "G_vaginalis", "group": "harmful", "type": "면역저하", "tm1_min": 78, "tm1_max": 86}]}
+#
+# compile_panel() turns a definition once into the plan every stage runs on: the taxa order, the column
+# indexes of the beneficial/harmful sums, the type rule table and one threshold per target (Tm1 window,
+# '높음' bound), so a new panel needs no code change and the stages no per-taxon branches.
+
+PANEL_FORMAT = 1
+LI_GROUP = ['beneficial', 'harmful']
+LI_TARGET_KEY = ['name', 'group', 'type', 'tm1_min', 'tm1_max', 'high_abundance']
+
+DEFAULT_PANEL = {
+    'format': PANEL_FORMAT,
+    'name': 'EGvaginal',
+    'universal': UNIVERSAL,
+    'ct_undetermined': CT_UNDETERMINED,
+    'tm1_min': TM1_CUTOFF,
+    'tm1_max': None,
+    'high_abundance': HIGH_ABUNDANCE,
+    'high_group_total': HIGH_GROUP_TOTAL,
+    'min_total_abundance': MIN_TOTAL_ABUNDANCE,
+    'targets': [{'name': taxon, 'group': 'beneficial' if taxon in LI_BENEFICIAL else ('harmful' if taxon in LI_HARMFUL else None),
+                 'type': DICT_TAXON_TYPE[taxon]} for taxon in LI_MICROBIOME],
+}
+
+
+def normalize_panel(dict_panel):
+    """
+    Check a panel definition and fill in the keys it leaves out from DEFAULT_PANEL.
+
+    Returns:
+    The complete definition - every target with all of LI_TARGET_KEY.
+    """
+    li_unknown = [key for key in dict_panel if key not in DEFAULT_PANEL]
+    if li_unknown:
+        raise ValueError(f"Unknown panel keys {', '.join(li_unknown)}")
+    if dict_panel.get('format', PANEL_FORMAT) != PANEL_FORMAT:
+        raise ValueError(f"Unsupported panel format: {dict_panel['format']}")
+
+    dict_panel = {**DEFAULT_PANEL, **dict_panel}
+    if not dict_panel['targets']:
+        raise ValueError("The panel has no targets")
+
+    li_target = []
+    for dict_target in dict_panel['targets']:
+        li_unknown = [key for key in dict_target if key not in LI_TARGET_KEY]
+        if li_unknown:
+            raise ValueError(f"Unknown keys {', '.join(li_unknown)} of target {dict_target.get('name')}")
+        if ('name' not in dict_target) or ('type' not in dict_target):
+            raise ValueError(f"Every target needs a name and a type: {dict_target}")
+        if dict_target.get('group') not in LI_GROUP + [None]:
+            raise ValueError(f"Unknown group {dict_target['group']} of target {dict_target['name']} (expected one of {', '.join(LI_GROUP)} or null)")
+
+        li_target.append({'name': dict_target['name'], 'group': dict_target.get('group'), 'type': dict_target['type'],
+                          **{key: dict_target.get(key, dict_panel[key]) for key in ['tm1_min', 'tm1_max', 'high_abundance']}})
+
+    li_name = [dict_target['name'] for dict_target in li_target]
+    li_repeated = [name for name in dict.fromkeys(li_name) if li_name.count(name) > 1]
+    if li_repeated:
+        raise ValueError(f"Targets listed more than once: {', '.join(li_repeated)}")
+    if dict_panel['universal'] in li_name:
+        raise ValueError(f"The universal target {dict_panel['universal']} cannot be a panel target")
+
+    dict_panel['targets'] = li_target
+
+    return dict_panel
+
+
+def compile_panel(dict_panel=DEFAULT_PANEL):
+    """
+    Compile a panel definition into the plan of the stages.
+
+    Parameters:
+    dict_panel (dict): Panel definition, see DEFAULT_PANEL.
+
+    Returns:
+    Dictionary of the plan: the taxa order and the targets of a plate, the Undetermined Ct, the per-target Tm1 window
+    and '높음' bound, the '높음' bound of the group totals, the beneficial/harmful taxa, the type rule table
+    (compile_type_rules), the panel hash the results depend on and the complete definition.
+    """
+    dict_panel = normalize_panel(dict_panel)
+    li_target = dict_panel['targets']
+    li_microbiome = [dict_target['name'] for dict_target in li_target]
+    li_beneficial = [dict_target['name'] for dict_target in li_target if dict_target['group'] == 'beneficial']
+    li_harmful = [dict_target['name'] for dict_target in li_target if dict_target['group'] == 'harmful']
+
+    plan = {
+        'name': dict_panel['name'],
+        'panel_hash': hashlib.sha256(json.dumps(dict_panel, ensure_ascii=False, sort_keys=True).encode('utf-8')).hexdigest(),
+        'li_microbiome': li_microbiome,
+        'universal': dict_panel['universal'],
+        'li_target': li_microbiome + [dict_panel['universal']],
+        'ct_undetermined': float(dict_panel['ct_undetermined']),
+        # Open bounds of the detection window as -inf / inf - NaN Tm1 compares false against both, as before
+        'arr_tm1_min': np.array([-np.inf if dict_target['tm1_min'] is None else dict_target['tm1_min'] for dict_target in li_target], dtype=float),
+        'arr_tm1_max': np.array([np.inf if dict_target['tm1_max'] is None else dict_target['tm1_max'] for dict_target in li_target], dtype=float),
+        'arr_high': np.array([dict_target['high_abundance'] for dict_target in li_target], dtype=float),
+        'arr_high_group': np.full(len(LI_GROUP), dict_panel['high_group_total'], dtype=float),
+        'li_beneficial': li_beneficial,
+        'li_harmful': li_harmful,
+        'type_rule': compile_type_rules(li_microbiome, li_beneficial, li_harmful,
+                                        {dict_target['name']: dict_target['type'] for dict_target in li_target}, dict_panel['min_total_abundance']),
+        'definition': dict_panel,
+    }
+
+    return plan
+
+
+def load_panel(path_panel):
+    with open(path_panel, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def load_plan(path_panel=None):
+    """
+    Plan of a panel definition file, or of the default panel if path_panel is None.
+    """
+    if path_panel is None:
+        return DEFAULT_PLAN
+
+    return compile_panel(load_panel(path_panel))
+
+
+# Plan of the default panel, compiled once per process
+DEFAULT_PLAN = compile_panel(DEFAULT_PANEL)
+
+
+####################################
+# main
+####################################
+if __name__ == '__main__':
+
+    if len(sys.argv) < 2:
+        print(json.dumps(DEFAULT_PANEL, ensure_ascii=False, indent=2))
+        sys.exit(0)
+
+    plan = load_plan(sys.argv[1])
+
+    print(f"Panel {plan['name']} - {len(plan['li_microbiome'])} targets, hash {plan['panel_hash'][:12]}")
+    print(f"beneficial: {', '.join(plan['li_beneficial'])}")
+    print(f"harmful: {', '.join(plan['li_harmful'])}")
+    for idx, taxon in enumerate(plan['li_microbiome']):
+        print(f"  {taxon:<16}{plan['arr_tm1_min'][idx]:g} < Tm1 <= {plan['arr_tm1_max'][idx]:g}, 높음 >= {plan['arr_high'][idx]:g}, "
+              f"type {plan['type_rule']['li_type'][plan['type_rule']['arr_taxon_type'][idx]]}")
@@ -0,0 +1,155 @@
+import os, json, time, resource, datetime, functools, tracemalloc
+from contextlib import contextmanager
+
+#-------------------------------------------------------
+# Per-stage instrumentation
+#-------------------------------------------------------
+# Stage methods decorated with instrument_stage record wall time, CPU time, peak RSS growth,
+# tracemalloc allocation (optional) and the row count of their result for every plate, when the
+# object they belong to has a StageProfiler in its `profiler` attribute. Records are appended as
+# JSON lines and can be summarized into a Prometheus textfile.
+
+
+def peak_rss_mb():
+    # ru_maxrss is in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class StageProfiler:
+    def __init__(self, path_jsonl=None, path_prom=None, use_tracemalloc=False):
+        """
+        Initializes a StageProfiler object.
+
+        Parameters:
+        path_jsonl (str): JSON lines file the stage records are appended to.
+        path_prom (str): Prometheus textfile rewritten by write_prometheus().
+        use_tracemalloc (bool): Also trace Python allocations per stage (slows the stages down).
+        """
+        self.path_jsonl = path_jsonl
+        self.path_prom = path_prom
+        self.use_tracemalloc = use_tracemalloc
+        self.li_record = []
+
+        if use_tracemalloc and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @contextmanager
+    def stage(self, stage, plate=None):
+        """
+        Measure one stage run. The yielded dictionary is the record; the caller may add 'rows' and 'rv'.
+        """
+        record = {'time': datetime.datetime.now().isoformat(timespec='milliseconds'), 'pid': os.getpid(),
+                  'plate': plate, 'stage': stage, 'rows': None, 'rv': None}
+
+        if self.use_tracemalloc:
+            tracemalloc.reset_peak()
+            traced_start = tracemalloc.get_traced_memory()[0]
+        rss_start = peak_rss_mb()
+        cpu_start = time.process_time()
+        wall_start = time.perf_counter()
+
+        try:
+            yield record
+        finally:
+            record['wall_seconds'] = time.perf_counter() - wall_start
+            record['cpu_seconds'] = time.process_time() - cpu_start
+            record['rss_peak_mb'] = peak_rss_mb()
+            record['rss_peak_growth_mb'] = record['rss_peak_mb'] - rss_start
+            if self.use_tracemalloc:
+                traced_current, traced_peak = tracemalloc.get_traced_memory()
+                record['traced_delta_mb'] = (traced_current - traced_start) / (1 << 20)
+                record['traced_peak_mb'] = (traced_peak - traced_start) / (1 << 20)
+
+            self.li_record.append(record)
+            self.write_record(record)
+
+    def write_record(self, record):
+        if self.path_jsonl is None:
+            return
+
+        # One write per line - concurrent worker processes can share the file
+        with open(self.path_jsonl, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+    def write_prometheus(self, path_prom=None, li_record=None):
+        """
+        Summarize the stage records into a Prometheus textfile (totals per stage and the last run).
+        """
+        path_prom = path_prom if path_prom is not None else self.path_prom
+        li_record = li_record if li_record is not None else self.li_record
+        if path_prom is None:
+            return
+
+        dict_stage = {}
+        for record in li_record:
+            dict_stage.setdefault(record['stage'], []).append(record)
+
+        li_line = []
+        li_metric = [
+            ('vaginal_pcr_stage_runs_total', 'counter', 'Number of stage runs', lambda li: len(li)),
+            ('vaginal_pcr_stage_wall_seconds_total', 'counter', 'Wall time spent in the stage', lambda li: sum(r['wall_seconds'] for r in li)),
+            ('vaginal_pcr_stage_cpu_seconds_total', 'counter', 'CPU time spent in the stage', lambda li: sum(r['cpu_seconds'] for r in li)),
+            ('vaginal_pcr_stage_rows_total', 'counter', 'Rows produced by the stage', lambda li: sum(r['rows'] or 0 for r in li)),
+            ('vaginal_pcr_stage_errors_total', 'counter', 'Stage runs that failed', lambda li: sum(r['rv'] is False for r in li)),
+            ('vaginal_pcr_stage_last_wall_seconds', 'gauge', 'Wall time of the last stage run', lambda li: li[-1]['wall_seconds']),
+            ('vaginal_pcr_stage_max_rss_peak_growth_mb', 'gauge', 'Largest peak RSS growth of a stage run', lambda li: max(r['rss_peak_growth_mb'] for r in li)),
+        ]
+        for name, metric_type, description, func in li_metric:
+            li_line.append(f"# HELP {name} {description}")
+            li_line.append(f"# TYPE {name} {metric_type}")
+            for stage, li in dict_stage.items():
+                li_line.append(f'{name}{{stage="{stage}"}} {func(li)}')
+
+        # Written through a temporary file - node_exporter may read it at any time
+        path_tmp = f"{path_prom}.tmp"
+        with open(path_tmp, 'w', encoding='utf-8') as f:
+            f.write('\n'.join(li_line) + '\n')
+        os.replace(path_tmp, path_prom)
+
+
+def instrument_stage(rows_attr=None):
+    """
+    Decorator of the pipeline stage methods. Without a profiler on the object, the stage runs unmeasured.
+
+    Parameters:
+    rows_attr (str): Attribute holding the stage result, whose length is recorded as the row count.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            profiler = getattr(self, 'profiler', None)
+            if profiler is None:
+                return func(self, *args, **kwargs)
+
+            plate = os.path.basename(getattr(self, 'path_exp', '') or '')
+            with profiler.stage(func.__name__, plate=plate) as record:
+                try:
+                    result = func(self, *args, **kwargs)
+                # Stages leave with sys.exit() on some errors
+                except BaseException:
+                    record['rv'] = False
+                    raise
+
+                if isinstance(result, tuple):
+                    record['rv'] = result[0]
+                if (rows_attr is not None) and (getattr(self, rows_attr, None) is not None):
+                    record['rows'] = len(getattr(self, rows_attr))
+
+            return result
+
+        return wrapper
+
+    return decorator
+
+
+def profiler_from_env():
+    """
+    StageProfiler configured by VAGINAL_PCR_PROFILE (JSON lines path) and VAGINAL_PCR_PROMETHEUS
+    (textfile path), or None if neither is set.
+    """
+    path_jsonl = os.environ.get('VAGINAL_PCR_PROFILE')
+    path_prom = os.environ.get('VAGINAL_PCR_PROMETHEUS')
+    if (path_jsonl is None) and (path_prom is None):
+        return None
+
+    return StageProfiler(path_jsonl, path_prom, use_tracemalloc=os.environ.get('VAGINAL_PCR_TRACEMALLOC') == '1')
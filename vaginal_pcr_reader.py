@@ -0,0 +1,159 @@
+import os, csv
+import numpy as np
+import pandas as pd
+
+from vaginal_pcr_engine import CT_UNDETERMINED
+
+#-------------------------------------------------------
+# Streaming reader of QuantStudio experiment exports
+#-------------------------------------------------------
+# The result table of an export starts at the row whose first cell is 'Well' and ends at the first
+# row without a well. Rows are streamed and only the four used columns are kept, so neither the
+# metadata block above the table nor the summary block below it is ever materialized.
+
+# Export column -> column of df_exp; 'Cт' (Cyrillic т) and 'CT' are both written by the instrument software
+DICT_COLUMN = {"Sample Name": "sample_name", "Target Name": "microbiome", "Cт": "Ct", "CT": "Ct", "Tm1": "Tm1"}
+LI_EXP_COLUMN = ["sample_name", "microbiome", "Ct", "Tm1"]
+
+# Extensions of the exports read_experiment reads - text exports, the legacy .xls and .xlsx
+LI_TEXT_EXT = ['.csv', '.txt', '.tsv']
+LI_EXPORT_EXT = ['.xlsx', '.xls'] + LI_TEXT_EXT
+
+
+def parse_float(value, undetermined=None):
+    """
+    Ct / Tm1 value of a cell. A text value may use one comma as the decimal separator ('35,12' - exports of a
+    decimal-comma locale); any other comma is ambiguous and rejected rather than dropped.
+    """
+    if value is None:
+        return np.nan
+    if isinstance(value, str):
+        value = value.strip()
+        if value == 'Undetermined':
+            return undetermined
+        if value == '':
+            return np.nan
+        if ',' in value:
+            if (value.count(',') > 1) or ('.' in value):
+                raise ValueError(f"Check the Experiment result file - ambiguous number {value!r}")
+            value = value.replace(',', '.')
+
+    return float(value)
+
+
+def find_columns(row_header):
+    """
+    Map the used columns of df_exp to their position in the header row.
+    """
+    dict_position = {}
+    for idx, name in enumerate(row_header):
+        name = name.strip() if isinstance(name, str) else name
+        if (name in DICT_COLUMN) and (DICT_COLUMN[name] not in dict_position):
+            dict_position[DICT_COLUMN[name]] = idx
+
+    li_missing = [col for col in LI_EXP_COLUMN if col not in dict_position]
+    if li_missing:
+        raise ValueError(f"Check the columns of Experiment result file - missing {', '.join(li_missing)}")
+
+    return dict_position
+
+
+def rows_to_frame(iter_row, undetermined=CT_UNDETERMINED):
+    """
+    Build df_exp from an iterator over the rows of an export.
+
+    Returns:
+    DataFrame indexed by Well with the columns sample_name, microbiome, Ct (float, Undetermined mapped
+    to undetermined) and Tm1 (float).
+    """
+    dict_position = None
+    li_well, li_sample_name, li_microbiome, li_ct, li_tm1 = [], [], [], [], []
+
+    for row in iter_row:
+        if dict_position is None:
+            if row and (row[0] == 'Well'):
+                dict_position = find_columns(row)
+            continue
+
+        # End of the result table - first row without a well
+        if (not row) or (row[0] is None) or (row[0] == '') or (isinstance(row[0], str) and row[0].startswith('[')):
+            break
+
+        li_well.append(row[0])
+        li_sample_name.append(row[dict_position['sample_name']])
+        li_microbiome.append(row[dict_position['microbiome']])
+        li_ct.append(parse_float(row[dict_position['Ct']], undetermined=undetermined))
+        li_tm1.append(parse_float(row[dict_position['Tm1']]))
+
+    if dict_position is None:
+        raise ValueError("Check the Experiment result file - no 'Well' header row")
+
+    df_exp = pd.DataFrame({'sample_name': li_sample_name, 'microbiome': li_microbiome,
+                           'Ct': np.array(li_ct, dtype=float), 'Tm1': np.array(li_tm1, dtype=float)},
+                          index=pd.Index(li_well, name='Well'))
+
+    return df_exp
+
+
+def iter_xlsx_rows(path_exp, sheet=0):
+    import openpyxl
+
+    wb = openpyxl.load_workbook(path_exp, read_only=True, data_only=True)
+    try:
+        ws = wb.worksheets[sheet] if isinstance(sheet, int) else wb[sheet]
+        for row in ws.iter_rows(values_only=True):
+            yield row
+    finally:
+        wb.close()
+
+
+def iter_xls_rows(path_exp, sheet=0):
+    """
+    Rows of a legacy .xls export, read with pandas (requires xlrd); empty cells are None as in iter_xlsx_rows.
+    """
+    df_sheet = pd.read_excel(path_exp, sheet_name=sheet, header=None, dtype=object)
+    for row in df_sheet.itertuples(index=False, name=None):
+        yield tuple(None if (isinstance(value, float) and np.isnan(value)) else value for value in row)
+
+
+def iter_text_rows(path_exp):
+    """
+    Rows of an instrument CSV/TXT export. The delimiter (tab or comma) is taken from the 'Well' header line;
+    the '*' metadata lines above it are skipped without being split.
+    """
+    with open(path_exp, encoding='utf-8-sig', errors='replace', newline='') as f:
+        delimiter = None
+        for line in f:
+            if delimiter is None:
+                if not (line.startswith('Well\t') or line.startswith('Well,') or line.startswith('"Well"')):
+                    continue
+                delimiter = '\t' if '\t' in line else ','
+                yield next(csv.reader([line], delimiter=delimiter))
+                continue
+
+            row = next(csv.reader([line], delimiter=delimiter), [])
+            row = [value if value != '' else None for value in row]
+            if row and isinstance(row[0], str) and row[0].isdigit():
+                row[0] = int(row[0])
+            yield row
+
+
+def read_experiment(path_exp, undetermined=CT_UNDETERMINED):
+    """
+    Read the result table of a QuantStudio export (.xlsx, a legacy .xls, or the equivalent .csv/.txt).
+
+    Parameters:
+    path_exp (str): Path of PCR experiment result file.
+    undetermined (float): Ct of the 'Undetermined' wells - the ct_undetermined of the panel.
+
+    Returns:
+    DataFrame indexed by Well with the columns sample_name, microbiome, Ct and Tm1.
+    """
+    ext = os.path.splitext(path_exp)[1].lower()
+
+    if ext in LI_TEXT_EXT:
+        return rows_to_frame(iter_text_rows(path_exp), undetermined)
+    if ext == '.xls':
+        return rows_to_frame(iter_xls_rows(path_exp), undetermined)
+
+    return rows_to_frame(iter_xlsx_rows(path_exp), undetermined)
@@ -0,0 +1,217 @@
+##<Usage: python vaginal_pcr_rebuild.py {dir|glob} [{dir|glob} ...] [--store DIR] [--workers N] [--policy keep-first|replace|keep-both] [--panel FILE] [--skip-failed]>
+### ex) python vaginal_pcr_rebuild.py "/home/kbkim/vaginal_pcr/archive/" --workers 8
+### Plates are merged in path order - the order of sequential ingests - so name the archive chronologically.
+### An interrupted rebuild resumes from the plates it already computed (kept in <store>.rebuild until it completes).
+
+import os, sys, time, pickle, hashlib, argparse
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from vaginal_pcr_reader import read_experiment
+from vaginal_pcr_engine import calculate_abundance, split_runs
+from vaginal_pcr_panel import load_plan
+from vaginal_pcr_store import ReferenceStore, SampleRegistry, hash_sample_ids, write_reference_matrix
+from vaginal_pcr_stats import compute_reference_stats, write_stats_snapshot
+from vaginal_pcr_drift import record_baseline
+from vaginal_pcr_batch import assign_plate_names, collect_plates
+from vaginal_pcr_update_reference import LI_POLICY, WriteLog, resolve_sample_ids
+
+#-------------------------------------------------------
+# Reference rebuild from archived plate exports
+#-------------------------------------------------------
+# Replaying the update script plate by plate rewrites the statistics and the matrix once per plate.
+# A rebuild parses and computes the plates in a process pool, merges them in path order with the
+# duplicate policy of the update script (so the reference is the one sequential ingests would give),
+# and publishes it as one write: one segment, the registry, stats.json and reference.mat.
+#
+#   <store>.rebuild/<key>.pkl   abundances of one plate, keyed by its path, size, mtime and the panel hash
+#
+# Plates are computed at most once per key, so a rebuild started again after an interruption (or a
+# failed plate) only computes what is missing. The work directory is removed once the store is published.
+
+REBUILD_FORMAT = 1
+
+
+def plate_key(path_exp, plan):
+    stat = os.stat(path_exp)
+    str_key = f"{REBUILD_FORMAT}:{os.path.abspath(path_exp)}:{stat.st_size}:{stat.st_mtime_ns}:{plan['panel_hash']}"
+
+    return hashlib.sha256(str_key.encode('utf-8')).hexdigest()
+
+
+def compute_plate(path_exp, plate, path_result, plan):
+    """
+    Parse one plate and compute the abundances of every run on it in a worker process.
+
+    Returns:
+    Dictionary with the plate summary (sample and run counts, incomplete repeats, timing, status).
+    """
+    start = time.perf_counter()
+    dict_result = {'plate': plate, 'path_exp': path_exp, 'n_sample': 0, 'n_run': 0, 'li_partial': [], 'rv': True, 'rvmsg': "Success"}
+
+    try:
+        df_exp = read_experiment(path_exp, plan['ct_undetermined'])
+        li_df_run, li_partial = split_runs(df_exp, plan['li_target'])
+        li_df_abundance = [calculate_abundance(df_run, plan) for df_run in li_df_run]
+        df_abundance = pd.concat(li_df_abundance) if len(li_df_abundance) > 1 else li_df_abundance[0]
+
+        # Written under a temporary name - an interrupted worker leaves no partial result behind
+        path_tmp = f"{path_result}.{os.getpid()}.tmp"
+        with open(path_tmp, 'wb') as f:
+            pickle.dump(df_abundance, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(path_tmp, path_result)
+
+        dict_result.update({'n_sample': len(df_abundance), 'n_run': len(li_df_run), 'li_partial': li_partial})
+    except Exception as e:
+        dict_result['rv'] = False
+        dict_result['rvmsg'] = str(e)
+
+    dict_result['seconds'] = time.perf_counter() - start
+
+    return dict_result
+
+
+def publish_rebuild(path_store, df_db, plan):
+    """
+    Replace the reference of the store with df_db under the store lock: the segment and manifest, the sample-ID
+    registry, the statistics snapshot and the published matrix, in the order the update script writes them,
+    then the baseline record of the drift series.
+
+    Returns:
+    The manifest of the rebuilt store.
+    """
+    os.makedirs(path_store, exist_ok=True)
+    refstore = ReferenceStore(path_store)
+
+    with refstore.lock():
+        manifest = refstore.rewrite(df_db, {'beneficial': plan['li_beneficial'], 'harmful': plan['li_harmful']})
+
+        registry = SampleRegistry(refstore)
+        registry.arr_key = np.unique(hash_sample_ids(df_db.index))
+        registry.write(manifest)
+
+        write_stats_snapshot(f"{path_store}/stats.json", compute_reference_stats(df_db, manifest))
+        write_reference_matrix(f"{path_store}/reference.mat", df_db, manifest)
+        record_baseline(path_store, manifest, df_db)
+
+    return manifest
+
+
+def run_rebuild(li_path, path_store, max_workers=None, policy='keep-first', plan=None, skip_failed=False, fplog=None):
+    """
+    Rebuild the reference of a store from plate exports.
+
+    Parameters:
+    li_path (list): Paths of the experiment workbooks, in ingest order.
+    path_store (str): Directory of the reference store to rebuild (created if missing).
+    max_workers (int): Number of worker processes (default: CPU count).
+    policy (str): Duplicate sample policy - 'keep-first', 'replace' or 'keep-both'.
+    plan (dict): Compiled target panel (default: the default panel).
+    skip_failed (bool): Publish without the plates that could not be read; otherwise nothing is published.
+
+    Returns:
+    A tuple (manifest, df_summary) of the rebuilt store (None if it was not published) and the per-plate summary.
+    """
+    myNAME = "run_rebuild"
+    start = time.perf_counter()
+    plan = plan if plan is not None else load_plan()
+
+    if policy not in LI_POLICY:
+        raise ValueError(f"Unknown duplicate policy {policy} (expected one of {', '.join(LI_POLICY)})")
+
+    path_work = f"{path_store}.rebuild"
+    os.makedirs(path_work, exist_ok=True)
+
+    li_plate = assign_plate_names(li_path)
+    li_path_result = [f"{path_work}/{plate_key(path_exp, plan)}.pkl" for path_exp in li_path]
+    li_todo = [idx for idx, path_result in enumerate(li_path_result) if not os.path.exists(path_result)]
+    if len(li_todo) < len(li_path):
+        WriteLog(myNAME, f"{len(li_path) - len(li_todo)} of {len(li_path)} plates already computed - resumed", type='INFO', fplog=fplog)
+
+    # Parse and compute - plates finish in any order, the merge below is in path order
+    dict_result = {}
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        dict_future = {executor.submit(compute_plate, li_path[idx], li_plate[idx], li_path_result[idx], plan): idx for idx in li_todo}
+
+        for n_done, future in enumerate(as_completed(dict_future), 1):
+            result = future.result()
+            dict_result[dict_future[future]] = result
+            elapsed = time.perf_counter() - start
+            WriteLog(myNAME, f"[{n_done}/{len(li_todo)}] {result['plate']} - {result['rvmsg']}, {result['n_sample']} samples ({result['seconds']:.2f}s) "
+                             f"- {n_done/elapsed:.2f} plates/s, ~{(len(li_todo) - n_done)*elapsed/n_done:.0f}s left", type='INFO', fplog=fplog)
+            if result['li_partial']:
+                WriteLog(myNAME, f"{result['plate']}: incomplete repeat wells ignored for {', '.join(map(str, result['li_partial']))}", type='WARNING', fplog=fplog)
+
+    li_failed = [li_plate[idx] for idx, result in sorted(dict_result.items()) if not result['rv']]
+    if li_failed:
+        WriteLog(myNAME, f"{len(li_failed)} plates failed: {', '.join(li_failed)}", type='ERROR', fplog=fplog)
+        if not skip_failed:
+            WriteLog(myNAME, "Reference not rebuilt - fix or remove the failed plates and run again (computed plates are kept)", type='ERROR', fplog=fplog)
+            return None, pd.DataFrame([dict_result[idx] for idx in sorted(dict_result)])
+
+    # Merge in path order and resolve the duplicates as sequential ingests into an empty store would
+    li_df_abundance = []
+    for path_result in li_path_result:
+        if os.path.exists(path_result):
+            with open(path_result, 'rb') as f:
+                li_df_abundance.append(pickle.load(f))
+    if len(li_df_abundance) > 1:
+        df_abundance = pd.concat(li_df_abundance)
+    elif li_df_abundance:
+        df_abundance = li_df_abundance[0]
+    else:
+        df_abundance = pd.DataFrame(columns=plan['li_microbiome'], dtype=float)
+
+    # Against an empty registry - 'replace' keeps the last run of a sample where it is, like the re-appends of sequential ingests
+    df_db, _, li_renamed = resolve_sample_ids(df_abundance, SampleRegistry(ReferenceStore(path_store)), policy)
+
+    manifest = publish_rebuild(path_store, df_db, plan)
+
+    for name in os.listdir(path_work):
+        os.remove(f"{path_work}/{name}")
+    os.rmdir(path_work)
+
+    elapsed = time.perf_counter() - start
+    WriteLog(myNAME, f"Reference version {manifest['version']} rebuilt from {len(li_df_abundance)} plates - {len(df_db)} of {len(df_abundance)} samples kept, "
+                     f"{len(li_renamed)} renamed ({policy}) in {elapsed:.2f}s", type='INFO', fplog=fplog)
+
+    return manifest, pd.DataFrame([dict_result[idx] for idx in sorted(dict_result)])
+
+
+####################################
+# main
+####################################
+def main(li_arg=None):
+    """
+    Command line of the rebuild - also the 'rebuild-ref' command of vaginal_pcr_cli.py.
+
+    Parameters:
+    li_arg (list): Arguments (default: sys.argv[1:]).
+    """
+    parser = argparse.ArgumentParser(prog='rebuild-ref', description="Rebuild the reference store from an archive of PCR experiment result files")
+    parser.add_argument('patterns', nargs='+', help="Directories or glob patterns of experiment result files (.xlsx, .xls, .csv, .txt, .tsv), merged in path order")
+    parser.add_argument('--store', default=None, help="Reference store to rebuild (default: input/EGvaginal_db)")
+    parser.add_argument('--workers', type=int, default=None, help="Number of worker processes (default: CPU count)")
+    parser.add_argument('--policy', default='keep-first', choices=LI_POLICY, help="Duplicate sample policy (default: keep-first)")
+    parser.add_argument('--panel', default=None, help="Target panel definition (json, see vaginal_pcr_panel.py; default: the EGvaginal panel)")
+    parser.add_argument('--skip-failed', action='store_true', help="Rebuild without the plates that cannot be read")
+    args = parser.parse_args(li_arg)
+
+    li_path = collect_plates(args.patterns)
+    if not li_path:
+        print("No experiment result files found")
+        sys.exit(1)
+
+    curdir = os.path.dirname(os.path.abspath(__file__))
+    path_store = os.path.abspath(args.store) if args.store is not None else f"{curdir}/input/EGvaginal_db"
+
+    manifest, _ = run_rebuild(li_path, path_store, max_workers=args.workers, policy=args.policy, plan=load_plan(args.panel), skip_failed=args.skip_failed)
+    if manifest is None:
+        sys.exit(1)
+
+    print('Rebuild Complete')
+
+
+if __name__ == '__main__':
+    main()
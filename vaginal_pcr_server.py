@@ -0,0 +1,280 @@
+##<Usage: python vaginal_pcr_server.py [--host HOST] [--port PORT | --socket PATH] [--workers N] [--store DIR] [--shards FILE] [--cache DIR] [--panel FILE]>
+### ex) python vaginal_pcr_server.py --port 8350
+###     curl --data-binary @plate.xlsx "http://localhost:8350/analyze?name=plate.xlsx"
+
+import os, sys, json, time, shutil, asyncio, argparse, tempfile
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import urlsplit, parse_qs
+
+from vaginal_pcr_analysis import WriteLog, save_reference_histogram
+from vaginal_pcr_batch import analyze_plate
+from vaginal_pcr_stats import load_reference_stats, pin_reference_matrix
+from vaginal_pcr_shards import load_shard_config, open_pooled_reference
+from vaginal_pcr_cache import ResultCache
+from vaginal_pcr_panel import load_plan
+
+#-------------------------------------------------------
+# Long-lived analysis service
+#-------------------------------------------------------
+# The server keeps the reference statistics in memory and hands them to a pool of warm worker
+# processes, so a request only pays for parsing its plate. The store manifest is checked on every
+# request and the statistics are reloaded only when vaginal_pcr_update_reference.py changed it.
+# With them, the published matrix of the same version is pinned (hard-linked into the work directory);
+# every worker opens its percentile index once per version and keeps it across requests.
+# The reload runs in a thread, off the event loop, behind one lock - concurrent requests never load or
+# pin twice, and the pin of a previous version is removed only once no request in flight uses it.
+#
+#   POST /analyze?name=<file name>   body: plate export (.xlsx, .csv or .txt)
+#        -> {"plate", "n_sample", "seconds", "abundance", "eval", "mean_abundance"} (csv texts)
+#   GET  /health                     -> {"status", "store_version", "content_hash", "requests", "cache"}
+
+MAX_BODY = 64 << 20
+LI_OUTPUT = [('abundance', 'EGvaginal_abundance.csv'), ('eval', 'EGvaginal_eval.csv'), ('mean_abundance', 'EGvaginal_mean_abundance.csv')]
+
+
+def analyze_upload(data, filename, workdir, path_hist, dict_ref_stats, path_shards=None, path_cache=None, plan=None, path_matrix=None):
+    """
+    Worker side of /analyze - write the uploaded plate to a scratch directory and run the pipeline on it.
+
+    Returns:
+    Dictionary of the plate summary and its output csv texts.
+    """
+    dirpath = tempfile.mkdtemp(dir=workdir)
+    try:
+        path_exp = f"{dirpath}/{os.path.basename(filename)}"
+        with open(path_exp, 'wb') as f:
+            f.write(data)
+
+        plate = os.path.splitext(os.path.basename(filename))[0]
+        dict_result = analyze_plate(path_exp, plate, dirpath, path_hist, dict_ref_stats=dict_ref_stats, path_shards=path_shards, path_cache=path_cache, plan=plan,
+                                    path_matrix=path_matrix)
+
+        dict_response = {key: dict_result[key] for key in ['plate', 'n_sample', 'seconds', 'rv', 'rvmsg']}
+        if dict_result['rv']:
+            for key, name in LI_OUTPUT:
+                with open(f"{dirpath}/{plate}/{name}", encoding='utf-8-sig') as f:
+                    dict_response[key] = f.read()
+
+        return dict_response
+    finally:
+        shutil.rmtree(dirpath, ignore_errors=True)
+
+
+class VaginalPCRServer:
+    def __init__(self, workdir=None, max_workers=None, fplog=None, path_shards=None, path_cache=None, plan=None, path_db_store=None):
+        """
+        Initializes a VaginalPCRServer object.
+
+        Parameters:
+        workdir (str): Scratch directory of the uploads (default: a temporary directory).
+        max_workers (int): Number of worker processes (default: CPU count).
+        path_shards (str): Shard configuration - serve the pooled multi-site reference instead of input/EGvaginal_db.
+        path_cache (str): Result cache directory - re-submitted plates are answered from it.
+        plan (dict): Compiled target panel of the uploaded plates (default: the default panel).
+        path_db_store (str): Reference store to serve (default: input/EGvaginal_db); its legacy csv is <store>_abundance.csv.
+        """
+        self.__fplog = fplog
+
+        curdir = os.path.dirname(os.path.abspath(__file__))
+        self.path_db_store = path_db_store if path_db_store is not None else f"{curdir}/input/EGvaginal_db"
+        self.path_db = f"{self.path_db_store}_abundance.csv"
+        self.path_manifest = f"{self.path_db_store}/manifest.json"
+        self.path_shards = path_shards
+        self.path_cache = path_cache
+        self.plan = plan
+        self.li_path_manifest = [self.path_manifest] if path_shards is None else [f"{dict_shard['store']}/manifest.json" for dict_shard in load_shard_config(path_shards)]
+
+        self.workdir = workdir if workdir is not None else tempfile.mkdtemp(prefix='vaginal_pcr_server_')
+        self.path_hist = f"{self.workdir}/EGvaginal_abundance_hist.png"
+        self.max_workers = max_workers if max_workers is not None else os.cpu_count()
+        self.executor = ProcessPoolExecutor(max_workers=self.max_workers)
+
+        ## Warm reference statistics, the matrix of their version pinned for the workers and the manifest state they were loaded from
+        self.dict_ref_stats = None
+        self.path_matrix = None
+        self.manifest_mtime = None
+        self.n_request = 0
+
+        ## Serializes the reloads and the bookkeeping of the pins - {pinned matrix: requests in flight} and the pins of previous versions
+        self.reload_lock = asyncio.Lock()
+        self.dict_pin_request = {}
+        self.li_path_stale_pin = []
+
+    def ReloadReference(self):
+        """
+        Reload the reference statistics if the store manifest (of any shard) changed since the last load.
+        """
+        myNAME = self.__class__.__name__+"::"+sys._getframe().f_code.co_name
+
+        manifest_mtime = self.read_manifest_mtime()
+        if (self.dict_ref_stats is not None) and (manifest_mtime == self.manifest_mtime):
+            return False
+
+        if self.path_shards is not None:
+            dict_ref_stats, _ = open_pooled_reference(self.path_shards)
+        else:
+            dict_ref_stats, _ = load_reference_stats(self.path_db_store, self.path_db)
+        # The accumulator is only needed by the update script - keep the per-request payload small
+        self.dict_ref_stats = {key: value for key, value in dict_ref_stats.items() if key != 'accumulator'}
+        self.manifest_mtime = self.read_manifest_mtime()
+        save_reference_histogram(self.dict_ref_stats, self.path_hist)
+
+        # The previous pin stays until the requests submitted with it have finished
+        if self.path_shards is None:
+            path_prev = self.path_matrix
+            self.path_matrix = pin_reference_matrix(self.path_db_store, self.dict_ref_stats['content_hash'],
+                                                    f"{self.workdir}/reference_{self.dict_ref_stats['content_hash'][-16:]}.mat")
+            if (path_prev is not None) and (path_prev != self.path_matrix):
+                self.li_path_stale_pin.append(path_prev)
+            self.remove_stale_pins()
+
+        WriteLog(myNAME, f"Reference version {self.dict_ref_stats['store_version']} loaded ({self.dict_ref_stats['n_sample']} samples)", type='INFO', fplog=self.__fplog)
+
+        return True
+
+    def read_manifest_mtime(self):
+        return tuple(os.stat(path).st_mtime_ns if os.path.exists(path) else None for path in self.li_path_manifest)
+
+    def remove_stale_pins(self):
+        """
+        Remove the pins of previous versions that no request in flight uses - called with reload_lock held.
+        """
+        li_path_keep = []
+        for path in self.li_path_stale_pin:
+            if path == self.path_matrix:
+                continue
+            if self.dict_pin_request.get(path, 0) > 0:
+                li_path_keep.append(path)
+            elif os.path.exists(path):
+                os.remove(path)
+        self.li_path_stale_pin = li_path_keep
+
+    async def reload_reference(self):
+        """
+        ReloadReference in a thread of the event loop, so loading a new version does not stall the other connections.
+        """
+        async with self.reload_lock:
+            await asyncio.get_running_loop().run_in_executor(None, self.ReloadReference)
+
+    async def analyze(self, data, filename):
+        loop = asyncio.get_running_loop()
+
+        # The statistics and the pin of one version for this request - a reload during it does not remove the pin
+        async with self.reload_lock:
+            await loop.run_in_executor(None, self.ReloadReference)
+            dict_ref_stats, path_matrix = self.dict_ref_stats, self.path_matrix
+            self.dict_pin_request[path_matrix] = self.dict_pin_request.get(path_matrix, 0) + 1
+
+        try:
+            return await loop.run_in_executor(self.executor, analyze_upload, data, filename, self.workdir, self.path_hist, dict_ref_stats,
+                                              self.path_shards, self.path_cache, self.plan, path_matrix)
+        finally:
+            async with self.reload_lock:
+                self.dict_pin_request[path_matrix] -= 1
+                if self.dict_pin_request[path_matrix] == 0:
+                    del self.dict_pin_request[path_matrix]
+                self.remove_stale_pins()
+
+    async def handle(self, reader, writer):
+        status, dict_body = 200, None
+        try:
+            request_line = (await reader.readline()).decode('latin-1').strip()
+            if not request_line:
+                writer.close()
+                return
+            method, target = request_line.split(' ')[0:2]
+
+            dict_header = {}
+            while True:
+                line = (await reader.readline()).decode('latin-1').strip()
+                if not line:
+                    break
+                key, _, value = line.partition(':')
+                dict_header[key.strip().lower()] = value.strip()
+
+            url = urlsplit(target)
+            content_length = int(dict_header.get('content-length', 0))
+
+            if content_length > MAX_BODY:
+                status, dict_body = 413, {'error': 'Request body too large'}
+
+            elif (method == 'GET') and (url.path == '/health'):
+                await self.reload_reference()
+                dict_body = {'status': 'ok', 'store_version': self.dict_ref_stats['store_version'],
+                             'content_hash': self.dict_ref_stats['content_hash'], 'requests': self.n_request,
+                             'cache': ResultCache(self.path_cache).read_counters() if self.path_cache is not None else None}
+
+            elif (method == 'POST') and (url.path == '/analyze'):
+                data = await reader.readexactly(content_length)
+                filename = parse_qs(url.query).get('name', ['plate.xlsx'])[0]
+
+                start = time.perf_counter()
+                dict_body = await self.analyze(data, filename)
+                dict_body['latency'] = time.perf_counter() - start
+                self.n_request += 1
+
+                if not dict_body['rv']:
+                    status = 422
+
+            else:
+                status, dict_body = 404, {'error': f"Unknown endpoint {method} {url.path}"}
+
+        except Exception as e:
+            status, dict_body = 500, {'error': str(e)}
+
+        body = json.dumps(dict_body, ensure_ascii=False).encode('utf-8')
+        reason = {200: 'OK', 404: 'Not Found', 413: 'Payload Too Large', 422: 'Unprocessable Entity', 500: 'Internal Server Error'}[status]
+        writer.write(f"HTTP/1.1 {status} {reason}\r\nContent-Type: application/json; charset=utf-8\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode('latin-1') + body)
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def serve(self, host='127.0.0.1', port=8350, path_socket=None):
+        myNAME = self.__class__.__name__+"::"+sys._getframe().f_code.co_name
+
+        # Start the workers up front - the first request must not pay for the process start and imports.
+        # They are forked before the reload starts the thread of reload_reference, which a fork must not copy
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*[loop.run_in_executor(self.executor, os.getpid) for _ in range(self.max_workers)])
+
+        await self.reload_reference()
+
+        if path_socket is not None:
+            server = await asyncio.start_unix_server(self.handle, path=path_socket)
+            WriteLog(myNAME, f"Listening on {path_socket}", type='INFO', fplog=self.__fplog)
+        else:
+            server = await asyncio.start_server(self.handle, host=host, port=port)
+            WriteLog(myNAME, f"Listening on http://{host}:{port}", type='INFO', fplog=self.__fplog)
+
+        async with server:
+            await server.serve_forever()
+
+    def close(self):
+        self.executor.shutdown()
+
+
+####################################
+# main
+####################################
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Serve the PCR analysis over HTTP with a warm reference")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8350)
+    parser.add_argument('--socket', default=None, help="Listen on a Unix socket instead of TCP")
+    parser.add_argument('--workers', type=int, default=None, help="Number of worker processes (default: CPU count)")
+    parser.add_argument('--store', default=None, help="Reference store to serve (default: input/EGvaginal_db; --shards is used instead if given)")
+    parser.add_argument('--shards', default=None, help="Shard configuration of a pooled multi-site reference (json)")
+    parser.add_argument('--cache', default=None, help="Result cache directory - re-submitted plates are answered from it")
+    parser.add_argument('--panel', default=None, help="Target panel definition (json, see vaginal_pcr_panel.py; default: the EGvaginal panel)")
+    args = parser.parse_args()
+
+    vaginalpcrserver = VaginalPCRServer(max_workers=args.workers, path_shards=args.shards, path_cache=args.cache, plan=load_plan(args.panel),
+                                        path_db_store=os.path.abspath(args.store) if args.store is not None else None)
+    try:
+        asyncio.run(vaginalpcrserver.serve(host=args.host, port=args.port, path_socket=args.socket))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        vaginalpcrserver.close()
@@ -0,0 +1,192 @@
+##<Usage: python vaginal_pcr_shards.py {shards.json} [--workers N]>
+### ex) python vaginal_pcr_shards.py "/home/kbkim/vaginal_pcr/input/EGvaginal_shards.json"
+
+import os, json, hashlib, argparse
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+from vaginal_pcr_stats import LI_GROUP_TOTAL, ReferenceAccumulator, load_percentile_index, open_reference_snapshot, rank_to_percentile
+from vaginal_pcr_store import legacy_content_hash
+
+#-------------------------------------------------------
+# Sharded multi-site reference
+#-------------------------------------------------------
+# Every site (or month) keeps its own reference store, updated with vaginal_pcr_update_reference.py --store.
+# The pooled cohort is never materialized: each shard contributes its partial aggregates - the exact
+# running sums, sample count and histogram bin counts of its statistics snapshot - computed in parallel
+# and reduced by integer addition, so the pooled means and distributions are bit-identical to those of
+# one store holding every sample. Percentile ranks add the rank counts of the shards' sorted columns.
+# A sample ID present in two shards counts twice - shards are expected to hold disjoint cohorts.
+#
+# Shard configuration (paths relative to the file):
+#   {"shards": [{"name": "site_a", "store": "site_a/EGvaginal_db", "csv": "site_a/EGvaginal_db_abundance.csv"}, ...]}
+# "csv" is optional; it is the legacy reference the store is migrated from on first use.
+
+
+def load_shard_config(path_config):
+    """
+    Read the shard configuration.
+
+    Returns:
+    List of shard dictionaries {name, store, csv} with absolute paths.
+    """
+    with open(path_config, encoding='utf-8') as f:
+        dict_config = json.load(f)
+
+    dirpath = os.path.dirname(os.path.abspath(path_config))
+    li_shard = []
+    for dict_shard in dict_config['shards']:
+        path_store = os.path.join(dirpath, dict_shard['store'])
+        path_csv = os.path.join(dirpath, dict_shard['csv']) if dict_shard.get('csv') else f"{path_store}_abundance.csv"
+        li_shard.append({'name': dict_shard.get('name', os.path.basename(path_store)), 'store': path_store, 'csv': path_csv})
+
+    if len(set(dict_shard['name'] for dict_shard in li_shard)) != len(li_shard):
+        raise ValueError(f"Shard names must be unique: {path_config}")
+
+    return li_shard
+
+
+def compute_shard_partial(dict_shard):
+    """
+    Map step - the partial aggregates of one shard: its statistics snapshot, recomputed if it is stale.
+
+    Returns:
+    Dictionary with the shard name, version, content hash and the accumulator (sums, count, histogram bins).
+    """
+    dict_stats, _, _ = open_reference_snapshot(dict_shard['store'], dict_shard['csv'])
+
+    return {'name': dict_shard['name'], 'store_version': dict_stats['store_version'], 'content_hash': dict_stats['content_hash'],
+            'n_sample': dict_stats['n_sample'], 'accumulator': dict_stats['accumulator']}
+
+
+def pooled_content_hash(li_name_hash):
+    """
+    Content hash of the pooled reference, from the (name, content hash) pairs of the shards in configuration order.
+    """
+    h = hashlib.sha256()
+    for name, content_hash in li_name_hash:
+        h.update(f"{name}:{content_hash}\n".encode('utf-8'))
+
+    return h.hexdigest()
+
+
+def read_pooled_content_hash(path_config):
+    """
+    Content hash of the pooled reference from the shard manifests alone (the hash of the legacy csv of a shard without a
+    store), or None if a shard has neither.
+    """
+    li_name_hash = []
+    for dict_shard in load_shard_config(path_config):
+        path_manifest = f"{dict_shard['store']}/manifest.json"
+        if os.path.exists(path_manifest):
+            with open(path_manifest, encoding='utf-8') as f:
+                li_name_hash.append((dict_shard['name'], json.load(f)['content_hash']))
+        elif os.path.exists(dict_shard['csv']):
+            li_name_hash.append((dict_shard['name'], legacy_content_hash(dict_shard['csv'])))
+        else:
+            return None
+
+    return pooled_content_hash(li_name_hash)
+
+
+def reduce_partials(li_partial):
+    """
+    Reduce step - pooled reference statistics of the shards, in the format of a store snapshot.
+
+    Returns:
+    Dictionary of the reference statistics, with the per-shard versions under 'shards'.
+    """
+    acc = None
+    for dict_partial in li_partial:
+        acc_shard = ReferenceAccumulator.from_dict(dict_partial['accumulator'])
+        acc = acc_shard if acc is None else acc.merge(acc_shard)
+
+    if acc is None:
+        raise ValueError("No reference shards")
+
+    # Pooled version key - changes whenever any shard changes
+    content_hash = pooled_content_hash([(dict_partial['name'], dict_partial['content_hash']) for dict_partial in li_partial])
+    manifest = {'content_hash': content_hash, 'version': sum(dict_partial['store_version'] for dict_partial in li_partial)}
+
+    dict_stats = acc.to_stats(manifest)
+    dict_stats['shards'] = [{key: dict_partial[key] for key in ['name', 'store_version', 'content_hash', 'n_sample']} for dict_partial in li_partial]
+
+    return dict_stats
+
+
+class ShardedPercentileIndex:
+    def __init__(self, li_index):
+        """
+        Percentile ranks within the pooled cohort of several shards, from the shards' own sorted columns.
+
+        Parameters:
+        li_index (list): PercentileIndex of every shard.
+        """
+        self.li_index = li_index
+
+    def percentile(self, col, arr_value):
+        arr_left, arr_right = 0, 0
+        for index in self.li_index:
+            arr_shard_left, arr_shard_right = index.rank_counts(col, arr_value)
+            arr_left = arr_left + arr_shard_left
+            arr_right = arr_right + arr_shard_right
+
+        return rank_to_percentile(np.asarray(arr_left), np.asarray(arr_right), sum(index.n_sample() for index in self.li_index), arr_value)
+
+
+def open_sharded_percentile_index(path_config, dict_stats=None):
+    """
+    ShardedPercentileIndex of a shard configuration, memory-mapping the sorted columns of every shard.
+
+    Parameters:
+    dict_stats (dict): Pooled statistics; the sorted columns are then taken from the same shard versions when published.
+    """
+    li_shard = load_shard_config(path_config)
+    dict_content_hash = {} if dict_stats is None else {dict_shard['name']: dict_shard['content_hash'] for dict_shard in dict_stats['shards']}
+
+    return ShardedPercentileIndex([load_percentile_index(dict_shard['store'], dict_shard['csv'], dict_content_hash.get(dict_shard['name']))
+                                   for dict_shard in li_shard])
+
+
+def open_pooled_reference(path_config, max_workers=None):
+    """
+    Pooled reference of a shard configuration: shard partials computed in parallel and reduced.
+
+    Parameters:
+    path_config (str): Shard configuration file.
+    max_workers (int): Worker processes for the shard partials (default: one per shard, at most the CPU count).
+
+    Returns:
+    A tuple (dict_stats, percentile_index) - the pooled statistics and a ShardedPercentileIndex.
+    """
+    li_shard = load_shard_config(path_config)
+    max_workers = max_workers if max_workers is not None else min(len(li_shard), os.cpu_count())
+
+    if max_workers > 1:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            li_partial = list(executor.map(compute_shard_partial, li_shard))
+    else:
+        li_partial = [compute_shard_partial(dict_shard) for dict_shard in li_shard]
+
+    dict_stats = reduce_partials(li_partial)
+
+    return dict_stats, open_sharded_percentile_index(path_config, dict_stats)
+
+
+####################################
+# main
+####################################
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Pooled statistics of a sharded reference")
+    parser.add_argument('config', help="Shard configuration file (json)")
+    parser.add_argument('--workers', type=int, default=None, help="Worker processes (default: one per shard)")
+    args = parser.parse_args()
+
+    dict_stats, _ = open_pooled_reference(args.config, max_workers=args.workers)
+
+    for dict_shard in dict_stats['shards']:
+        print(f"{dict_shard['name']}: version {dict_shard['store_version']}, {dict_shard['n_sample']} samples")
+    print(f"Pooled: {dict_stats['n_sample']} samples")
+    for col in LI_GROUP_TOTAL:
+        print(f"{col}: mean {dict_stats['mean_group_total'][col]}, histogram {dict_stats['histogram'][col]}")
@@ -0,0 +1,448 @@
+import os, json, math
+import numpy as np
+
+from vaginal_pcr_engine import LI_BENEFICIAL, LI_GROUP_TOTAL, LI_HARMFUL, calculate_group_total
+from vaginal_pcr_store import (MATRIX_FORMAT, ReferenceMatrix, ReferenceStore, open_reference_matrix, read_legacy_reference, read_matrix_header,
+                               sort_reference_columns, store_groups, write_json_atomic)
+
+#-------------------------------------------------------
+# Reference statistics snapshot
+#-------------------------------------------------------
+# The analysis only needs a handful of numbers from the reference cohort: the per-taxon means,
+# the means of the beneficial/harmful totals and their 0-20-40-60-80-100 histograms.
+# vaginal_pcr_update_reference.py writes them to stats.json next to the store manifest,
+# keyed by the store content hash; a snapshot with another hash is stale.
+#
+# Means and histograms are derived from running sums and counts (ReferenceAccumulator), which the
+# update script maintains per plate instead of rescanning the reference. The sums are kept exactly,
+# so an incremental update and a full recompute give bit-identical statistics.
+
+SNAPSHOT_VERSION = 2
+HIST_BINS = [0, 20, 40, 60, 80, 100]
+
+# Every finite float64 is an integer multiple of 2**-1074
+EXACT_SCALE = 1074
+
+
+def exact_sum(arr):
+    """
+    Exact sum of float64 values, as an integer multiple of 2**-EXACT_SCALE. math.fsum gives the correctly rounded
+    sum; its rounding error is summed again until nothing is left, so a column costs a few passes in C.
+    """
+    li_x = np.asarray(arr, dtype=float).tolist()
+
+    total = 0
+    part = math.fsum(li_x)
+    while part != 0:
+        num, den = part.as_integer_ratio()
+        total += num << (EXACT_SCALE - den.bit_length() + 1)
+        li_x.append(-part)
+        part = math.fsum(li_x)
+
+    return total
+
+
+def exact_mean(total, n_sample):
+    # int / int true division is correctly rounded in Python
+    return total / (n_sample << EXACT_SCALE) if n_sample > 0 else float('nan')
+
+
+def calculate_histogram_count(data):
+    """
+    Number of samples per histogram bin (values outside 0-100 fall in no bin).
+    """
+    return np.histogram(np.asarray(data, dtype=float), bins=HIST_BINS)[0]
+
+
+def format_distribution(li_distribution):
+    return ','.join(str(x) for x in li_distribution)
+
+
+class ReferenceAccumulator:
+    def __init__(self, li_taxa, li_beneficial=LI_BENEFICIAL, li_harmful=LI_HARMFUL):
+        """
+        Initializes an empty ReferenceAccumulator.
+
+        Parameters:
+        li_taxa (list): Taxa of the reference, in column order.
+        li_beneficial (list): Taxa summed into beneficial_total[%].
+        li_harmful (list): Taxa summed into harmful_total[%].
+        """
+        self.li_taxa = list(li_taxa)
+        self.li_beneficial = list(li_beneficial)
+        self.li_harmful = list(li_harmful)
+
+        self.n_sample = 0
+        self.dict_sum = {col: 0 for col in self.li_taxa + LI_GROUP_TOTAL}
+        self.dict_hist_count = {col: [0]*(len(HIST_BINS) - 1) for col in LI_GROUP_TOTAL}
+
+    def update(self, df_abundance, sign):
+        dict_group_total = dict(zip(LI_GROUP_TOTAL, calculate_group_total(df_abundance, self.li_beneficial, self.li_harmful)))
+
+        self.n_sample += sign*len(df_abundance)
+        for taxon in self.li_taxa:
+            self.dict_sum[taxon] += sign*exact_sum(df_abundance[taxon])
+        for col in LI_GROUP_TOTAL:
+            self.dict_sum[col] += sign*exact_sum(dict_group_total[col])
+            self.dict_hist_count[col] = [count + sign*int(x) for count, x in zip(self.dict_hist_count[col], calculate_histogram_count(dict_group_total[col]))]
+
+        return self
+
+    def add(self, df_abundance):
+        """
+        Add the (sample x taxa) rows of df_abundance to the running sums and counts.
+        """
+        return self.update(df_abundance, 1)
+
+    def remove(self, df_abundance):
+        """
+        Remove rows that were added before, e.g. the previous values of a re-run sample.
+        """
+        return self.update(df_abundance, -1)
+
+    def merge(self, other):
+        """
+        Add the sums and counts of another accumulator over the same taxa, e.g. of another reference shard.
+        """
+        if (other.li_taxa, other.li_beneficial, other.li_harmful) != (self.li_taxa, self.li_beneficial, self.li_harmful):
+            raise ValueError("Reference accumulators of different taxa cannot be merged")
+
+        self.n_sample += other.n_sample
+        for col in self.dict_sum:
+            self.dict_sum[col] += other.dict_sum[col]
+        for col in self.dict_hist_count:
+            self.dict_hist_count[col] = [count + x for count, x in zip(self.dict_hist_count[col], other.dict_hist_count[col])]
+
+        return self
+
+    def to_dict(self):
+        return {'taxa': self.li_taxa, 'beneficial': self.li_beneficial, 'harmful': self.li_harmful,
+                'n_sample': self.n_sample, 'sum': self.dict_sum, 'hist_count': self.dict_hist_count}
+
+    @classmethod
+    def from_dict(cls, dict_acc):
+        acc = cls(dict_acc['taxa'], dict_acc['beneficial'], dict_acc['harmful'])
+        acc.n_sample = dict_acc['n_sample']
+        acc.dict_sum = {col: int(x) for col, x in dict_acc['sum'].items()}
+        acc.dict_hist_count = {col: [int(x) for x in li] for col, li in dict_acc['hist_count'].items()}
+
+        return acc
+
+    def to_stats(self, manifest=None):
+        """
+        Derive the statistics snapshot from the running sums and counts.
+        """
+        dict_stats = {
+            'snapshot_version': SNAPSHOT_VERSION,
+            'content_hash': None if manifest is None else manifest['content_hash'],
+            'store_version': None if manifest is None else manifest['version'],
+            'n_sample': self.n_sample,
+            'mean_abundance': {taxon: exact_mean(self.dict_sum[taxon], self.n_sample) for taxon in self.li_taxa},
+            'mean_group_total': {col: exact_mean(self.dict_sum[col], self.n_sample) for col in LI_GROUP_TOTAL},
+            'histogram': {col: [count*100 / self.n_sample if self.n_sample > 0 else 0.0 for count in self.dict_hist_count[col]] for col in LI_GROUP_TOTAL},
+            'accumulator': self.to_dict(),
+        }
+
+        return dict_stats
+
+
+def compute_reference_stats(df_db, manifest=None, li_beneficial=None, li_harmful=None):
+    """
+    Full recompute of the reference statistics from the (sample x taxa) reference DB.
+
+    Parameters:
+    df_db (DataFrame): Reference DB, one row per sample.
+    manifest (dict): Store manifest the DB was loaded from, used to key the snapshot.
+    li_beneficial (list), li_harmful (list): Taxa of the group totals (default: the groups of the manifest).
+
+    Returns:
+    Dictionary of the reference statistics.
+    """
+    li_store_beneficial, li_store_harmful = store_groups(manifest) if manifest is not None else (LI_BENEFICIAL, LI_HARMFUL)
+    li_beneficial = li_store_beneficial if li_beneficial is None else li_beneficial
+    li_harmful = li_store_harmful if li_harmful is None else li_harmful
+
+    acc = ReferenceAccumulator(df_db.columns.to_list(), li_beneficial, li_harmful).add(df_db)
+
+    return acc.to_stats(manifest)
+
+
+def compare_reference_stats(dict_stats, dict_expected):
+    """
+    Compare two statistics snapshots.
+
+    Returns:
+    List of the keys whose values differ, empty if they match.
+    """
+    li_mismatch = []
+    for key in ['n_sample', 'mean_abundance', 'mean_group_total', 'histogram']:
+        if dict_stats[key] != dict_expected[key]:
+            li_mismatch.append(key)
+
+    return li_mismatch
+
+
+def write_stats_snapshot(path_stats, dict_stats):
+    write_json_atomic(path_stats, dict_stats)
+
+
+def load_stats_snapshot(path_stats, content_hash):
+    """
+    Load the statistics snapshot.
+
+    Returns:
+    The statistics dictionary, or None if the snapshot is missing, of another format, or stale for content_hash.
+    """
+    if not os.path.exists(path_stats):
+        return None
+
+    with open(path_stats, encoding='utf-8') as f:
+        dict_stats = json.load(f)
+
+    if (dict_stats.get('snapshot_version') != SNAPSHOT_VERSION) | (dict_stats.get('content_hash') != content_hash):
+        return None
+
+    return dict_stats
+
+
+# Legacy csv references read by this process, by path: (size, mtime, df_db, manifest, dict_stats, percentile index)
+dict_legacy_reference = {}
+
+
+def open_legacy_reference(path_store, path_csv):
+    """
+    The legacy csv reference of an install without a store (see read_legacy_reference) and its statistics. They are
+    kept for the process while the file keeps its size and mtime, so a server or batch worker reads the csv once.
+
+    Returns:
+    A tuple (df_db, manifest, dict_stats).
+    """
+    if not os.path.exists(path_csv):
+        raise FileNotFoundError(f"No reference store at {path_store} and no legacy reference {path_csv} - create the store with update-ref or rebuild-ref")
+
+    stat = os.stat(path_csv)
+    key = os.path.abspath(path_csv)
+    legacy = dict_legacy_reference.get(key)
+    if (legacy is None) or (legacy['size'], legacy['mtime']) != (stat.st_size, stat.st_mtime_ns):
+        df_db, manifest = read_legacy_reference(path_csv)
+        legacy = {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'df_db': df_db, 'manifest': manifest,
+                  'dict_stats': compute_reference_stats(df_db, manifest), 'percentile_index': None}
+        dict_legacy_reference[key] = legacy
+
+    return legacy['df_db'], legacy['manifest'], legacy['dict_stats']
+
+
+def open_reference_snapshot(path_store, path_csv):
+    """
+    Pin one consistent version of the reference: the manifest, its statistics snapshot and its published matrix.
+    These are atomically replaced files, read without a lock. If the snapshot or the matrix does not match the
+    manifest - stale, missing, or an update is between its writes - they are read again under a shared lock,
+    which waits for a running update, and whatever is still missing is recomputed from the segments. Before the
+    first update has migrated it, the legacy csv is read as the reference; nothing is written.
+
+    Parameters:
+    path_store (str): Directory of the reference store.
+    path_csv (str): Legacy reference csv, read while the store does not exist.
+
+    Returns:
+    A tuple (dict_stats, df_db, refmatrix). df_db is the loaded reference if it had to be read, else None;
+    refmatrix is the memory-mapped matrix of the same version, or None if it is not published.
+    """
+    refstore = ReferenceStore(path_store)
+    if not refstore.exists():
+        df_db, _, dict_stats = open_legacy_reference(path_store, path_csv)
+        return dict_stats, df_db, None
+
+    def read_published():
+        manifest = refstore.read_manifest()
+        dict_stats = load_stats_snapshot(f"{path_store}/stats.json", manifest['content_hash'])
+        refmatrix = open_reference_matrix(path_store, manifest['content_hash'])
+        return manifest, dict_stats, refmatrix
+
+    manifest, dict_stats, refmatrix = read_published()
+    df_db = None
+
+    if (dict_stats is None) or (refmatrix is None):
+        with refstore.lock(shared=True):
+            manifest, dict_stats, refmatrix = read_published()
+
+            if dict_stats is None:
+                # The published matrix is memory-mapped; the segments are only read when it is missing or stale
+                df_db = refmatrix.to_frame() if refmatrix is not None else refstore.load(manifest)
+                dict_stats = compute_reference_stats(df_db, manifest)
+
+    return dict_stats, df_db, refmatrix
+
+
+def load_reference_stats(path_store, path_csv):
+    """
+    Statistics of the current reference: the snapshot if it is up to date, a full recompute otherwise.
+
+    Parameters:
+    path_store (str): Directory of the reference store.
+    path_csv (str): Legacy reference csv, read while the store does not exist.
+
+    Returns:
+    A tuple (dict_stats, df_db), where df_db is the loaded reference if it had to be recomputed, else None.
+    """
+    dict_stats, df_db, _ = open_reference_snapshot(path_store, path_csv)
+
+    return dict_stats, df_db
+
+
+#-------------------------------------------------------
+# Percentile ranks against the reference cohort
+#-------------------------------------------------------
+# Every reference column is kept sorted (the sorted section of reference.mat, written by the update
+# script), so the rank of a whole plate is two np.searchsorted calls per column instead of a scan of
+# the reference per value.
+def rank_counts(arr_sorted, arr_value):
+    """
+    Number of reference values below (left) and not above (right) each value. Counts of several
+    sorted columns - e.g. reference shards - add up to the counts of the pooled column.
+
+    Returns:
+    A tuple (arr_left, arr_right).
+    """
+    arr_value = np.asarray(arr_value, dtype=float)
+
+    return np.searchsorted(arr_sorted, arr_value, side='left'), np.searchsorted(arr_sorted, arr_value, side='right')
+
+
+def rank_to_percentile(arr_left, arr_right, n_sample, arr_value):
+    """
+    Percentiles from the rank counts, as scipy.stats.percentileofscore(kind='rank'); NaN for NaN values or an empty reference.
+    """
+    if n_sample == 0:
+        return np.full(len(arr_left), np.nan)
+
+    arr_percentile = (arr_left + arr_right + (arr_left < arr_right)) * (50.0 / n_sample)
+    arr_percentile[np.isnan(np.asarray(arr_value, dtype=float))] = np.nan
+
+    return arr_percentile
+
+
+def percentile_rank(arr_sorted, arr_value):
+    """
+    Percentile ranks of values within a sorted reference column, as scipy.stats.percentileofscore(kind='rank').
+
+    Parameters:
+    arr_sorted (ndarray): Reference values, ascending.
+    arr_value (array-like): Values to rank.
+
+    Returns:
+    ndarray of percentiles (0-100); NaN for NaN values or an empty reference.
+    """
+    arr_left, arr_right = rank_counts(arr_sorted, arr_value)
+
+    return rank_to_percentile(arr_left, arr_right, len(arr_sorted), arr_value)
+
+
+class PercentileIndex:
+    def __init__(self, li_column, arr_sorted):
+        """
+        Initializes a PercentileIndex object.
+
+        Parameters:
+        li_column (list): Reference columns (taxa and beneficial/harmful totals).
+        arr_sorted (ndarray): One ascending row per column, usually memory-mapped from reference.mat.
+        """
+        self.li_column = list(li_column)
+        self.arr_sorted = arr_sorted
+
+    @classmethod
+    def from_matrix(cls, refmatrix):
+        return cls(refmatrix.li_sorted_column, refmatrix.arr_sorted)
+
+    @classmethod
+    def from_frame(cls, df_db, li_beneficial=LI_BENEFICIAL, li_harmful=LI_HARMFUL):
+        return cls(*sort_reference_columns(df_db, df_db.columns.to_list(), li_beneficial, li_harmful))
+
+    def rank_counts(self, col, arr_value):
+        return rank_counts(self.arr_sorted[self.li_column.index(col)], arr_value)
+
+    def n_sample(self):
+        return self.arr_sorted.shape[1]
+
+    def percentile(self, col, arr_value):
+        return percentile_rank(self.arr_sorted[self.li_column.index(col)], arr_value)
+
+
+class ReferenceVersionError(ValueError):
+    """
+    The reference moved on from the version the statistics were pinned to.
+    """
+
+
+def load_percentile_index(path_store, path_csv, content_hash=None, df_db=None):
+    """
+    Percentile index of the reference version content_hash - the one the statistics were pinned to: the sorted columns
+    of reference.mat if it is published for that version, otherwise sorted from df_db (the reference the statistics were
+    computed from), or from the store while it still holds that version. Without content_hash, of the current reference.
+
+    Raises:
+    ReferenceVersionError if the store no longer holds content_hash - percentiles of another version are never
+    paired with the statistics; the caller reloads both (or fails).
+    """
+    refmatrix = open_reference_matrix(path_store, content_hash)
+    if refmatrix is not None:
+        return PercentileIndex.from_matrix(refmatrix)
+
+    refstore = ReferenceStore(path_store)
+    if not refstore.exists():
+        # Legacy csv - sorted once per process, like its statistics
+        _, manifest, _ = open_legacy_reference(path_store, path_csv)
+        legacy = dict_legacy_reference[os.path.abspath(path_csv)]
+        if (content_hash is not None) and (manifest['content_hash'] != content_hash):
+            raise ReferenceVersionError(f"The reference {path_csv} changed since its statistics were loaded - reload them")
+        if legacy['percentile_index'] is None:
+            legacy['percentile_index'] = PercentileIndex.from_frame(legacy['df_db'])
+        return legacy['percentile_index']
+
+    if df_db is not None:
+        # Stores without groups use the default ones
+        return PercentileIndex.from_frame(df_db, *store_groups(refstore.read_manifest()))
+
+    with refstore.lock(shared=True):
+        manifest = refstore.read_manifest()
+        if (content_hash is None) or (manifest['content_hash'] == content_hash):
+            df_db = refstore.load(manifest)
+
+    if (content_hash is not None) and (manifest['content_hash'] != content_hash):
+        raise ReferenceVersionError(f"The reference {path_store} changed since its statistics were loaded (version {manifest['version']} now) - reload them")
+
+    return PercentileIndex.from_frame(df_db, *store_groups(manifest))
+
+
+def pin_reference_matrix(path_store, content_hash, path_pin):
+    """
+    Hard-link the published matrix of the version content_hash to path_pin. Updates replace reference.mat by a rename,
+    so the pinned link keeps that version readable for the processes a batch or the server starts later.
+
+    Returns:
+    path_pin, or None if the matrix of that version is not published or cannot be linked (e.g. another file system).
+    """
+    try:
+        if os.path.lexists(path_pin):
+            os.remove(path_pin)
+        os.link(f"{path_store}/reference.mat", path_pin)
+    except OSError:
+        return None
+
+    dict_header = read_matrix_header(path_pin)
+    if (dict_header.get('format') != MATRIX_FORMAT) or (dict_header['content_hash'] != content_hash):
+        os.remove(path_pin)
+        return None
+
+    return path_pin
+
+
+def open_pinned_matrix(path_pin, content_hash):
+    """
+    PercentileIndex of a matrix pinned by pin_reference_matrix, checked against content_hash.
+    """
+    refmatrix = ReferenceMatrix(path_pin)
+    if refmatrix.content_hash != content_hash:
+        raise ReferenceVersionError(f"Pinned reference matrix {path_pin} is not of the loaded statistics")
+
+    return PercentileIndex.from_matrix(refmatrix)
@@ -0,0 +1,838 @@
+import os, sys, json, fcntl, hashlib
+import numpy as np
+import pandas as pd
+
+from vaginal_pcr_engine import LI_BENEFICIAL, LI_GROUP_TOTAL, LI_HARMFUL, LI_MICROBIOME, calculate_group_total
+
+#-------------------------------------------------------
+# Append-only reference store
+#-------------------------------------------------------
+# Layout of a store directory:
+#   manifest.json       taxa order, version, content hash and the ordered list of segments
+#   seg_000001.npy      float64 (sample x taxa) matrix of one ingest
+#   seg_000001.ids      sample IDs of the rows above, one per line
+#   reference.mat       the current reference as one memory-mappable matrix (see write_reference_matrix)
+#   registry.idx        sorted hashes of the sample IDs, for membership tests (see SampleRegistry)
+# Segments are never rewritten, only added (or merged by compact()).
+# When a sample ID occurs in more than one segment, the latest row wins.
+# Segments merged away by compact() or rewrite() are listed as 'retired' in the manifest and kept until the
+# next compaction, so a reader still holding the previous manifest can load them.
+#
+# Every file is written to a temporary name, fsynced and renamed into place, and the manifest is
+# replaced last, so its 'version' only ever grows and names a complete state. Writers serialize on
+# an advisory lock (.lock, see lock()); readers pin one manifest and the files it names.
+
+STORE_FORMAT = 1
+COMPACT_SEGMENTS = 32
+
+
+def fsync_dir(path_dir):
+    """
+    fsync a directory, so a rename inside it survives a crash.
+    """
+    fd = os.open(path_dir, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def write_json_atomic(path, obj):
+    """
+    Write a JSON file through a temporary file, fsync and os.replace, so readers never see a partial file.
+    """
+    path_tmp = f"{path}.{os.getpid()}.tmp"
+    with open(path_tmp, 'w', encoding='utf-8') as f:
+        json.dump(obj, f, ensure_ascii=False, indent=1)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path_tmp, path)
+    fsync_dir(os.path.dirname(os.path.abspath(path)))
+
+
+class StoreLock:
+    def __init__(self, path_lock, shared=False):
+        """
+        Advisory lock (flock) of a reference store. Writers hold it exclusively for a whole update;
+        readers take it shared only when they have to read segments or wait for an update to finish.
+
+        Parameters:
+        path_lock (str): Path of the lock file.
+        shared (bool): Take a shared instead of an exclusive lock.
+        """
+        self.path_lock = path_lock
+        self.shared = shared
+        self.f = None
+
+    def acquire(self):
+        if self.f is None:
+            os.makedirs(os.path.dirname(self.path_lock), exist_ok=True)
+            self.f = open(self.path_lock, 'a')
+            fcntl.flock(self.f.fileno(), fcntl.LOCK_SH if self.shared else fcntl.LOCK_EX)
+
+        return self
+
+    def release(self):
+        if self.f is not None:
+            fcntl.flock(self.f.fileno(), fcntl.LOCK_UN)
+            self.f.close()
+            self.f = None
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+
+def hash_file(path, h):
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+
+    return h
+
+
+class ReferenceStore:
+    def __init__(self, path_store):
+        """
+        Initializes a ReferenceStore object.
+
+        Parameters:
+        path_store (str): Directory of the sample-major reference store.
+        """
+        self.path_store = path_store
+        self.path_manifest = f"{path_store}/manifest.json"
+
+    def exists(self):
+        return os.path.exists(self.path_manifest)
+
+    def create(self, li_taxa, dict_group=None):
+        """
+        Create an empty store for the given taxa order.
+
+        Parameters:
+        li_taxa (list): Taxa of the reference, in column order.
+        dict_group (dict): Beneficial and harmful taxa of the panel, {'beneficial': [...], 'harmful': [...]};
+                           stores without groups use LI_BENEFICIAL / LI_HARMFUL.
+        """
+        os.makedirs(self.path_store, exist_ok=True)
+        manifest = {'format': STORE_FORMAT, 'version': 0, 'taxa': list(li_taxa), 'segments': [], 'next_segment': 1}
+        if dict_group is not None:
+            manifest['groups'] = {'beneficial': list(dict_group['beneficial']), 'harmful': list(dict_group['harmful'])}
+        manifest['content_hash'] = self.content_hash(manifest)
+        write_json_atomic(self.path_manifest, manifest)
+
+        return manifest
+
+    def read_manifest(self):
+        with open(self.path_manifest, encoding='utf-8') as f:
+            manifest = json.load(f)
+
+        if manifest.get('format') != STORE_FORMAT:
+            raise ValueError(f"Unsupported reference store format: {manifest.get('format')}")
+
+        # Stores written before content hashing - hash once in memory, persisted by the next write
+        if 'content_hash' not in manifest:
+            for segment in manifest['segments']:
+                segment.setdefault('sha256', self.segment_hash(segment['name']))
+            manifest['content_hash'] = self.content_hash(manifest)
+
+        return manifest
+
+    def read_segment(self, name, mmap_mode=None):
+        """
+        Read one segment.
+
+        Returns:
+        A tuple (li_sample_name, arr_abundance).
+        """
+        with open(f"{self.path_store}/{name}.ids", encoding='utf-8') as f:
+            li_sample_name = f.read().splitlines()
+        arr_abundance = np.load(f"{self.path_store}/{name}.npy", mmap_mode=mmap_mode)
+
+        return li_sample_name, arr_abundance
+
+    def segment_hash(self, name):
+        """
+        sha256 of one segment's ids and matrix files. Segments are immutable, so this is computed once at write time.
+        """
+        h = hashlib.sha256()
+        hash_file(f"{self.path_store}/{name}.ids", h)
+        hash_file(f"{self.path_store}/{name}.npy", h)
+
+        return h.hexdigest()
+
+    def content_hash(self, manifest):
+        """
+        Content hash of the whole reference, derived from the taxa order and the per-segment hashes.
+        """
+        h = hashlib.sha256(json.dumps(manifest['taxa']).encode('utf-8'))
+        for segment in manifest['segments']:
+            h.update(segment['sha256'].encode('ascii'))
+
+        return h.hexdigest()
+
+    def sample_ids(self, manifest=None):
+        """
+        Return the set of sample IDs in the store without loading any abundance data.
+        """
+        if manifest is None:
+            manifest = self.read_manifest()
+
+        set_sample_name = set()
+        for segment in manifest['segments']:
+            with open(f"{self.path_store}/{segment['name']}.ids", encoding='utf-8') as f:
+                set_sample_name.update(f.read().splitlines())
+
+        return set_sample_name
+
+    def lookup(self, li_sample_name, manifest=None):
+        """
+        Current (latest) rows of the given samples. They are found by a binary search of the sample-ID keys of the
+        published matrix when it belongs to manifest - O(looked-up samples) - and otherwise by a vectorized
+        membership test of every segment's IDs, memory-mapping only the rows found.
+
+        Returns:
+        (sample x taxa) DataFrame of the samples found in the store, in the order of li_sample_name.
+        """
+        if manifest is None:
+            manifest = self.read_manifest()
+
+        li_sample_name = list(li_sample_name)
+        refmatrix = open_reference_matrix(self.path_store, manifest['content_hash'])
+
+        if refmatrix is not None:
+            arr_row = refmatrix.find_rows(li_sample_name)
+            arr_found = arr_row >= 0
+            li_found = [sample_name for sample_name, found in zip(li_sample_name, arr_found) if found]
+            arr_abundance = np.asarray(refmatrix.arr_abundance[arr_row[arr_found]], dtype=np.float64).reshape(len(li_found), len(manifest['taxa']))
+        else:
+            arr_lookup = np.array([str(sample_name) for sample_name in li_sample_name], dtype=str)
+            li_ids = []
+            li_arr = []
+            for segment in manifest['segments']:
+                li_segment_sample, arr_segment = self.read_segment(segment['name'], mmap_mode='r')
+                arr_idx = np.flatnonzero(np.isin(np.array(li_segment_sample, dtype=str), arr_lookup))
+                li_ids.extend(li_segment_sample[idx] for idx in arr_idx)
+                li_arr.append(np.asarray(arr_segment[arr_idx], dtype=np.float64))
+
+            # The latest row of a sample wins, as in load()
+            idx_ids = pd.Index(li_ids)
+            arr_abundance = np.concatenate(li_arr, axis=0) if li_arr else np.empty((0, len(manifest['taxa'])))
+            arr_keep = ~idx_ids.duplicated(keep='last')
+            sr_row = pd.Series(np.arange(len(idx_ids))[arr_keep], index=idx_ids[arr_keep])
+
+            li_found = [sample_name for sample_name in li_sample_name if sample_name in sr_row.index]
+            arr_abundance = arr_abundance[sr_row.reindex(li_found).to_numpy(dtype=np.int64)].reshape(len(li_found), len(manifest['taxa']))
+
+        return pd.DataFrame(arr_abundance, index=pd.Index(li_found, name='serial_number'), columns=manifest['taxa'])
+
+    def load(self, manifest=None):
+        """
+        Load the store as a (sample x taxa) DataFrame, without transposing.
+        """
+        if manifest is None:
+            manifest = self.read_manifest()
+
+        li_sample_name = []
+        li_arr = []
+        for segment in manifest['segments']:
+            li_segment_sample, arr_segment = self.read_segment(segment['name'])
+            li_sample_name.extend(li_segment_sample)
+            li_arr.append(arr_segment)
+
+        if li_arr:
+            arr_abundance = np.concatenate(li_arr, axis=0)
+        else:
+            arr_abundance = np.empty((0, len(manifest['taxa'])))
+
+        idx_sample_name = pd.Index(li_sample_name, name='serial_number')
+        arr_keep = ~idx_sample_name.duplicated(keep='last')
+        if not arr_keep.all():
+            idx_sample_name = idx_sample_name[arr_keep]
+            arr_abundance = arr_abundance[arr_keep]
+
+        # Keep the matrix C-contiguous: column means then sum in the same order as the legacy csv frame
+        df_db = pd.DataFrame(np.ascontiguousarray(arr_abundance), index=idx_sample_name, columns=manifest['taxa'])
+
+        return df_db
+
+    def lock(self, shared=False):
+        """
+        Advisory lock of the store - exclusive for writers. Use as a context manager or acquire()/release().
+        """
+        return StoreLock(f"{self.path_store}/.lock", shared=shared)
+
+    def write_segment(self, name, arr_abundance, li_sample_name):
+        """
+        Write the files of a new segment, fsynced before the manifest refers to them.
+        """
+        with open(f"{self.path_store}/{name}.npy", 'wb') as f:
+            np.save(f, arr_abundance)
+            f.flush()
+            os.fsync(f.fileno())
+        with open(f"{self.path_store}/{name}.ids", 'w', encoding='utf-8') as f:
+            f.write(''.join(f"{sample_name}\n" for sample_name in li_sample_name))
+            f.flush()
+            os.fsync(f.fileno())
+
+    def append(self, df_abundance):
+        """
+        Append the rows of a (sample x taxa) DataFrame as a new segment. Cost is O(new samples).
+        Concurrent writers must hold lock() around the whole read-append-publish sequence.
+
+        Returns:
+        The updated manifest.
+        """
+        manifest = self.read_manifest()
+
+        if len(df_abundance) > 0:
+            arr_abundance = np.ascontiguousarray(df_abundance[manifest['taxa']].to_numpy(dtype=np.float64))
+            name = f"seg_{manifest['next_segment']:06d}"
+
+            self.write_segment(name, arr_abundance, df_abundance.index)
+
+            manifest['segments'].append({'name': name, 'n_sample': len(df_abundance), 'sha256': self.segment_hash(name)})
+            manifest['next_segment'] += 1
+            manifest['version'] += 1
+            manifest['content_hash'] = self.content_hash(manifest)
+            write_json_atomic(self.path_manifest, manifest)
+
+        if len(manifest['segments']) > COMPACT_SEGMENTS:
+            manifest = self.compact()
+
+        return manifest
+
+    def compact(self):
+        """
+        Merge all segments into one, dropping rows superseded by a later segment.
+
+        Returns:
+        The updated manifest.
+        """
+        manifest = self.read_manifest()
+        li_old_segment = [segment['name'] for segment in manifest['segments']]
+
+        if len(li_old_segment) <= 1:
+            return manifest
+
+        df_db = self.load(manifest)
+        name = f"seg_{manifest['next_segment']:06d}"
+
+        self.write_segment(name, np.ascontiguousarray(df_db.to_numpy(dtype=np.float64)), df_db.index)
+
+        manifest['segments'] = [{'name': name, 'n_sample': len(df_db), 'sha256': self.segment_hash(name)}]
+        manifest['next_segment'] += 1
+        manifest['version'] += 1
+        manifest['content_hash'] = self.content_hash(manifest)
+        self.retire_segments(manifest, li_old_segment)
+
+        return manifest
+
+
+    def rewrite(self, df_db, dict_group=None):
+        """
+        Replace the whole reference with the rows of df_db, written as one segment - a rebuild. The taxa become
+        the columns of df_db and the groups dict_group; the version keeps growing. Writers must hold lock().
+
+        Returns:
+        The updated manifest.
+        """
+        manifest = self.read_manifest() if self.exists() else self.create(df_db.columns, dict_group)
+        li_old_segment = [segment['name'] for segment in manifest['segments']]
+
+        manifest['taxa'] = list(df_db.columns)
+        manifest.pop('groups', None)
+        if dict_group is not None:
+            manifest['groups'] = {'beneficial': list(dict_group['beneficial']), 'harmful': list(dict_group['harmful'])}
+
+        manifest['segments'] = []
+        if len(df_db) > 0:
+            name = f"seg_{manifest['next_segment']:06d}"
+            self.write_segment(name, np.ascontiguousarray(df_db.to_numpy(dtype=np.float64)), df_db.index)
+            manifest['segments'].append({'name': name, 'n_sample': len(df_db), 'sha256': self.segment_hash(name)})
+            manifest['next_segment'] += 1
+        manifest['version'] += 1
+        manifest['content_hash'] = self.content_hash(manifest)
+        self.retire_segments(manifest, li_old_segment)
+
+        return manifest
+
+    def retire_segments(self, manifest, li_old_segment):
+        """
+        Write the manifest that replaces li_old_segment, keeping them as its retired segments for the readers of the
+        previous manifest; the segments retired by the previous compaction are deleted.
+        """
+        li_delete = [name for name in manifest.get('retired', []) if name not in li_old_segment]
+        manifest['retired'] = list(li_old_segment)
+        write_json_atomic(self.path_manifest, manifest)
+
+        for old in li_delete:
+            for ext in ['npy', 'ids']:
+                if os.path.exists(f"{self.path_store}/{old}.{ext}"):
+                    os.remove(f"{self.path_store}/{old}.{ext}")
+
+
+#-------------------------------------------------------
+# Published reference matrix
+#-------------------------------------------------------
+# reference.mat is the current (deduplicated) reference as one file that readers memory-map, so
+# every process shares the page cache copy and opening it costs the same for any reference size:
+#   'EGVMAT01'               magic
+#   uint64                   length of the JSON header
+#   JSON header              format, version, content_hash, taxa, n_sample and the section offsets
+#   float64 (sample x taxa)  abundance matrix, C order, 64-byte aligned
+#   float64 (column x sample) every taxon and the beneficial/harmful totals sorted ascending, for percentile lookups
+#   uint64 (n_sample)        sample-ID keys (hash_sample_ids) sorted ascending, for row lookups by ID
+#   int64 (n_sample)         row of every sorted key
+#   int64 (n_sample + 1)     byte offsets of the sample IDs in the ID section
+#   utf-8                    sample IDs, concatenated
+# The updater rewrites it through a temporary file, fsync and os.replace; open readers keep their mapping.
+
+MATRIX_MAGIC = b'EGVMAT01'
+MATRIX_FORMAT = 3
+MATRIX_ALIGN = 64
+
+
+def align_offset(offset):
+    return -(-offset // MATRIX_ALIGN) * MATRIX_ALIGN
+
+
+def store_groups(manifest):
+    """
+    Beneficial and harmful taxa of a store - those of its panel, or the default ones for stores created without.
+
+    Returns:
+    A tuple (li_beneficial, li_harmful).
+    """
+    dict_group = manifest.get('groups', {'beneficial': LI_BENEFICIAL, 'harmful': LI_HARMFUL})
+
+    return list(dict_group['beneficial']), list(dict_group['harmful'])
+
+
+def sort_reference_columns(df_db, li_taxa, li_beneficial=LI_BENEFICIAL, li_harmful=LI_HARMFUL):
+    """
+    Every taxon column and, when the taxa include them, the beneficial/harmful totals of the reference, sorted ascending.
+
+    Returns:
+    A tuple (li_sorted_column, arr_sorted) with one row of arr_sorted per column.
+    """
+    li_sorted_column = list(li_taxa)
+    li_arr = [df_db[taxon].to_numpy(dtype='<f8') for taxon in li_taxa]
+
+    if set(li_beneficial + li_harmful) <= set(li_taxa):
+        li_sorted_column += LI_GROUP_TOTAL
+        li_arr += [sr_total.to_numpy(dtype='<f8') for sr_total in calculate_group_total(df_db, li_beneficial, li_harmful)]
+
+    arr_sorted = np.sort(np.array(li_arr, dtype='<f8').reshape(len(li_sorted_column), len(df_db)), axis=1)
+
+    return li_sorted_column, arr_sorted
+
+
+def write_reference_matrix(path_matrix, df_db, manifest, arr_row_key=None):
+    """
+    Publish the (sample x taxa) reference as a memory-mappable matrix file, with its sorted columns and its sample-ID keys.
+
+    Parameters:
+    path_matrix (str): Path of the matrix file.
+    df_db (DataFrame): Current reference, one row per sample, columns in the taxa order of the manifest.
+    manifest (dict): Store manifest the reference belongs to.
+    arr_row_key (ndarray): hash_sample_ids of the rows of df_db, if the caller has them (default: hashed here).
+    """
+    arr_abundance = np.ascontiguousarray(df_db[manifest['taxa']].to_numpy(dtype='<f8'))
+    li_sorted_column, arr_sorted = sort_reference_columns(df_db, manifest['taxa'], *store_groups(manifest))
+    arr_row_key = hash_sample_ids(df_db.index) if arr_row_key is None else np.asarray(arr_row_key, dtype='<u8')
+    arr_key_row = np.argsort(arr_row_key, kind='stable').astype('<i8')
+    arr_key = arr_row_key[arr_key_row]
+    li_id_bytes = [str(sample_name).encode('utf-8') for sample_name in df_db.index]
+    arr_id_offset = np.zeros(len(li_id_bytes) + 1, dtype='<i8')
+    np.cumsum([len(id_bytes) for id_bytes in li_id_bytes], out=arr_id_offset[1:])
+
+    dict_header = {'format': MATRIX_FORMAT, 'version': manifest['version'], 'content_hash': manifest['content_hash'],
+                   'taxa': list(manifest['taxa']), 'n_sample': len(df_db), 'dtype': '<f8', 'sorted_columns': li_sorted_column}
+    # Section offsets depend on the header length - fix them with placeholders of the final width first
+    dict_header.update({'matrix_offset': 0, 'sorted_offset': 0, 'key_offset': 0, 'key_row_offset': 0, 'id_offset_offset': 0, 'id_offset': 0,
+                        'id_nbytes': int(arr_id_offset[-1])})
+    header_nbytes = len(json.dumps(dict_header).encode('utf-8')) + 6*20
+    dict_header['matrix_offset'] = align_offset(len(MATRIX_MAGIC) + 8 + header_nbytes)
+    dict_header['sorted_offset'] = align_offset(dict_header['matrix_offset'] + arr_abundance.nbytes)
+    dict_header['key_offset'] = align_offset(dict_header['sorted_offset'] + arr_sorted.nbytes)
+    dict_header['key_row_offset'] = align_offset(dict_header['key_offset'] + arr_key.nbytes)
+    dict_header['id_offset_offset'] = align_offset(dict_header['key_row_offset'] + arr_key_row.nbytes)
+    dict_header['id_offset'] = dict_header['id_offset_offset'] + arr_id_offset.nbytes
+    header = json.dumps(dict_header).encode('utf-8').ljust(header_nbytes)
+
+    path_tmp = f"{path_matrix}.{os.getpid()}.tmp"
+    with open(path_tmp, 'wb') as f:
+        f.write(MATRIX_MAGIC + np.uint64(len(header)).tobytes() + header)
+        f.seek(dict_header['matrix_offset'])
+        f.write(arr_abundance.tobytes())
+        f.seek(dict_header['sorted_offset'])
+        f.write(arr_sorted.tobytes())
+        f.seek(dict_header['key_offset'])
+        f.write(arr_key.tobytes())
+        f.seek(dict_header['key_row_offset'])
+        f.write(arr_key_row.tobytes())
+        f.seek(dict_header['id_offset_offset'])
+        f.write(arr_id_offset.tobytes())
+        f.write(b''.join(li_id_bytes))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path_tmp, path_matrix)
+    fsync_dir(os.path.dirname(os.path.abspath(path_matrix)))
+
+
+def read_matrix_header(path_matrix):
+    with open(path_matrix, 'rb') as f:
+        if f.read(len(MATRIX_MAGIC)) != MATRIX_MAGIC:
+            raise ValueError(f"Not a reference matrix file: {path_matrix}")
+        header_nbytes = int(np.frombuffer(f.read(8), dtype=np.uint64)[0])
+
+        return json.loads(f.read(header_nbytes).decode('utf-8'))
+
+
+class ReferenceMatrix:
+    def __init__(self, path_matrix):
+        """
+        Open a published reference matrix. Only the header is read; the sections are memory-mapped.
+
+        Parameters:
+        path_matrix (str): Path of the matrix file.
+        """
+        self.path_matrix = path_matrix
+
+        self.dict_header = read_matrix_header(path_matrix)
+
+        if self.dict_header['format'] != MATRIX_FORMAT:
+            raise ValueError(f"Unsupported reference matrix format: {self.dict_header['format']}")
+
+        self.li_taxa = self.dict_header['taxa']
+        self.n_sample = self.dict_header['n_sample']
+        self.version = self.dict_header['version']
+        self.content_hash = self.dict_header['content_hash']
+
+        self.li_sorted_column = self.dict_header['sorted_columns']
+        
+        if self.n_sample > 0:
+            self.arr_abundance = np.memmap(path_matrix, dtype=self.dict_header['dtype'], mode='r',
+                                           offset=self.dict_header['matrix_offset'], shape=(self.n_sample, len(self.li_taxa)))
+            self.arr_sorted = np.memmap(path_matrix, dtype='<f8', mode='r',
+                                        offset=self.dict_header['sorted_offset'], shape=(len(self.li_sorted_column), self.n_sample))
+            self.arr_key = np.memmap(path_matrix, dtype='<u8', mode='r', offset=self.dict_header['key_offset'], shape=(self.n_sample,))
+            self.arr_key_row = np.memmap(path_matrix, dtype='<i8', mode='r', offset=self.dict_header['key_row_offset'], shape=(self.n_sample,))
+        else:
+            self.arr_abundance = np.empty((0, len(self.li_taxa)))
+            self.arr_sorted = np.empty((len(self.li_sorted_column), 0))
+            self.arr_key = np.empty(0, dtype='<u8')
+            self.arr_key_row = np.empty(0, dtype='<i8')
+        self.arr_id_offset = np.memmap(path_matrix, dtype='<i8', mode='r', offset=self.dict_header['id_offset_offset'], shape=(self.n_sample + 1,))
+
+    def sorted_column(self, col):
+        """
+        Ascending values of one reference column (a taxon or a beneficial/harmful total), memory-mapped.
+        """
+        return self.arr_sorted[self.li_sorted_column.index(col)]
+
+    def read_ids(self, start=0, stop=None):
+        stop = self.n_sample if stop is None else stop
+        if stop <= start:
+            return b''
+
+        with open(self.path_matrix, 'rb') as f:
+            f.seek(self.dict_header['id_offset'] + int(self.arr_id_offset[start]))
+            return f.read(int(self.arr_id_offset[stop] - self.arr_id_offset[start]))
+
+    def sample_name(self, idx):
+        return self.read_ids(idx, idx + 1).decode('utf-8')
+
+    def row_keys(self):
+        """
+        hash_sample_ids of every row, in row order - from the sorted key section, without hashing.
+        """
+        arr_row_key = np.empty(self.n_sample, dtype='<u8')
+        arr_row_key[np.asarray(self.arr_key_row)] = self.arr_key
+
+        return arr_row_key
+
+    def find_rows(self, li_sample_name):
+        """
+        Rows of the given sample IDs - a binary search of their keys, confirmed against the stored IDs.
+
+        Returns:
+        int64 ndarray, -1 for the IDs not in the reference.
+        """
+        arr_hash = hash_sample_ids(li_sample_name)
+        arr_idx = np.searchsorted(self.arr_key, arr_hash)
+        arr_row = np.full(len(arr_hash), -1, dtype=np.int64)
+
+        arr_found = arr_idx < len(self.arr_key)
+        arr_found[arr_found] = self.arr_key[arr_idx[arr_found]] == arr_hash[arr_found]
+        for pos in np.flatnonzero(arr_found):
+            # Keys are unique in a reference; a hash collision with another ID is a miss
+            row = int(self.arr_key_row[arr_idx[pos]])
+            if self.sample_name(row) == str(li_sample_name[pos]):
+                arr_row[pos] = row
+
+        return arr_row
+
+    def sample_names(self):
+        data = self.read_ids()
+        arr_id_offset = np.asarray(self.arr_id_offset)
+
+        return [data[start:stop].decode('utf-8') for start, stop in zip(arr_id_offset[:-1].tolist(), arr_id_offset[1:].tolist())]
+
+    def to_frame(self):
+        """
+        The reference as a (sample x taxa) DataFrame backed by the memory map (no copy of the matrix).
+        """
+        return pd.DataFrame(np.asarray(self.arr_abundance), index=pd.Index(self.sample_names(), name='serial_number'), columns=self.li_taxa, copy=False)
+
+
+def open_reference_matrix(path_store, content_hash=None):
+    """
+    Open the published matrix of a store.
+
+    Returns:
+    The ReferenceMatrix, or None if it is missing, of an older format or, with content_hash given, stale.
+    """
+    path_matrix = f"{path_store}/reference.mat"
+    if (not os.path.exists(path_matrix)) or (read_matrix_header(path_matrix)['format'] != MATRIX_FORMAT):
+        return None
+
+    refmatrix = ReferenceMatrix(path_matrix)
+    if (content_hash is not None) and (refmatrix.content_hash != content_hash):
+        return None
+
+    return refmatrix
+
+
+def publish_reference_matrix(refstore, manifest, prev_content_hash=None, df_added=None):
+    """
+    Publish reference.mat for the current manifest. If the published matrix belongs to prev_content_hash and
+    the store only gained the rows of df_added since, the new matrix is the old one minus the superseded rows plus
+    df_added - the order refstore.load() gives - without reading the segments.
+
+    Returns:
+    The number of samples published.
+    """
+    refmatrix = open_reference_matrix(refstore.path_store, prev_content_hash) if (prev_content_hash is not None) and (df_added is not None) else None
+
+    if refmatrix is not None:
+        # The keys of the kept rows are carried over - only the added IDs are hashed
+        df_old = refmatrix.to_frame()
+        arr_keep = ~df_old.index.isin(df_added.index)
+        df_db = pd.concat([df_old[arr_keep], df_added[manifest['taxa']]])
+        arr_row_key = np.concatenate([refmatrix.row_keys()[arr_keep], hash_sample_ids(df_added.index)])
+    else:
+        df_db = refstore.load(manifest)
+        arr_row_key = None
+
+    write_reference_matrix(f"{refstore.path_store}/reference.mat", df_db, manifest, arr_row_key)
+
+    return len(df_db)
+
+
+#-------------------------------------------------------
+# Sample-ID registry
+#-------------------------------------------------------
+# registry.idx holds the 64-bit blake2b hashes of every sample ID in the store, sorted, behind a small
+# header with the content hash of the manifest it belongs to:
+#   'EGVREG01' | uint64 header length | JSON header | uint64 hashes (64-byte aligned)
+# Membership of a whole plate is one vectorized binary search over the memory-mapped hashes instead of
+# reading the .ids file of every segment. A stale or missing registry is rebuilt from the segments.
+
+REGISTRY_MAGIC = b'EGVREG01'
+
+
+def hash_sample_ids(li_sample_name):
+    """
+    64-bit keys of sample IDs (blake2b). A collision within a reference of 10**6 samples has a probability of ~10**-8.
+    """
+    return np.fromiter((int.from_bytes(hashlib.blake2b(str(sample_name).encode('utf-8'), digest_size=8).digest(), 'little')
+                        for sample_name in li_sample_name), dtype='<u8', count=len(li_sample_name))
+
+
+class SampleRegistry:
+    def __init__(self, refstore):
+        """
+        Initializes a SampleRegistry object.
+
+        Parameters:
+        refstore (ReferenceStore): Store the registry belongs to; writers must hold its lock.
+        """
+        self.refstore = refstore
+        self.path_registry = f"{refstore.path_store}/registry.idx"
+        self.arr_key = np.empty(0, dtype='<u8')
+
+    def read(self, content_hash):
+        """
+        Memory-map the registry if it belongs to content_hash.
+
+        Returns:
+        True if it was current, False if it is missing or stale.
+        """
+        if not os.path.exists(self.path_registry):
+            return False
+
+        with open(self.path_registry, 'rb') as f:
+            if f.read(len(REGISTRY_MAGIC)) != REGISTRY_MAGIC:
+                return False
+            header_nbytes = int(np.frombuffer(f.read(8), dtype=np.uint64)[0])
+            dict_header = json.loads(f.read(header_nbytes).decode('utf-8'))
+
+        if dict_header['content_hash'] != content_hash:
+            return False
+
+        if dict_header['n_key'] > 0:
+            self.arr_key = np.memmap(self.path_registry, dtype='<u8', mode='r', offset=dict_header['key_offset'], shape=(dict_header['n_key'],))
+        else:
+            self.arr_key = np.empty(0, dtype='<u8')
+
+        return True
+
+    def write(self, manifest):
+        dict_header = {'content_hash': manifest['content_hash'], 'version': manifest['version'], 'n_key': len(self.arr_key), 'key_offset': 0}
+        header_nbytes = len(json.dumps(dict_header).encode('utf-8')) + 20
+        dict_header['key_offset'] = align_offset(len(REGISTRY_MAGIC) + 8 + header_nbytes)
+        header = json.dumps(dict_header).encode('utf-8').ljust(header_nbytes)
+
+        path_tmp = f"{self.path_registry}.{os.getpid()}.tmp"
+        with open(path_tmp, 'wb') as f:
+            f.write(REGISTRY_MAGIC + np.uint64(len(header)).tobytes() + header)
+            f.seek(dict_header['key_offset'])
+            f.write(np.ascontiguousarray(self.arr_key, dtype='<u8').tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path_tmp, self.path_registry)
+        fsync_dir(self.refstore.path_store)
+
+    def load(self, manifest):
+        """
+        The registry of the manifest - memory-mapped if current, otherwise rebuilt from the segment ids and written.
+        """
+        if not self.read(manifest['content_hash']):
+            self.arr_key = np.unique(hash_sample_ids(sorted(self.refstore.sample_ids(manifest))))
+            self.write(manifest)
+
+        return self
+
+    def contains(self, li_sample_name):
+        """
+        Membership of every sample ID.
+
+        Returns:
+        Boolean ndarray.
+        """
+        arr_hash = hash_sample_ids(li_sample_name)
+        arr_idx = np.searchsorted(self.arr_key, arr_hash)
+        arr_found = arr_idx < len(self.arr_key)
+        arr_found[arr_found] = self.arr_key[arr_idx[arr_found]] == arr_hash[arr_found]
+
+        return arr_found
+
+    def add(self, li_sample_name, manifest):
+        """
+        Register sample IDs appended to the store and write the registry for the new manifest.
+        """
+        self.arr_key = np.union1d(np.asarray(self.arr_key), hash_sample_ids(li_sample_name)).astype('<u8')
+        self.write(manifest)
+
+        return self
+
+
+def legacy_content_hash(path_csv):
+    """
+    Content hash of a legacy reference csv - that of the file, so it is known without parsing the csv.
+    """
+    return f"csv:{hash_file(path_csv, hashlib.sha256()).hexdigest()}"
+
+
+def read_legacy_reference(path_csv):
+    """
+    Read the wide (taxa x sample) EGvaginal_db_abundance.csv without migrating it, for readers of an install
+    whose store has not been created yet. Nothing is written.
+
+    Returns:
+    A tuple (df_db, manifest) - the reference and a version-0 manifest of its taxa, whose content hash is that of the file.
+    """
+    df_db = pd.read_csv(path_csv, index_col=0).transpose()
+    manifest = {'format': STORE_FORMAT, 'version': 0, 'taxa': df_db.columns.to_list(), 'segments': [], 'next_segment': 1,
+                'content_hash': legacy_content_hash(path_csv)}
+
+    return df_db, manifest
+
+
+def migrate_csv_to_store(path_csv, path_store):
+    """
+    One-time migration of the wide (taxa x sample) EGvaginal_db_abundance.csv into a reference store, with every
+    file an update writes: the segment and manifest, the sample-ID registry, the statistics snapshot, the published
+    matrix and the baseline of the drift series. The caller holds the store lock.
+
+    Parameters:
+    path_csv (str): Path of the legacy reference CSV.
+    path_store (str): Directory of the reference store to create.
+
+    Returns:
+    The ReferenceStore that was created.
+    """
+    # Imported here - both modules build on the store
+    from vaginal_pcr_stats import compute_reference_stats, write_stats_snapshot
+    from vaginal_pcr_drift import record_baseline
+
+    df_db = pd.read_csv(path_csv, index_col=0).transpose()
+
+    store = ReferenceStore(path_store)
+    store.create(df_db.columns.to_list())
+    manifest = store.append(df_db)
+
+    registry = SampleRegistry(store)
+    registry.arr_key = np.unique(hash_sample_ids(df_db.index))
+    registry.write(manifest)
+
+    write_stats_snapshot(f"{path_store}/stats.json", compute_reference_stats(df_db, manifest))
+    write_reference_matrix(f"{path_store}/reference.mat", df_db, manifest)
+    record_baseline(path_store, manifest, df_db)
+
+    return store
+
+
+def open_store(path_store, path_csv, plan=None):
+    """
+    Open the reference store for an update, migrating it from the legacy CSV on first use (or creating it empty
+    without one). An empty store is created for the taxa and groups of the panel plan, or of the default panel if
+    plan is None. Readers do not call this - they read the legacy CSV as it is until an update migrates it.
+    """
+    store = ReferenceStore(path_store)
+
+    if not store.exists():
+        # Two processes may start on a fresh install - only one migrates
+        with store.lock():
+            if (not store.exists()) and os.path.exists(path_csv):
+                migrate_csv_to_store(path_csv, path_store)
+            elif not store.exists():
+                # New shard without a legacy reference - starts empty
+                if plan is None:
+                    store.create(LI_MICROBIOME)
+                else:
+                    store.create(plan['li_microbiome'], {'beneficial': plan['li_beneficial'], 'harmful': plan['li_harmful']})
+
+    return store
+
+
+####################################
+# main
+####################################
+if __name__ == '__main__':
+    curdir = os.path.dirname(os.path.abspath(__file__))
+
+    path_store = f"{curdir}/input/EGvaginal_db"
+
+    if ReferenceStore(path_store).exists():
+        print(f"Reference store already exists: {path_store}")
+        sys.exit(1)
+
+    with ReferenceStore(path_store).lock():
+        migrate_csv_to_store(f"{curdir}/input/EGvaginal_db_abundance.csv", path_store)
+
+    print('Migration Complete')
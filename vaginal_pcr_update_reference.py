@@ -1,22 +1,46 @@
-##<Usage: python Script.py {path_exp}>
+##<Usage: python Script.py {path_exp} [{path_exp} ...] [--policy keep-first|replace|keep-both] [--verify] [--store DIR] [--panel FILE]>
+##<       python Script.py --enqueue {path_exp} [...] | --queue>
 ### ex) python vaginal_pcr_update_reference.py "/home/kbkim/vaginal_pcr/input/EGvaginal_experiment_result.xlsx"
+### --policy  : samples already in the reference, or repeated on the plates, are
+###             keep-first (default) - the existing / first values are kept
+###             replace              - the latest values replace them (--replace is the same)
+###             keep-both            - every run is kept; repeats get the next free suffix _run2, _run3, ...
+### --verify  : compare the incrementally updated statistics with a full recompute of the reference
+### --enqueue : only copy the plates into the ingest queue (input/EGvaginal_db/queue)
+### --queue   : ingest every queued plate in one locked write, then move them to queue/done
+### --store   : reference store (shard) to update (default: input/EGvaginal_db)
+### --panel   : target panel definition (json, see vaginal_pcr_panel.py); a new store is created for its taxa
 
-import os, datetime
+import os, glob, shutil, datetime, argparse
 import pandas as pd
 import sys
 import numpy as np
-from scipy.stats import percentileofscore, pearsonr
-import matplotlib.pyplot as plt
-
-# Check if the script is being called with the correct arguments
-if len(sys.argv) < 2:
-    print("Usage: python Script.py <path_exp>")
-    print("Example: python vaginal_pcr_update_reference.py \"/home/kbkim/vaginal_pcr/input/EGvaginal_experiment_result.xlsx\"")
-    sys.exit(1)
-    
-# path_exp : Path of Merged Proportion file to analyze
-path_exp = sys.argv[1] 
 
+from vaginal_pcr_reader import read_experiment
+from vaginal_pcr_profile import instrument_stage, profiler_from_env
+from vaginal_pcr_engine import calculate_abundance, split_runs
+from vaginal_pcr_panel import load_plan
+from vaginal_pcr_store import SampleRegistry, open_store, publish_reference_matrix, store_groups
+from vaginal_pcr_stats import ReferenceAccumulator, compare_reference_stats, compute_reference_stats, load_stats_snapshot, write_stats_snapshot
+from vaginal_pcr_drift import record_update
+
+#-------------------------------------------------------
+# Concurrency
+#-------------------------------------------------------
+# An update holds the store lock exclusively from InsertDataDB to PublishReference: the statistics
+# snapshot it builds on, the new segment, stats.json and reference.mat then all belong to one
+# manifest version, and a concurrent update waits instead of losing its plate. Analyses do not
+# take the lock; they pin the manifest version they read (see open_reference_snapshot).
+#
+# Plates dropped into the queue directory (--enqueue, or any atomic copy) are ingested together by
+# --queue: one lock, one segment, one statistics and matrix write for all pending plates.
+
+#-------------------------------------------------------
+# Duplicate sample IDs
+#-------------------------------------------------------
+# A sample ID is a duplicate if it is already in the reference (looked up in the store's sample-ID
+# registry) or occurs earlier in the ingested runs - in plate order, then run order on the plate.
+LI_POLICY = ['keep-first', 'replace', 'keep-both']
 
 #-------------------------------------------------------
 # Common Function
@@ -40,42 +64,182 @@ def WriteLog(functionname, msg, type='INFO', fplog=None):
     if( fplog != None ):
         fplog.write(writestr)
         fplog.flush()
+
+
+def enqueue_plates(li_path_exp, path_queue):
+    """
+    Copy plates into the ingest queue. Each copy is renamed into place, so a running ingest never sees a partial file.
+
+    Returns:
+    List of the queued paths.
+    """
+    os.makedirs(path_queue, exist_ok=True)
+
+    li_queued = []
+    for path_exp in li_path_exp:
+        stamp = datetime.datetime.now().strftime('%Y%m%d_%H%M%S_%f')
+        path_queued = f"{path_queue}/{stamp}_{os.path.basename(path_exp)}"
+        shutil.copyfile(path_exp, f"{path_queue}/.{os.path.basename(path_queued)}.tmp")
+        os.replace(f"{path_queue}/.{os.path.basename(path_queued)}.tmp", path_queued)
+        li_queued.append(path_queued)
+
+    return li_queued
+
+
+def claim_plates(path_queue):
+    """
+    Claim the plates waiting in the ingest queue, oldest first, by moving them into a directory of this process.
+    The rename succeeds for one process only, so concurrent --queue runs never ingest a plate twice;
+    plates of a failed run stay in its claim directory.
+
+    Returns:
+    List of the claimed paths.
+    """
+    path_claim = f"{path_queue}/claimed_{os.getpid()}"
+    os.makedirs(path_claim, exist_ok=True)
+
+    li_claimed = []
+    for path_exp in sorted(path for path in glob.glob(f"{path_queue}/*") if os.path.isfile(path)):
+        try:
+            os.replace(path_exp, f"{path_claim}/{os.path.basename(path_exp)}")
+        except FileNotFoundError:
+            continue
+        li_claimed.append(f"{path_claim}/{os.path.basename(path_exp)}")
+
+    if not li_claimed:
+        os.rmdir(path_claim)
+
+    return li_claimed
+
+
+def next_run_name(sample_name, set_taken, registry):
+    """
+    First of sample_name_run2, sample_name_run3, ... that is neither in the reference nor taken by this ingest.
+    """
+    run = 2
+    while (f"{sample_name}_run{run}" in set_taken) or registry.contains([f"{sample_name}_run{run}"])[0]:
+        run += 1
+
+    return f"{sample_name}_run{run}"
+
+
+def resolve_sample_ids(df_abundance, registry, policy):
+    """
+    Apply the duplicate policy to the ingested rows.
+
+    Parameters:
+    df_abundance (DataFrame): Abundances of every run, in plate and run order; the index may repeat.
+    registry (SampleRegistry): Sample IDs of the reference.
+    policy (str): One of LI_POLICY.
+
+    Returns:
+    A tuple (df_insert, li_replaced, li_renamed) - the rows to append, the existing samples they replace
+    and the (sample name, new name) pairs of renamed repeats.
+    """
+    idx_sample_name = df_abundance.index
+    arr_exist = registry.contains(idx_sample_name)
+
+    if policy == 'keep-first':
+        df_insert = df_abundance[~arr_exist & ~idx_sample_name.duplicated(keep='first')]
+        return df_insert, [], []
+
+    if policy == 'replace':
+        arr_keep = ~idx_sample_name.duplicated(keep='last')
+        df_insert = df_abundance[arr_keep]
+        return df_insert, df_insert.index[arr_exist[arr_keep]].to_list(), []
+
+    if policy != 'keep-both':
+        raise ValueError(f"Unknown duplicate policy {policy} (expected one of {', '.join(LI_POLICY)})")
+
+    li_sample_name = idx_sample_name.to_list()
+    li_renamed = []
+    set_taken = set()
+    for idx, sample_name in enumerate(li_sample_name):
+        if arr_exist[idx] or (sample_name in set_taken):
+            li_sample_name[idx] = next_run_name(sample_name, set_taken, registry)
+            li_renamed.append((sample_name, li_sample_name[idx]))
+        set_taken.add(li_sample_name[idx])
+
+    df_insert = df_abundance.set_axis(pd.Index(li_sample_name, name=idx_sample_name.name), axis=0)
+
+    return df_insert, [], li_renamed
+
+
+def finish_plates(li_path_exp, path_queue):
+    # Ingested plates are kept in queue/done for reference
+    os.makedirs(f"{path_queue}/done", exist_ok=True)
+    for path_exp in li_path_exp:
+        os.replace(path_exp, f"{path_queue}/done/{os.path.basename(path_exp)}")
+        
+    path_claim = os.path.dirname(li_path_exp[0]) if li_path_exp else None
+    if (path_claim is not None) and (path_claim != path_queue) and (not os.listdir(path_claim)):
+        os.rmdir(path_claim)
         
          
 ###################################
 # MainClass
 ###################################
 class VaginalPCRUpdateRef:
-    def __init__(self, path_exp, fplog=None):
+    def __init__(self, path_exp, fplog=None, replace=False, verify=False, profiler=None, path_db_store=None, policy=None, plan=None):
         """
         Initializes a VaginalPCRUpdateRef object.
 
         Parameters:
-        path_exp (str): Path of PCR experiment result file to analyze.
+        path_exp (str or list): Path of PCR experiment result file to analyze, or a list of them ingested as one write.
+        replace (bool): Re-run samples replace their existing values in the reference (policy='replace').
+        verify (bool): Compare the incremental statistics update with a full recompute.
+        profiler (StageProfiler): Records timing and memory of every stage if given.
+        path_db_store (str): Directory of the reference store (default: input/EGvaginal_db).
+        policy (str): Duplicate sample policy - 'keep-first', 'replace' or 'keep-both' (default: by replace).
+        plan (dict): Compiled target panel (vaginal_pcr_panel) of the plates and the store (default: the default panel).
         """
         self.__fplog=fplog        
+        self.profiler = profiler
+        self.plan = plan if plan is not None else load_plan()
+        self.policy = policy if policy is not None else ('replace' if replace else 'keep-first')
+        self.replace = self.policy == 'replace'
+        self.verify = verify
         
         ## Path of Reference files
         curdir = os.path.dirname(os.path.abspath(__file__))
-        self.path_exp = path_exp
-        self.path_db = f"{curdir}/input/EGvaginal_db_abundance.csv"
+        self.li_path_exp = [path_exp] if isinstance(path_exp, str) else list(path_exp)
+        self.path_exp = self.li_path_exp[0] if len(self.li_path_exp) == 1 else f"{len(self.li_path_exp)} plates"
+        self.path_db_store = path_db_store if path_db_store is not None else f"{curdir}/input/EGvaginal_db"
+        self.path_db = f"{curdir}/input/EGvaginal_db_abundance.csv" if path_db_store is None else f"{path_db_store}_abundance.csv"
+        self.path_db_stats = f"{self.path_db_store}/stats.json"
         
         ## Path of output files     
 
 
         
-        ## Dataframe of Reference files
+        ## Reference store, its lock & Dataframe of Reference files
+        self.refstore = None
+        self.lock = None
+        self.li_df_exp = None
         self.df_exp = None
         self.df_db = None
+        self.df_replaced = None
+        
+        ## Reference statistics, manifest and content hash before the update
+        self.dict_ref_stats = None
+        self.prev_manifest = None
+        self.prev_content_hash = None
         
-        ## Dataframe of output files to calculate
+        ## Dataframe of output files to calculate, and the abundances of every plate for the drift series
         self.df_abundance = None
+        self.li_plate_abundance = None
         
         ## Lists used for calculation
         self.li_new_sample_name = None
         self.li_microbiome = None
         
         
+    def release_lock(self):
+        if self.lock is not None:
+            self.lock.release()
+            self.lock = None
+        
+    @instrument_stage('df_exp')
     def ReadDB(self):
         myNAME = self.__class__.__name__+"::"+sys._getframe().f_code.co_name
         WriteLog(myNAME, "In", type='INFO', fplog=self.__fplog)
@@ -84,30 +248,12 @@ class VaginalPCRUpdateRef:
         rvmsg = "Success"
         
         try:           
-            self.df_db = pd.read_csv(self.path_db)
-            
-            self.df_exp = pd.read_excel(self.path_exp)
-            idx_well_id = list(self.df_exp[self.df_exp.columns[0]]).index('Well')
-            self.df_exp = self.df_exp[idx_well_id:].rename(columns = self.df_exp[idx_well_id:].reset_index().iloc[0]).drop(idx_well_id).set_index('Well')
-            
-            li_column = self.df_exp.columns.values.tolist()
-            
-            if "Cт" in li_column:
-                self.df_exp = self.df_exp[["Sample Name", "Target Name", "Cт", 'Tm1']]
-                self.df_exp.rename(columns = {"Sample Name": "sample_name", "Target Name": "microbiome", "Cт": "Ct", "Tm1": "Tm1"}, inplace=True)
-                
-            elif "CT" in li_column:
-                self.df_exp = self.df_exp[["Sample Name", "Target Name", "CT", 'Tm1']]
-                self.df_exp.rename(columns = {"Sample Name": "sample_name", "Target Name": "microbiome", "CT": "Ct", "Tm1": "Tm1"}, inplace=True)
-            
-            else:
-                print("Check the columns of Experiment result file")
-                sys.exit()
-            
-            idx_nan_id = self.df_exp.index.to_list().index(np.nan)
-            self.df_exp = self.df_exp.iloc[:idx_nan_id, :]
-            self.df_exp.loc[self.df_exp['Ct'] == 'Undetermined', 'Ct'] = 40.1
+            # Only the store handle is needed - ingest never loads the existing abundances
+            self.refstore = open_store(self.path_db_store, self.path_db, self.plan)
             
+            # Experiment results - streamed result tables with float Ct (Undetermined -> ct_undetermined of the panel) and Tm1
+            self.li_df_exp = [read_experiment(path_exp, self.plan['ct_undetermined']) for path_exp in self.li_path_exp]
+            self.df_exp = pd.concat(self.li_df_exp) if len(self.li_df_exp) > 1 else self.li_df_exp[0]
         except Exception as e:
             print(str(e))
             rv = False
@@ -116,6 +262,7 @@ class VaginalPCRUpdateRef:
             
         return rv, rvmsg   
 
+    @instrument_stage('df_abundance')
     def CalculateProportion(self):
         """
         Calculate the Relative Abundance and Save the Relative Abundance data as an Csv file.
@@ -131,29 +278,33 @@ class VaginalPCRUpdateRef:
         rvmsg = "Success"
         
         try:      
-            self.li_new_sample_name = list(dict.fromkeys(self.df_exp.sample_name)) 
-            self.li_microbiome = ['L_crispatus', 'L_gasseri', 'L_iners', 'L_jensenii', 'G_vaginalis', 'F_vaginae', 'BVAB-1']
+            self.li_microbiome = list(self.plan['li_microbiome'])
             
-            self.df_abundance = pd.DataFrame(index = self.li_microbiome, columns = self.li_new_sample_name)
-            self.df_abundance = self.df_abundance.fillna(0)
+            manifest = self.refstore.read_manifest()
+            if (sorted(manifest['taxa']) != sorted(self.li_microbiome)) or (store_groups(manifest) != (self.plan['li_beneficial'], self.plan['li_harmful'])):
+                raise ValueError(f"The reference store {self.path_db_store} does not hold the taxa and groups of the panel {self.plan['name']}")
             
-            for i in range(len(self.li_new_sample_name)):
-                for j in range(len(self.li_microbiome)):            
+            if self.policy not in LI_POLICY:
+                raise ValueError(f"Unknown duplicate policy {self.policy} (expected one of {', '.join(LI_POLICY)})")
             
-                    sample_name = self.li_new_sample_name[i]
-
-                    condition_universal = (self.df_exp.sample_name == sample_name) & (self.df_exp.microbiome == 'Universal')
-                    condition_microbiome = (self.df_exp.sample_name == sample_name) & (self.df_exp.microbiome == self.li_microbiome[j])
-
-                    ct = self.df_exp[condition_microbiome]['Ct'].values[0]
-                    ct_universal = self.df_exp[condition_universal]['Ct'].values[0]   
-                    Tm1 = self.df_exp[condition_microbiome]['Tm1'].values[0]
+            # Plates one by one, and every run of a sample repeated on a plate - the duplicates are resolved
+            # in this order by InsertDataDB, like sequential ingests of the runs would resolve them
+            li_df_abundance = []
+            self.li_plate_abundance = []
+            for path_exp, df_exp in zip(self.li_path_exp, self.li_df_exp):
+                li_df_run, li_partial = split_runs(df_exp, self.plan['li_target'])
+                
+                for df_run in li_df_run[1:]:
+                    WriteLog(myNAME, f"{os.path.basename(path_exp)}: {df_run['sample_name'].nunique()} samples repeated on the plate", type='INFO', fplog=self.__fplog)
+                if li_partial:
+                    WriteLog(myNAME, f"{os.path.basename(path_exp)}: incomplete repeat wells ignored for {', '.join(map(str, li_partial))}", type='WARNING', fplog=self.__fplog)
                     
-                    if (ct == 40.1) | (Tm1 <= 80):     
-                        self.df_abundance.loc[self.li_microbiome[j], self.li_new_sample_name[i]] = 0
-                        
-                    else:  
-                        self.df_abundance.loc[self.li_microbiome[j], self.li_new_sample_name[i]] = 2**(-(ct- ct_universal))
+                li_df_plate = [calculate_abundance(df_run, self.plan) for df_run in li_df_run]
+                li_df_abundance.extend(li_df_plate)
+                self.li_plate_abundance.append((os.path.splitext(os.path.basename(path_exp))[0], pd.concat(li_df_plate) if len(li_df_plate) > 1 else li_df_plate[0]))
+                
+            self.df_abundance = pd.concat(li_df_abundance) if len(li_df_abundance) > 1 else li_df_abundance[0]
+            self.li_new_sample_name = list(dict.fromkeys(self.df_abundance.index))
                         
         except Exception as e:
             print(str(e))
@@ -161,10 +312,16 @@ class VaginalPCRUpdateRef:
             rvmsg = str(e)
             print(f"Error has occurred in the {myNAME} process") 
             
-    # Insert data into DB - Merge the data frame df_db & df_exp
+        return rv, rvmsg
+            
+    # Insert data into DB - Append the new samples of df_abundance to the reference store
+    @instrument_stage('df_db')
     def InsertDataDB(self): 
         """
-        Inserts data into the database by merging the data frames df_db and df_abundance.
+        Inserts data into the database by appending the samples of df_abundance as a new store segment.
+        Duplicate samples are resolved by the policy against the sample-ID registry of the store, which is
+        updated with the appended IDs. Takes the store lock, held until PublishReference, and reads the
+        current statistics snapshot under it.
 
         Returns:
         A tuple (success, message), where success is a boolean indicating whether the operation was successful,
@@ -176,22 +333,129 @@ class VaginalPCRUpdateRef:
         rvmsg = "Success"
         
         try: 
-            self.df_db = pd.merge(self.df_db, self.df_abundance, how='outer',left_on='taxa', right_index=True, suffixes=['', '_right']) 
-            self.df_db = self.df_db.fillna(0)
-            self.df_db = self.df_db.filter(regex='^(?!.*_right).*') # Eliminate duplicate columns
+            self.lock = self.refstore.lock().acquire()
+            
+            manifest = self.refstore.read_manifest()
+            self.prev_manifest = manifest
+            self.prev_content_hash = manifest['content_hash']
+            self.dict_ref_stats = load_stats_snapshot(self.path_db_stats, self.prev_content_hash)
+            
+            registry = SampleRegistry(self.refstore).load(manifest)
+            self.df_db, li_replaced, li_renamed = resolve_sample_ids(self.df_abundance, registry, self.policy)
+            
+            # Previous values of the replaced samples, to be taken out of the statistics
+            self.df_replaced = self.refstore.lookup(li_replaced, manifest) if li_replaced else self.df_abundance.iloc[0:0]
+            
+            manifest = self.refstore.append(self.df_db)
+            registry.add(self.df_db.index, manifest)
+            
+            for sample_name, new_name in li_renamed:
+                WriteLog(myNAME, f"{sample_name} is a duplicate - kept as {new_name}", type='INFO', fplog=self.__fplog)
+            WriteLog(myNAME, f"{len(self.df_db)} of {len(self.df_abundance)} samples inserted, {len(self.df_replaced)} replaced, {len(li_renamed)} renamed ({self.policy})", type='INFO', fplog=self.__fplog)
+            
+        except Exception as e:
+            print(str(e))
+            rv = False
+            rvmsg = str(e)
+            print(f"Error has occurred in the {myNAME} process")    
+            self.release_lock()
+            
+        return rv, rvmsg      
+
+
+    @instrument_stage('df_db')
+    def UpdateStatistics(self): 
+        """
+        Update the reference statistics (means, group totals, histograms) with the inserted samples and save them
+        as the snapshot keyed by the content hash of the updated reference. The running sums and counts of the
+        previous snapshot are updated in O(new samples); without a valid previous snapshot they are rebuilt from the
+        whole reference. With verify=True the result is compared with a full recompute; on a mismatch the recompute is
+        saved and the stage fails, so the update stops before the matrix is published. The per-plate and cumulative
+        streaming statistics of the update are appended to the drift series of the store (vaginal_pcr_drift).
+
+        Returns:
+        A tuple (success, message), where success is a boolean indicating whether the operation was successful,
+        and message is a string containing a success or error message.
+        """   
+        myNAME = self.__class__.__name__+"::"+sys._getframe().f_code.co_name
+        WriteLog(myNAME, "In", type='INFO', fplog=self.__fplog)
+        rv = True
+        rvmsg = "Success"
+        
+        try: 
+            manifest = self.refstore.read_manifest()
+            
+            if (self.dict_ref_stats is not None) and ('accumulator' in self.dict_ref_stats):
+                acc = ReferenceAccumulator.from_dict(self.dict_ref_stats['accumulator'])
+                acc.remove(self.df_replaced)
+                acc.add(self.df_db)
+            else:
+                WriteLog(myNAME, "No valid statistics snapshot - rebuild from the whole reference", type='INFO', fplog=self.__fplog)
+                acc = ReferenceAccumulator(manifest['taxa'], *store_groups(manifest)).add(self.refstore.load(manifest))
+            
+            dict_stats = acc.to_stats(manifest)
+            
+            if self.verify:
+                dict_full_stats = compute_reference_stats(self.refstore.load(manifest), manifest)
+                li_mismatch = compare_reference_stats(dict_stats, dict_full_stats)
+                
+                if li_mismatch:
+                    rv = False
+                    rvmsg = f"Incremental statistics differ from the full recompute: {', '.join(li_mismatch)}"
+                    dict_stats = dict_full_stats
+                    
+                WriteLog(myNAME, f"Verify - {rvmsg}", type='INFO', fplog=self.__fplog)
+            
+            write_stats_snapshot(self.path_db_stats, dict_stats)
+            
+            # Drift series - a record that cannot be written only costs the next update a baseline scan
+            try:
+                record_update(self.path_db_store, manifest, self.prev_manifest, self.li_plate_abundance, self.df_db, self.df_replaced,
+                              lambda: self.refstore.load(manifest))
+            except Exception as e:
+                WriteLog(myNAME, f"Drift record not written: {e}", type='WARNING', fplog=self.__fplog)
+            
+        except Exception as e:
+            print(str(e))
+            rv = False
+            rvmsg = str(e)
+            print(f"Error has occurred in the {myNAME} process")    
+            self.release_lock()
+            
+        return rv, rvmsg      
+
+
+    @instrument_stage('df_db')
+    def PublishReference(self): 
+        """
+        Publish the updated reference as the memory-mapped matrix file (reference.mat) the analysis workers share.
+        The previous matrix is extended with the inserted samples when it is current, so the segments are not re-read.
+        Releases the store lock taken by InsertDataDB.
 
-            # Update the data - Convert df_exp to df_db
-            self.df_abundance = self.df_db       
-                      
-            self.df_db_rev = self.df_db.set_index(keys=['taxa'], inplace=False, drop=True)    
-            self.df_db_rev.to_csv(self.path_db, index_label='taxa')
+        Returns:
+        A tuple (success, message), where success is a boolean indicating whether the operation was successful,
+        and message is a string containing a success or error message.
+        """   
+        myNAME = self.__class__.__name__+"::"+sys._getframe().f_code.co_name
+        WriteLog(myNAME, "In", type='INFO', fplog=self.__fplog)
+        rv = True
+        rvmsg = "Success"
+        
+        try: 
+            manifest = self.refstore.read_manifest()
+            n_sample = publish_reference_matrix(self.refstore, manifest, prev_content_hash=self.prev_content_hash, df_added=self.df_db)
+            
+            WriteLog(myNAME, f"Reference matrix version {manifest['version']} published ({n_sample} samples)", type='INFO', fplog=self.__fplog)
+            
+            # The update is complete - let the next one in
+            self.release_lock()
             
         except Exception as e:
             print(str(e))
             rv = False
             rvmsg = str(e)
             print(f"Error has occurred in the {myNAME} process")    
-            sys.exit()
+            self.release_lock()
             
         return rv, rvmsg      
 
@@ -199,12 +463,71 @@ class VaginalPCRUpdateRef:
 ####################################
 # main
 ####################################
-if __name__ == '__main__':
+def main(li_arg=None):
+    """
+    Command line of the update - also the 'update-ref' command of vaginal_pcr_cli.py.
+    Exits with status 1 if a stage fails; the update stops at that stage and the store lock is released.
+
+    Parameters:
+    li_arg (list): Arguments (default: sys.argv[1:]).
+    """
+    parser = argparse.ArgumentParser(prog='update-ref', description="Ingest PCR experiment result files into the reference store")
+    parser.add_argument('path_exp', nargs='*', help="Experiment result files, ingested as one write")
+    parser.add_argument('--policy', default=None, choices=LI_POLICY, help="Duplicate sample policy (default: keep-first, or replace with --replace)")
+    parser.add_argument('--replace', action='store_true', help="Same as --policy replace")
+    parser.add_argument('--verify', action='store_true', help="Compare the incrementally updated statistics with a full recompute")
+    parser.add_argument('--enqueue', action='store_true', help="Only copy the files into the ingest queue of the store")
+    parser.add_argument('--queue', action='store_true', help="Ingest every queued file in one write, then move them to queue/done")
+    parser.add_argument('--store', default=None, help="Reference store (shard) to update (default: input/EGvaginal_db)")
+    parser.add_argument('--panel', default=None, help="Target panel definition (json, see vaginal_pcr_panel.py; default: the EGvaginal panel)")
+    args = parser.parse_args(li_arg)
+    
+    policy = args.policy if args.policy is not None else ('replace' if args.replace else 'keep-first')
+    path_db_store = os.path.abspath(args.store) if args.store is not None else None
+    li_path_exp = list(args.path_exp)
+    
+    curdir = os.path.dirname(os.path.abspath(__file__))
+    path_queue = f"{path_db_store if path_db_store is not None else f'{curdir}/input/EGvaginal_db'}/queue"
+    
+    if args.enqueue:
+        if not li_path_exp:
+            parser.error("--enqueue needs the experiment result files to queue")
+        for path_queued in enqueue_plates(li_path_exp, path_queue):
+            print(f"Queued {path_queued}")
+        sys.exit(0)
+        
+    if args.queue:
+        li_path_exp = claim_plates(path_queue)
+        if not li_path_exp:
+            print("No queued plates")
+            sys.exit(0)
+    
+    if not li_path_exp:
+        parser.error("no experiment result file given (or --queue)")
     
-    vaginalupdate = VaginalPCRUpdateRef(path_exp)
-    vaginalupdate.ReadDB()
-    vaginalupdate.CalculateProportion()
-    vaginalupdate.InsertDataDB()      
+    vaginalupdate = VaginalPCRUpdateRef(li_path_exp, policy=policy, verify=args.verify, profiler=profiler_from_env(), path_db_store=path_db_store,
+                                        plan=load_plan(args.panel))
+    li_stage = [vaginalupdate.ReadDB, vaginalupdate.CalculateProportion, vaginalupdate.InsertDataDB, vaginalupdate.UpdateStatistics,
+                vaginalupdate.PublishReference]
     
-    print('Update Complete')     
-            
\ No newline at end of file
+    for stage in li_stage:
+        rv, rvmsg = stage()
+        if not rv:
+            break
+    vaginalupdate.release_lock()
+    
+    if vaginalupdate.profiler is not None:
+        vaginalupdate.profiler.write_prometheus()
+    
+    if not rv:
+        print(f"Update failed in {stage.__name__}: {rvmsg}")
+        sys.exit(1)
+    
+    if args.queue:
+        finish_plates(li_path_exp, path_queue)
+    
+    print('Update Complete')
+
+
+if __name__ == '__main__':
+    main()